@@ -45,6 +45,10 @@ def create_app() -> Flask:
     except Exception:
         pass
 
+    # 処理時間の計測（Server-Timing ヘッダー）
+    from .utils.timing import init_request_timing
+    init_request_timing(app)
+
     # CSRF トークンをテンプレートで使えるようにする
     @app.context_processor
     def inject_csrf():
@@ -203,6 +207,11 @@ def create_app() -> Flask:
     except Exception as e:
         print(f"⚠️ export blueprint 登録エラー: {e}")
 
+    # 管理用コマンド（flask vouchers ...）
+    from .cli import nta_cli, vouchers_cli
+    app.cli.add_command(vouchers_cli)
+    app.cli.add_command(nta_cli)
+
     # エラーハンドラ
     @app.errorhandler(404)
     def not_found(error):
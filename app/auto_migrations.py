@@ -369,6 +369,56 @@ def run_auto_migrations():
             else:
                 logger.info(f"- {col_name} カラムは既に存在します (T_管理者)")
         
+        # 12. T_テナントテーブルに ai_confidence_threshold カラムを追加
+        if not column_exists(session, 'T_テナント', 'ai_confidence_threshold'):
+            logger.info("T_テナントテーブルに ai_confidence_threshold カラムを追加中...")
+            
+            if db_type == 'postgresql':
+                session.execute(text("""
+                    ALTER TABLE "T_テナント" 
+                    ADD COLUMN ai_confidence_threshold INTEGER NULL
+                """))
+                session.execute(text("""
+                    COMMENT ON COLUMN "T_テナント".ai_confidence_threshold 
+                    IS 'OCR信頼度（0〜100）がこの値未満のときだけAI補正する。NULLは既定値'
+                """))
+            else:
+                session.execute(text("""
+                    ALTER TABLE `T_テナント` 
+                    ADD COLUMN `ai_confidence_threshold` INT NULL 
+                    COMMENT 'OCR信頼度（0〜100）がこの値未満のときだけAI補正する。NULLは既定値'
+                """))
+            
+            session.commit()
+            logger.info("✓ ai_confidence_threshold カラムを追加しました")
+        else:
+            logger.info("- ai_confidence_threshold カラムは既に存在します")
+        
+        # 13. T_証憑テーブルに 勘定科目 カラムを追加
+        if not column_exists(session, 'T_証憑', '勘定科目'):
+            logger.info("T_証憑テーブルに 勘定科目 カラムを追加中...")
+            
+            if db_type == 'postgresql':
+                session.execute(text("""
+                    ALTER TABLE "T_証憑" 
+                    ADD COLUMN 勘定科目 VARCHAR(50) NULL
+                """))
+                session.execute(text("""
+                    COMMENT ON COLUMN "T_証憑".勘定科目 
+                    IS '証憑処理でAIが推定した勘定科目（仕訳生成で使う）。NULLはキーワードで推定'
+                """))
+            else:
+                session.execute(text("""
+                    ALTER TABLE `T_証憑` 
+                    ADD COLUMN `勘定科目` VARCHAR(50) NULL 
+                    COMMENT '証憑処理でAIが推定した勘定科目（仕訳生成で使う）。NULLはキーワードで推定'
+                """))
+            
+            session.commit()
+            logger.info("✓ 勘定科目 カラムを追加しました")
+        else:
+            logger.info("- 勘定科目 カラムは既に存在します")
+        
         logger.info("✓ 自動マイグレーションが正常に完了しました")
         
     except Exception as e:
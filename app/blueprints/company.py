@@ -10,6 +10,7 @@ from datetime import datetime
 from ..utils import get_db, _sql
 from ..utils.decorators import require_roles
 from ..utils.nta_api import NTAInvoiceAPI, extract_invoice_number_from_text
+from ..utils.company_index import mark_company_index_stale
 
 bp = Blueprint('company', __name__, url_prefix='/company')
 
@@ -153,6 +154,7 @@ def register():
             conn.commit()
         
         conn.close()
+        mark_company_index_stale(tenant_id)
         
         flash('企業情報を登録しました', 'success')
         return redirect(url_for('company.index'))
@@ -241,6 +243,7 @@ def edit(company_id):
             conn.commit()
         
         conn.close()
+        mark_company_index_stale(tenant_id)
         
         flash('企業情報を更新しました', 'success')
         return redirect(url_for('company.detail', company_id=company_id))
@@ -267,6 +270,7 @@ def delete(company_id):
             conn.commit()
         
         conn.close()
+        mark_company_index_stale(tenant_id, rebuild=True)
         
         flash('企業情報を削除しました', 'success')
         
@@ -2,14 +2,60 @@ from flask import Blueprint, jsonify, current_app
 
 bp = Blueprint("health", __name__)
 
+
+def _load_worker_snapshots():
+    """ワーカーのスナップショット（読めなければ空。Web プロセスの値だけを返す）"""
+    from ..utils.worker_stats import load_worker_snapshots
+
+    try:
+        return load_worker_snapshots()
+    except Exception as e:
+        print(f"ワーカー統計の取得エラー: {e}")
+        return []
+
+
 @bp.get("/healthz")
 def healthz():
     """
     アプリケーションの状態を返します。
     ok=True のとき正常稼働です。
+    OCR・AI・国税庁検索などの集計値は、この Web プロセスと稼働中のワーカープロセスの合算です。
     """
+    from ..utils.db import get_pool_status, schema_bootstrap_stats
+    from ..utils.tesseract_pool import get_tesseract_pool_status
+    from ..utils.thumbnails import get_thumbnail_stats
+    from ..utils.memory import current_rss_mb, peak_rss_mb
+    from ..utils.worker_stats import STATS_SECTIONS, collect_process_stats, merge_stats
+
+    snapshots = _load_worker_snapshots()
+    merged = merge_stats([collect_process_stats()] + [s["stats"] for s in snapshots])
+
     return jsonify(
         ok=True,
         env=current_app.config.get("ENVIRONMENT"),
         version=current_app.config.get("VERSION"),
+        db_pool=get_pool_status(),
+        schema=schema_bootstrap_stats,
+        tesseract_pool=get_tesseract_pool_status(),
+        thumbnails=get_thumbnail_stats(),
+        memory={'rss_mb': current_rss_mb(), 'peak_rss_mb': peak_rss_mb()},
+        workers={
+            'reporting': len(snapshots),
+            'processes': [{k: s[k] for k in ('worker_key', 'pid', 'age_sec')} for s in snapshots],
+        },
+        **{section: merged.get(section) for section in STATS_SECTIONS},
     )
+
+
+@bp.get("/healthz/timings")
+def timings():
+    """
+    処理段階別のレイテンシヒストグラム（この Web プロセスと稼働中のワーカープロセスの合算）を返します。
+    """
+    from ..utils.timing import get_raw_histograms, get_timing_histograms, merge_histograms
+
+    snapshots = _load_worker_snapshots()
+    histograms = merge_histograms([get_raw_histograms()] + [s["timings"] for s in snapshots])
+    result = get_timing_histograms(histograms)
+    result['workers'] = len(snapshots)
+    return jsonify(result)
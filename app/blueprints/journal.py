@@ -109,7 +109,11 @@ def generate():
             # 証憑データを取得
             sql = _sql(conn, '''
                 SELECT 
-                    v.*,
+                    v.id,
+                    v.金額,
+                    v.日付,
+                    v.摘要,
+                    v.勘定科目,
                     c.id as company_id,
                     c.会社名
                 FROM "T_証憑" v
@@ -122,22 +126,19 @@ def generate():
             if not voucher:
                 continue
             
-            # 証憑データを辞書に変換
+            # 証憑データを辞書に変換（勘定科目は証憑処理でAIが推定したもの）
             voucher_data = {
-                'id': voucher[0] if isinstance(voucher, tuple) else voucher['id'],
-                '金額': voucher[3] if isinstance(voucher, tuple) else voucher['金額'],
-                '日付': voucher[4] if isinstance(voucher, tuple) else voucher['日付'],
-                '摘要': voucher[5] if isinstance(voucher, tuple) else voucher['摘要'],
+                'id': voucher[0],
+                '金額': voucher[1],
+                '日付': voucher[2],
+                '摘要': voucher[3],
+                '勘定科目': voucher[4],
             }
             
             # 企業情報
             company_data = None
-            if isinstance(voucher, tuple):
-                if len(voucher) > 14 and voucher[14]:
-                    company_data = {'会社名': voucher[15]}
-            else:
-                if voucher.get('company_id'):
-                    company_data = {'会社名': voucher['会社名']}
+            if voucher[5]:
+                company_data = {'会社名': voucher[6]}
             
             # 仕訳を生成
             journal_entry = generate_journal_entry(voucher_data, company_data)
@@ -227,6 +228,7 @@ def detail(journal_id):
         SELECT 
             j.*,
             c.会社名,
+            v.id as voucher_id,
             v.画像パス
         FROM "T_仕訳" j
         LEFT JOIN "T_企業情報" c ON j.企業情報ID = c.id
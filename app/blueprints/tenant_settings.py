@@ -7,6 +7,7 @@ AI設定を含む
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session
 from ..utils.db import get_db, _sql
 from ..utils.ai_helper import get_ai_model_info
+from ..utils.ocr_confidence import AI_CONFIDENCE_THRESHOLD
 
 bp = Blueprint('tenant_settings', __name__, url_prefix='/tenant/settings')
 
@@ -52,6 +53,15 @@ def index():
         anthropic_api_key = None
         google_vision_api_key = None
     
+    # AI補正のしきい値（カラムがまだ存在しない場合は既定値）
+    ai_confidence_threshold = None
+    try:
+        cur.execute(_sql(conn, 'SELECT ai_confidence_threshold FROM "T_テナント" WHERE id = %s'), (tenant_id,))
+        row = cur.fetchone()
+        ai_confidence_threshold = row[0] if row else None
+    except Exception:
+        conn.rollback() if hasattr(conn, 'rollback') else None
+    
     # AIモデル情報を取得
     models = [
         {
@@ -80,6 +90,8 @@ def index():
         google_api_key=google_api_key,
         anthropic_api_key=anthropic_api_key,
         google_vision_api_key=google_vision_api_key,
+        ai_confidence_threshold=ai_confidence_threshold,
+        default_ai_confidence_threshold=AI_CONFIDENCE_THRESHOLD,
     )
 
 
@@ -99,6 +111,16 @@ def update():
     anthropic_api_key = request.form.get('anthropic_api_key', '').strip() or None
     google_vision_api_key = request.form.get('google_vision_api_key', '').strip() or None
     
+    # AI補正のしきい値（空欄なら既定値を使う）
+    threshold_text = request.form.get('ai_confidence_threshold', '').strip()
+    ai_confidence_threshold = None
+    if threshold_text:
+        try:
+            ai_confidence_threshold = max(0, min(100, int(threshold_text)))
+        except ValueError:
+            flash('AI補正のしきい値は0〜100の整数で入力してください', 'error')
+            return redirect(url_for('tenant_settings.index'))
+    
     conn = get_db()
     cur = conn.cursor()
     
@@ -124,6 +146,21 @@ def update():
                 anthropic_api_key = %s
             WHERE id = %s
         '''), (ai_model, openai_api_key, google_api_key, anthropic_api_key, tenant_id))
+    # しきい値の更新に失敗して rollback してもAPIキーの更新が取り消されないよう先に確定する
+    if hasattr(conn, 'commit'):
+        conn.commit()
+    
+    try:
+        cur.execute(_sql(conn, '''
+            UPDATE "T_テナント" SET ai_confidence_threshold = %s WHERE id = %s
+        '''), (ai_confidence_threshold, tenant_id))
+    except Exception as e:
+        conn.rollback() if hasattr(conn, 'rollback') else None
+        print(f"AI補正しきい値の更新エラー: {e}")
+    
+    if hasattr(conn, 'commit'):
+        conn.commit()
+    conn.close()
     
     flash('AI設定を更新しました', 'success')
     return redirect(url_for('tenant_settings.index'))
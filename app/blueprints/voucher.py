@@ -4,28 +4,74 @@
 レシート・領収書のアップロード、OCR処理、一覧表示
 """
 
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify, abort, send_file
 from werkzeug.utils import secure_filename
 import os
 from datetime import datetime
 
 from ..utils import get_db, _sql
 from ..utils.decorators import require_roles
-from ..utils.ocr import process_receipt_image, save_uploaded_file
-from ..utils.nta_api import search_company_by_ocr_data
-from ..utils.nta_api_enhanced import enhanced_company_search
-from ..utils.ai_helper import get_ai_settings, correct_ocr_text, normalize_company_name_with_ai, select_best_company_from_candidates
+from ..utils.ocr import save_uploaded_file
+from ..utils.voucher_jobs import enqueue_voucher_job, get_voucher_job, job_to_status
+from ..utils.timing import span
+from ..utils.storage import sha256_from_path
+from ..utils.thumbnails import VARIANTS, DERIVATIVE_VERSION, get_derivative, remove_derivatives, schedule_derivatives
+from ..utils.duplicate_detection import check_upload_duplicates, remove_voucher_fingerprints
 
 bp = Blueprint('voucher', __name__, url_prefix='/voucher')
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf'}
 
+# 証憑画像のブラウザキャッシュ期間（保存パスは内容で決まり、同じパスの中身は変わらない）
+IMAGE_CACHE_MAX_AGE = int(os.environ.get('IMAGE_CACHE_MAX_AGE', str(365 * 24 * 3600)))
+
 
 def allowed_file(filename):
     """アップロード可能なファイル形式かチェック"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def _wants_json():
+    """XHR/fetch からのアップロードか（JSONで応答する）"""
+    return request.accept_mimetypes.best == 'application/json' or \
+        request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+
+
+def _describe_duplicates(matches):
+    """重複候補をレスポンス用に整形（登録は止めず、確認用の情報として返す）"""
+    described = []
+    for match in matches:
+        item = dict(match)
+        if match['voucher_id']:
+            item['voucher_url'] = url_for('voucher.detail', voucher_id=match['voucher_id'])
+            item['thumbnail_url'] = url_for('voucher.image', voucher_id=match['voucher_id'], variant='thumb')
+        else:
+            item['status_url'] = url_for('voucher.job_status', job_id=match['job_id'])
+        described.append(item)
+    return described
+
+
+def _remove_upload_if_unreferenced(conn, filepath):
+    """
+    保存ファイルを、どの証憑からも処理待ち・処理中のジョブからも参照されていなければ削除
+    （内容アドレス方式のため、同じファイルを他の証憑・他テナントのジョブが使っていることがある）
+    """
+    if not filepath:
+        return
+    cur = conn.cursor()
+    cur.execute(_sql(conn, 'SELECT COUNT(*) FROM "T_証憑" WHERE 画像パス = %s'), (filepath,))
+    if cur.fetchone()[0] > 0:
+        return
+    cur.execute(_sql(conn, '''
+        SELECT COUNT(*) FROM "T_証憑ジョブ" WHERE 画像パス = %s AND status IN ('queued', 'running')
+    '''), (filepath,))
+    if cur.fetchone()[0] > 0:
+        return
+    if os.path.exists(filepath):
+        os.remove(filepath)
+    remove_derivatives(filepath)
+
+
 @bp.route('/')
 @require_roles(['system_admin', 'tenant_admin', 'admin', 'employee'])
 def index():
@@ -49,7 +95,8 @@ def index():
             v.住所,
             v.ステータス,
             v.created_at,
-            u.name as uploaded_by_name
+            u.name as uploaded_by_name,
+            v.画像パス
         FROM "T_証憑" v
         LEFT JOIN "T_従業員" u ON v.uploaded_by = u.id
         WHERE v.tenant_id = %s
@@ -72,7 +119,7 @@ def index():
 def upload():
     """証憑アップロード"""
     if request.method == 'GET':
-        return render_template('voucher_upload.html')
+        return render_template('voucher_upload.html', job_id=request.args.get('job_id', type=int))
     
     tenant_id = session.get('tenant_id')
     user_id = session.get('user_id')
@@ -97,186 +144,114 @@ def upload():
         return redirect(request.url)
     
     try:
-        # ファイルを保存
-        filepath = save_uploaded_file(file)
-        
-        # AI設定を取得（OCR処理前に取得）
-        conn_temp = get_db()
-        cur_temp = conn_temp.cursor()
-        ai_settings = {'ai_model': 'gemini-1.5-flash'}  # デフォルト
-        api_keys = {}
-        google_vision_api_key = None
-        
-        try:
-            cur_temp.execute(_sql(conn_temp, '''
-                SELECT ai_model, openai_api_key, google_api_key, anthropic_api_key, google_vision_api_key
-                FROM "T_テナント" WHERE id = %s
-            '''), (tenant_id,))
-            tenant_settings = cur_temp.fetchone()
-            if tenant_settings:
-                ai_settings['ai_model'] = tenant_settings[0] or 'gemini-1.5-flash'
-                api_keys = {
-                    'openai_api_key': tenant_settings[1],
-                    'google_api_key': tenant_settings[2],
-                    'anthropic_api_key': tenant_settings[3],
-                }
-                google_vision_api_key = tenant_settings[4] if len(tenant_settings) > 4 else None
-        except Exception as e:
-            print(f"AI設定取得エラー: {e}")
-        finally:
-            conn_temp.close()
-        
-        # OCR処理（Google Cloud Vision APIキーがあれば使用）
-        ocr_result = process_receipt_image(filepath, google_vision_api_key=google_vision_api_key)
-        
-        # AIでOCR結果を補正
-        try:
-            if api_keys.get('google_api_key') or api_keys.get('openai_api_key'):
-                corrected_text = correct_ocr_text(
-                    ocr_result.get('full_text', ''),
-                    ai_settings['ai_model'],
-                    api_keys
-                )
-                # 補正後のテキストを再解析
-                from ..utils.ocr import extract_phone_numbers, extract_addresses, extract_company_name
-                ocr_result['phone_numbers'] = extract_phone_numbers(corrected_text)
-                ocr_result['addresses'] = extract_addresses(corrected_text)
-                ocr_result['company_name'] = extract_company_name(corrected_text)
-        except Exception as e:
-            print(f"AI補正エラー: {e}")
-        
-        # 電話番号と住所は最初の1件を使用
-        phone = ocr_result['phone_numbers'][0] if ocr_result['phone_numbers'] else None
-        address = ocr_result['addresses'][0] if ocr_result['addresses'] else None
-        company_name = ocr_result.get('company_name')
-        
-        # AIで会社名を正規化
-        if company_name and (api_keys.get('google_api_key') or api_keys.get('openai_api_key')):
-            try:
-                company_name = normalize_company_name_with_ai(
-                    company_name,
-                    ai_settings['ai_model'],
-                    api_keys
-                )
-            except Exception as e:
-                print(f"AI会社名正規化エラー: {e}")
-        
-        # 拡張検索フローを使用
-        search_result = enhanced_company_search(ocr_result)
-        
-        company_id = None
-        invoice_number = search_result.get('invoice_number')
-        corporate_number = search_result.get('corporate_number')
-        company_info = search_result.get('company_info')
-        
-        # 検証結果をチェック
-        if not search_result.get('verification_passed'):
-            flash(search_result.get('warning_message'), 'warning')
-        
-        if company_info:
-                
-                # 企業情報をデータベースに保存（既存の場合は更新）
-                conn = get_db()
-                cur = conn.cursor()
-                
-                # 既存の企業情報をチェック
-                check_sql = _sql(conn, '''
-                    SELECT id FROM "T_企業情報"
-                    WHERE 法人番号 = %s OR インボイス登録番号 = %s
-                ''')
-                cur.execute(check_sql, (corporate_number, invoice_number))
-                existing = cur.fetchone()
-                
-                if existing:
-                    company_id = existing[0] if isinstance(existing, tuple) else existing['id']
-                else:
-                    # 新規企業情報を登録
-                    insert_company_sql = _sql(conn, '''
-                        INSERT INTO "T_企業情報" (
-                            tenant_id,
-                            法人番号,
-                            インボイス登録番号,
-                            会社名,
-                            会社名カナ,
-                            郵便番号,
-                            住所,
-                            都道府県,
-                            市区町村,
-                            番地,
-                            インボイス登録有無,
-                            インボイス登録日,
-                            法人種別
-                        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    ''')
-                    
-                    cur.execute(insert_company_sql, (
-                        tenant_id,
-                        company_info.get('法人番号'),
-                        company_info.get('インボイス登録番号'),
-                        company_info.get('会社名'),
-                        company_info.get('会社名カナ'),
-                        company_info.get('郵便番号'),
-                        company_info.get('住所'),
-                        company_info.get('都道府県'),
-                        company_info.get('市区町村'),
-                        company_info.get('番地'),
-                        company_info.get('インボイス登録有無', 0),
-                        company_info.get('インボイス登録日'),
-                        company_info.get('法人種別')
-                    ))
-                    
-                    if hasattr(conn, 'commit'):
-                        conn.commit()
-                    
-                    # 挿入されたIDを取得
-                    company_id = cur.lastrowid
-                
-                conn.close()
-        
-        # データベースに証憑情報を保存
-        conn = get_db()
-        cur = conn.cursor()
-        
-        sql = _sql(conn, '''
-            INSERT INTO "T_証憑" (
-                tenant_id,
-                uploaded_by,
-                company_id,
-                画像パス,
-                OCR結果_生データ,
-                電話番号,
-                住所,
-                金額,
-                日付,
-                ステータス
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ''')
-        
-        cur.execute(sql, (
-            tenant_id,
-            user_id,
-            company_id,
-            filepath,
-            ocr_result['raw_text'],
-            phone,
-            address,
-            ocr_result['amount'],
-            ocr_result['date'],
-            'pending'
-        ))
-        
-        if hasattr(conn, 'commit'):
-            conn.commit()
-        
-        conn.close()
-        
-        flash('証憑をアップロードしました', 'success')
-        return redirect(url_for('voucher.index'))
-        
+        # ファイルを保存し、処理はワーカーに任せる
+        with span('upload.save'):
+            filepath = save_uploaded_file(file)
+
+        # 同じファイルが登録済みなら知らせる（登録は止めない）
+        with span('upload.dedupe'):
+            duplicates = check_upload_duplicates(tenant_id, filepath)
+
+        with span('upload.enqueue'):
+            job_id = enqueue_voucher_job(tenant_id, user_id, filepath, file.filename)
+        schedule_derivatives(filepath)
     except Exception as e:
+        if _wants_json():
+            return jsonify({'error': str(e)}), 500
         flash(f'エラーが発生しました: {str(e)}', 'error')
         return redirect(request.url)
 
+    if _wants_json():
+        return jsonify({
+            'job_id': job_id,
+            'status_url': url_for('voucher.job_status', job_id=job_id),
+            'duplicates': _describe_duplicates(duplicates),
+        }), 202
+
+    flash('証憑を受け付けました。OCR処理が完了するまでお待ちください', 'success')
+    if duplicates:
+        ids = ', '.join(f"#{d['voucher_id']}" if d['voucher_id'] else f"ジョブ#{d['job_id']}" for d in duplicates)
+        flash(f'同じファイルが登録済みです（{ids}）。不要な場合は処理後に削除してください', 'warning')
+    return redirect(url_for('voucher.upload', job_id=job_id))
+
+
+@bp.route('/upload/bulk', methods=['POST'])
+@require_roles(['system_admin', 'tenant_admin', 'admin', 'employee'])
+def upload_bulk():
+    """
+    証憑一括アップロード
+    ワーカーが同一テナントのジョブをまとめて取得し、Vision API のバッチOCRで処理する
+    """
+    tenant_id = session.get('tenant_id')
+    user_id = session.get('user_id')
+
+    if not tenant_id or not user_id:
+        flash('セッション情報が不正です', 'error')
+        return redirect(url_for('auth.index'))
+
+    files = [f for f in request.files.getlist('files') if f and f.filename]
+    if not files:
+        flash('ファイルが選択されていません', 'error')
+        return redirect(url_for('voucher.upload'))
+
+    jobs = []
+    skipped = []
+    duplicated = []
+    for file in files:
+        if not allowed_file(file.filename):
+            skipped.append(file.filename)
+            continue
+        try:
+            with span('upload.save'):
+                filepath = save_uploaded_file(file)
+            # ジョブ登録前に調べるので、同じ一括アップロード内の同じファイルも見つかる
+            with span('upload.dedupe'):
+                duplicates = check_upload_duplicates(tenant_id, filepath)
+            with span('upload.enqueue'):
+                job_id = enqueue_voucher_job(tenant_id, user_id, filepath, file.filename)
+            schedule_derivatives(filepath)
+            if duplicates:
+                duplicated.append({
+                    'job_id': job_id,
+                    'filename': file.filename,
+                    'duplicates': _describe_duplicates(duplicates),
+                })
+            jobs.append({
+                'job_id': job_id,
+                'filename': file.filename,
+                'status_url': url_for('voucher.job_status', job_id=job_id),
+            })
+        except Exception as e:
+            skipped.append(file.filename)
+            print(f"一括アップロードエラー: {file.filename}: {e}")
+
+    if _wants_json():
+        return jsonify({'jobs': jobs, 'skipped': skipped, 'duplicates': duplicated}), 202
+
+    if jobs:
+        flash(f'{len(jobs)}件の証憑を受け付けました。OCR処理はバックグラウンドで行います', 'success')
+    if duplicated:
+        flash(f'同じファイルが登録済みです（受け付けは済んでいます）: '
+              f'{", ".join(d["filename"] for d in duplicated)}', 'warning')
+    if skipped:
+        flash(f'受け付けられなかったファイル: {", ".join(skipped)}', 'warning')
+    return redirect(url_for('voucher.index'))
+
+
+@bp.route('/jobs/<int:job_id>')
+@require_roles(['system_admin', 'tenant_admin', 'admin', 'employee'])
+def job_status(job_id):
+    """証憑処理ジョブの進捗（アップロード画面からポーリング）"""
+    tenant_id = session.get('tenant_id')
+    job = get_voucher_job(job_id, tenant_id)
+    if not job:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+
+    status = job_to_status(job)
+    if job['voucher_id']:
+        status['voucher_url'] = url_for('voucher.detail', voucher_id=job['voucher_id'])
+    return jsonify(status)
+
 
 @bp.route('/<int:voucher_id>')
 @require_roles(['system_admin', 'tenant_admin', 'admin', 'employee'])
@@ -307,6 +282,52 @@ def detail(voucher_id):
     return render_template('voucher_detail.html', voucher=voucher)
 
 
+@bp.route('/<int:voucher_id>/image/<variant>')
+@require_roles(['system_admin', 'tenant_admin', 'admin', 'employee'])
+def image(voucher_id, variant):
+    """
+    証憑画像の配信
+    variant: 'thumb'（一覧用）/ 'preview'（詳細用）/ 'original'（元ファイル）
+    """
+    if variant != 'original' and variant not in VARIANTS:
+        abort(404)
+    tenant_id = session.get('tenant_id')
+
+    conn = get_db()
+    cur = conn.cursor()
+    sql = _sql(conn, 'SELECT 画像パス FROM "T_証憑" WHERE id = %s AND tenant_id = %s')
+    cur.execute(sql, (voucher_id, tenant_id))
+    row = cur.fetchone()
+    conn.close()
+
+    if not row:
+        abort(404)
+    filepath = row[0] if isinstance(row, tuple) else row['画像パス']
+    if not filepath or not os.path.exists(filepath):
+        abort(404)
+
+    if variant == 'original':
+        path, mimetype = filepath, None
+    else:
+        with span(f'image.{variant}'):
+            path = get_derivative(filepath, variant)
+        if not path:
+            abort(404)
+        mimetype = 'image/webp'
+
+    # 内容アドレスのパスならハッシュを ETag にする（それ以外は更新日時とサイズから生成）
+    sha256 = sha256_from_path(filepath)
+    etag = f'{sha256}-{variant}-{DERIVATIVE_VERSION}' if sha256 else True
+    response = send_file(os.path.abspath(path), mimetype=mimetype, etag=etag,
+                         conditional=True, max_age=IMAGE_CACHE_MAX_AGE)
+    # テナントの証憑なので共有キャッシュには置かせない
+    response.cache_control.public = False
+    response.cache_control.private = True
+    if sha256:
+        response.cache_control.immutable = True
+    return response
+
+
 @bp.route('/<int:voucher_id>/edit', methods=['GET', 'POST'])
 @require_roles(['system_admin', 'tenant_admin', 'admin'])
 def edit(voucher_id):
@@ -388,16 +409,16 @@ def delete(voucher_id):
         if row:
             filepath = row[0] if isinstance(row, tuple) else row['画像パス']
             
-            # データベースから削除
+            # データベースから削除（重複チェック用の行も削除する）
+            remove_voucher_fingerprints(conn, tenant_id, voucher_id)
             sql = _sql(conn, 'DELETE FROM "T_証憑" WHERE id = %s AND tenant_id = %s')
             cur.execute(sql, (voucher_id, tenant_id))
             
             if hasattr(conn, 'commit'):
                 conn.commit()
             
-            # ファイルを削除
-            if filepath and os.path.exists(filepath):
-                os.remove(filepath)
+            # ファイルを削除（同じ内容のファイルは共有されるため、他に参照が無い場合のみ）
+            _remove_upload_if_unreferenced(conn, filepath)
             
             flash('証憑を削除しました', 'success')
         else:
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+管理用コマンド（flask コマンド）
+
+    flask vouchers reprocess                       # 未確認の証憑を保存済みテキストから再抽出
+    flask vouchers reprocess --mode reocr --tenant 3 --workers 4
+    flask vouchers reprocess --all-statuses --dry-run
+
+    flask nta import-mirror 00_zenkoku_all_20240131.zip            # 法人番号の全件ファイル
+    flask nta import-mirror --source invoice e_diff_20240201.zip     # インボイスの差分ファイル
+"""
+
+import click
+from flask.cli import AppGroup
+
+
+vouchers_cli = AppGroup('vouchers', help='証憑の管理コマンド')
+
+
+@vouchers_cli.command('reprocess')
+@click.option('--mode', type=click.Choice(['extract', 'reocr']), default='extract', show_default=True,
+              help='extract: 保存済みOCRテキストから項目を再抽出 / reocr: 画像を再OCR')
+@click.option('--tenant', 'tenant_id', type=int, default=None, help='対象テナントID（省略時は全テナント）')
+@click.option('--all-statuses', is_flag=True, help='確認済みを含むすべての証憑を対象にする（既定は pending のみ）')
+@click.option('--batch-size', type=int, default=None, help='1バッチの件数（既定: REPROCESS_BATCH_SIZE）')
+@click.option('--workers', type=int, default=None, help='プロセス数（既定: CPUコア数）')
+@click.option('--checkpoint', 'checkpoint_path', default=None,
+              help='チェックポイントファイル（既定: reprocess_<mode>.checkpoint.json）')
+@click.option('--restart', is_flag=True, help='チェックポイントを無視して最初から処理する')
+@click.option('--limit', type=int, default=None, help='処理する最大件数')
+@click.option('--dry-run', is_flag=True, help='書き戻さずに更新対象の件数だけ数える')
+def reprocess(mode, tenant_id, all_statuses, batch_size, workers, checkpoint_path, restart, limit, dry_run):
+    """登録済みの証憑を再抽出・再OCRする"""
+    from .utils.voucher_reprocess import reprocess_vouchers
+
+    checkpoint_path = checkpoint_path or f'reprocess_{mode}.checkpoint.json'
+
+    def report(state):
+        click.echo(f"  ~id {state['last_id']}: 処理 {state['processed']:,}件 / 更新 {state['updated']:,}件 / "
+                   f"エラー {state['errors']:,}件  {state['rate'] or 0:,.1f}件/秒")
+
+    click.echo(f"再処理開始: mode={mode} tenant={tenant_id or '全テナント'} "
+               f"status={'すべて' if all_statuses else 'pending'}{' (dry-run)' if dry_run else ''}")
+    try:
+        result = reprocess_vouchers(
+            mode=mode,
+            tenant_id=tenant_id,
+            status=None if all_statuses else 'pending',
+            batch_size=batch_size,
+            workers=workers,
+            checkpoint_path=checkpoint_path,
+            restart=restart,
+            limit=limit,
+            dry_run=dry_run,
+            report=report,
+        )
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    click.echo(f"再処理{'完了' if result['completed'] else '中断（続きは同じコマンドで再開）'}: "
+               f"処理 {result['processed']:,}件 / 更新 {result['updated']:,}件 / エラー {result['errors']:,}件 "
+               f"（今回 {result['elapsed_sec']}秒、{result['rate'] or 0:,.1f}件/秒）")
+
+
+nta_cli = AppGroup('nta', help='国税庁データの管理コマンド')
+
+
+@nta_cli.command('import-mirror')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--source', type=click.Choice(['corporate', 'invoice']), default=None,
+              help='corporate: 法人番号 / invoice: インボイス（省略時はファイル名から推定）')
+@click.option('--encoding', default='utf-8-sig', show_default=True,
+              help='文字コード（Shift-JIS 版のファイルは cp932）')
+@click.option('--batch-size', type=int, default=None, help='まとめて書き込む件数（既定: NTA_MIRROR_BATCH_SIZE）')
+@click.option('--force', is_flag=True, help='取込済みのファイルも取り込み直す')
+def import_mirror(paths, source, encoding, batch_size, force):
+    """国税庁の一括ダウンロードファイル（全件・差分）をローカルミラーに取り込む（差分は日付順に指定）"""
+    from .utils.nta_mirror import import_file
+
+    def report(state):
+        click.echo(f"  {state['records']:,}件（更新 {state['upserted']:,} / 削除 {state['deleted']:,} / "
+                   f"登録終了 {state['ended']:,}）")
+
+    for path in paths:
+        click.echo(f"取込開始: {path}")
+        try:
+            result = import_file(path, source=source, encoding=encoding,
+                                 batch_size=batch_size, force=force, report=report)
+        except (ValueError, UnicodeDecodeError) as e:
+            raise click.ClickException(f"{path}: {e}")
+        if result['skipped']:
+            click.echo(f"取込済みのためスキップ: {result['file']}（--force で取り込み直す）")
+            continue
+        click.echo(f"取込完了: {result['file']} ({result['source']}) {result['records']:,}件 "
+                   f"{result['elapsed_sec']}秒")
@@ -9,6 +9,10 @@ class JsonFormatter(logging.Formatter):
             "message": record.getMessage(),
             "logger": record.name,
         }
+        # logger.info(..., extra={"fields": {...}}) の項目をそのまま出力する
+        fields = getattr(record, "fields", None)
+        if isinstance(fields, dict):
+            base.update(fields)
         if record.exc_info:
             base["exc_info"] = self.formatException(record.exc_info)
         return json.dumps(base, ensure_ascii=False)
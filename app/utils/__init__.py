@@ -3,7 +3,7 @@
 ユーティリティモジュール
 """
 
-from .db import get_db, get_db_connection, init_schema, _is_pg, _sql
+from .db import get_db, get_db_connection, init_schema, ensure_schema, _is_pg, _sql
 from .security import login_user, admin_exists, get_csrf, is_owner, can_manage_system_admins, is_tenant_owner, can_manage_tenant_admins
 from .decorators import require_roles, current_tenant_filter_sql, ROLES
 
@@ -11,6 +11,7 @@ __all__ = [
     'get_db',
     'get_db_connection',
     'init_schema',
+    'ensure_schema',
     '_is_pg',
     '_sql',
     'login_user',
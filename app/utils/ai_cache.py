@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+AI応答キャッシュ
+同じ入力（OCRテキスト・会社名など）で同じプロンプトを送る場合に、前回の応答を返して call_ai を省く
+
+- キー: テナント + 処理名 + プロンプトのバージョン + モデル + 正規化した入力のハッシュ
+  （テナントをまたいで応答を共有しない。テナントIDが無い呼び出しはAPIキーのハッシュで分ける）
+- 1段目: プロセス内 LRU（AI_CACHE_LRU_SIZE 件）
+- 2段目: T_AIキャッシュ テーブル（全プロセス共有）
+- AI_CACHE_TTL 秒で期限切れ。エラーになった呼び出しは保存しない
+- ヒットしたときは、保存時に計測した応答時間と get_ai_model_info の1件あたりの費用を「節約分」として集計する
+- ヒット件数（hit_count / last_hit_at）は読み取りのたびには書かず、プロセス内にためて
+  flush_ai_cache_hits でまとめて書く（ワーカーの定期処理から呼ぶ）。期限切れの削除も同じ定期処理で行う
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from .db import get_db, _sql
+
+
+AI_CACHE_ENABLED = os.environ.get('AI_CACHE_ENABLED', '1') in ('1', 'true', 'True')
+AI_CACHE_TTL = int(os.environ.get('AI_CACHE_TTL', str(30 * 24 * 3600)))
+AI_CACHE_LRU_SIZE = int(os.environ.get('AI_CACHE_LRU_SIZE', '512'))
+
+# ヒット/ミス集計（プロセス単位）
+_stats = {
+    'memory_hits': 0,
+    'db_hits': 0,
+    'misses': 0,
+    'stores': 0,
+    'errors': 0,
+    'saved_ms': 0.0,
+    'saved_yen': 0.0,
+}
+_stats_lock = threading.Lock()
+
+# キー → (期限のエポック秒, 応答, 保存時の応答時間ms)
+_lru: "OrderedDict[str, Tuple[float, str, float]]" = OrderedDict()
+_lru_lock = threading.Lock()
+
+# キー → まだ T_AIキャッシュ に書いていないヒット件数
+_pending_hits: Dict[str, int] = {}
+_pending_hits_lock = threading.Lock()
+
+
+def _count(name: str, value: float = 1) -> None:
+    with _stats_lock:
+        _stats[name] += value
+
+
+def _normalize_input(value: Any) -> str:
+    """全角半角・連続する空白の違いを吸収した入力（辞書・リストはJSONにして比較）"""
+    if not isinstance(value, str):
+        value = json.dumps(value, ensure_ascii=False, sort_keys=True, default=str)
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', value)).strip()
+
+
+def _scope(tenant_id: Optional[int], ai_model: str, api_keys: Dict[str, str]) -> str:
+    if tenant_id is not None:
+        return f't{tenant_id}'
+    api_key = api_keys.get('google_api_key' if ai_model.startswith('gemini') else 'openai_api_key') or ''
+    return 'k' + hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+
+def make_ai_cache_key(task: str, version: int, ai_model: str, inputs: Any,
+                      tenant_id: Optional[int], api_keys: Dict[str, str]) -> str:
+    """
+    キャッシュキー
+
+    Args:
+        task: 処理名（'correct_ocr_text' など）
+        version: プロンプトのバージョン（プロンプトを変えたら上げる）
+        ai_model: AIモデル名
+        inputs: プロンプトに埋め込む入力
+        tenant_id: テナントID
+        api_keys: APIキーの辞書（テナントIDが無いときの区別に使う）
+    """
+    digest = hashlib.sha256(_normalize_input(inputs).encode('utf-8')).hexdigest()
+    return f"{_scope(tenant_id, ai_model, api_keys)}:{task}:v{version}:{ai_model}:{digest}"
+
+
+def _lru_get(key: str) -> Optional[Tuple[float, str, float]]:
+    with _lru_lock:
+        entry = _lru.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del _lru[key]
+            return None
+        _lru.move_to_end(key)
+        return entry
+
+
+def _lru_put(key: str, expires_at: float, response: str, latency_ms: float) -> None:
+    if AI_CACHE_LRU_SIZE <= 0:
+        return
+    with _lru_lock:
+        _lru[key] = (expires_at, response, latency_ms)
+        _lru.move_to_end(key)
+        while len(_lru) > AI_CACHE_LRU_SIZE:
+            _lru.popitem(last=False)
+
+
+def _record_saving(ai_model: str, latency_ms: float) -> None:
+    from .ai_helper import get_ai_model_info
+
+    _count('saved_ms', latency_ms or 0.0)
+    _count('saved_yen', get_ai_model_info(ai_model).get('cost_per_transaction', 0.0))
+
+
+def _record_hit(key: str) -> None:
+    with _pending_hits_lock:
+        _pending_hits[key] = _pending_hits.get(key, 0) + 1
+
+
+def get_cached_response(key: str, ai_model: str) -> Optional[str]:
+    """
+    キャッシュからAI応答を取得
+
+    Returns:
+        保存済みの応答。無ければNone
+    """
+    if not AI_CACHE_ENABLED:
+        return None
+
+    entry = _lru_get(key)
+    if entry is not None:
+        _count('memory_hits')
+        _record_hit(key)
+        _record_saving(ai_model, entry[2])
+        return entry[1]
+
+    try:
+        conn = get_db()
+        try:
+            cur = conn.cursor()
+            cur.execute(_sql(conn, '''
+                SELECT response, expires_at, latency_ms FROM "T_AIキャッシュ"
+                WHERE cache_key = %s AND expires_at > %s
+            '''), (key, time.time()))
+            row = cur.fetchone()
+        finally:
+            conn.close()
+    except Exception as e:
+        _count('errors')
+        print(f"AIキャッシュ取得エラー: {e}")
+        return None
+
+    if not row:
+        _count('misses')
+        return None
+
+    response, expires_at, latency_ms = row[0], float(row[1]), float(row[2] or 0.0)
+    _lru_put(key, expires_at, response, latency_ms)
+    _count('db_hits')
+    _record_hit(key)
+    _record_saving(ai_model, latency_ms)
+    return response
+
+
+def store_response(key: str, task: str, ai_model: str, response: str, latency_ms: float,
+                   tenant_id: Optional[int] = None) -> None:
+    """
+    AI応答をキャッシュに保存（既存キーは上書き）
+
+    Args:
+        key: make_ai_cache_key の値
+        task: 処理名
+        ai_model: AIモデル名
+        response: AI応答テキスト
+        latency_ms: call_ai にかかった時間（ヒット時の節約分として集計する）
+        tenant_id: テナントID
+    """
+    if not AI_CACHE_ENABLED:
+        return
+
+    expires_at = time.time() + AI_CACHE_TTL
+    try:
+        conn = get_db()
+        try:
+            cur = conn.cursor()
+            cur.execute(_sql(conn, '''
+                INSERT INTO "T_AIキャッシュ" (cache_key, tenant_id, task, ai_model, response, latency_ms, expires_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (cache_key) DO UPDATE SET
+                    response = excluded.response,
+                    latency_ms = excluded.latency_ms,
+                    expires_at = excluded.expires_at,
+                    created_at = CURRENT_TIMESTAMP
+            '''), (key, tenant_id, task, ai_model, response, latency_ms, expires_at))
+            if hasattr(conn, 'commit'):
+                conn.commit()
+        finally:
+            conn.close()
+    except Exception as e:
+        _count('errors')
+        print(f"AIキャッシュ保存エラー: {e}")
+        return
+
+    _lru_put(key, expires_at, response, latency_ms)
+    _count('stores')
+
+
+def flush_ai_cache_hits() -> int:
+    """
+    ためておいたヒット件数を T_AIキャッシュ にまとめて書き、書いたキーの数を返す
+    書き込みに失敗した分は次回に持ち越す
+    """
+    with _pending_hits_lock:
+        pending = dict(_pending_hits)
+        _pending_hits.clear()
+    if not pending:
+        return 0
+    try:
+        conn = get_db()
+        try:
+            cur = conn.cursor()
+            cur.executemany(_sql(conn, '''
+                UPDATE "T_AIキャッシュ"
+                SET hit_count = hit_count + %s, last_hit_at = CURRENT_TIMESTAMP
+                WHERE cache_key = %s
+            '''), [(hits, key) for key, hits in pending.items()])
+            if hasattr(conn, 'commit'):
+                conn.commit()
+        finally:
+            conn.close()
+    except Exception:
+        with _pending_hits_lock:
+            for key, hits in pending.items():
+                _pending_hits[key] = _pending_hits.get(key, 0) + hits
+        raise
+    return len(pending)
+
+
+def purge_expired_ai_cache() -> int:
+    """期限切れのエントリを削除し、削除件数を返す"""
+    conn = get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute(_sql(conn, 'DELETE FROM "T_AIキャッシュ" WHERE expires_at <= %s'), (time.time(),))
+        deleted = cur.rowcount
+        if hasattr(conn, 'commit'):
+            conn.commit()
+    finally:
+        conn.close()
+    return deleted
+
+
+def get_ai_cache_stats() -> Dict:
+    """キャッシュのヒット率と、省いたAI呼び出しの応答時間・費用の合計"""
+    with _stats_lock:
+        stats = dict(_stats)
+    hits = stats['memory_hits'] + stats['db_hits']
+    lookups = hits + stats['misses']
+    stats['hit_ratio'] = round(hits / lookups, 3) if lookups else None
+    stats['saved_ms'] = round(stats['saved_ms'], 1)
+    stats['saved_yen'] = round(stats['saved_yen'], 2)
+    stats['lru_entries'] = len(_lru)
+    stats['lru_capacity'] = AI_CACHE_LRU_SIZE
+    stats['pending_hit_keys'] = len(_pending_hits)
+    stats['ttl'] = AI_CACHE_TTL
+    return stats
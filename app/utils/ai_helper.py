@@ -4,10 +4,81 @@ AI統合ヘルパー
 Gemini 1.5 Flash、GPT-4o-mini、GPT-4oの3モデルに対応
 """
 
+import json
 import os
-from typing import Dict, Optional, List
+import re
+import threading
+import time
+from typing import Callable, Dict, Optional, List
 from sqlalchemy.orm import Session
 
+from .ai_cache import get_cached_response, make_ai_cache_key, store_response
+from .timing import timed
+
+
+# 証憑1件のAI処理（OCR補正・会社名正規化・勘定科目推定）を1回の呼び出しにまとめる
+AI_COMBINED_EXTRACTION = os.environ.get('AI_COMBINED_EXTRACTION', '1') in ('1', 'true', 'True')
+
+# プロンプトのバージョン（プロンプトを変えたら上げる。古い応答はAIキャッシュから使われなくなる）
+PROMPT_VERSIONS = {
+    'correct_ocr_text': 1,
+    'estimate_account_subject': 1,
+    'normalize_company_name': 1,
+    'extract_voucher': 1,
+}
+
+# 勘定科目と判断の目安（まとめて抽出するときの選択肢）
+ACCOUNT_SUBJECTS = {
+    '旅費交通費': '電車、バス、タクシー、新幹線、飛行機、ガソリン、駐車場など',
+    '通信費': '携帯電話、インターネット、郵便、宅配便など',
+    '消耗品費': '文房具、事務用品、日用品など',
+    '水道光熱費': '電気、ガス、水道など',
+    '地代家賃': '家賃、駐車場代、倉庫代など',
+    '広告宣伝費': '広告、SNS広告、チラシなど',
+    '接待交際費': '飲食、贈答、ゴルフなど',
+    '会議費': '会議室、飲食（少人数）など',
+    '福利厚生費': '社員の慰安、健康診断など',
+    '研修費': 'セミナー、書籍、eラーニングなど',
+    '支払手数料': '振込手数料、各種手数料など',
+    '租税公課': '印紙、自動車税、固定資産税など',
+    '修繕費': '修理、メンテナンスなど',
+    '保険料': '損害保険、自動車保険など',
+    '雑費': 'その他',
+}
+
+# extract_voucher_with_ai の応答スキーマ（OpenAI の strict モードに合わせ、全項目必須・null 可で書く）
+VOUCHER_EXTRACTION_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'company_name': {'type': ['string', 'null']},
+        'normalized_company_name': {'type': ['string', 'null']},
+        'phone_numbers': {'type': 'array', 'items': {'type': 'string'}},
+        'addresses': {'type': 'array', 'items': {'type': 'string'}},
+        'invoice_number': {'type': ['string', 'null']},
+        'date': {'type': ['string', 'null']},
+        'amount': {'type': ['number', 'null']},
+        'account_subject': {'type': 'string', 'enum': list(ACCOUNT_SUBJECTS)},
+        'description': {'type': 'string'},
+    },
+    'required': [
+        'company_name', 'normalized_company_name', 'phone_numbers', 'addresses',
+        'invoice_number', 'date', 'amount', 'account_subject', 'description',
+    ],
+    'additionalProperties': False,
+}
+
+_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+_INVOICE_RE = re.compile(r'^T\d{13}$')
+
+# まとめて抽出した件数・再試行・失敗（プロセス単位）
+_stats = {'combined_calls': 0, 'retries': 0, 'failures': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(key: str) -> None:
+    with _stats_lock:
+        _stats[key] += 1
+
 
 def get_ai_settings(db: Session, tenant_id: int) -> Dict[str, str]:
     """
@@ -40,7 +111,13 @@ def get_ai_settings(db: Session, tenant_id: int) -> Dict[str, str]:
     }
 
 
-def call_ai(prompt: str, ai_model: str, api_keys: Dict[str, str]) -> str:
+@timed('ai.call_ai')
+def call_ai(
+    prompt: str,
+    ai_model: str,
+    api_keys: Dict[str, str],
+    response_schema: Optional[Dict] = None
+) -> str:
     """
     AIモデルを呼び出してテキスト生成
     
@@ -48,27 +125,88 @@ def call_ai(prompt: str, ai_model: str, api_keys: Dict[str, str]) -> str:
         prompt: プロンプト
         ai_model: AIモデル名（'gemini-1.5-flash', 'gpt-4o-mini', 'gpt-4o'）
         api_keys: APIキーの辞書
+        response_schema: 応答をJSONに制約する場合のJSON Schema
     
     Returns:
         AI応答テキスト
     """
     if ai_model == 'gemini-1.5-flash':
-        return call_gemini(prompt, api_keys.get('google_api_key'))
+        return call_gemini(prompt, api_keys.get('google_api_key'), response_schema)
     elif ai_model == 'gpt-4o-mini':
-        return call_openai(prompt, 'gpt-4o-mini', api_keys.get('openai_api_key'))
+        return call_openai(prompt, 'gpt-4o-mini', api_keys.get('openai_api_key'), response_schema)
     elif ai_model == 'gpt-4o':
-        return call_openai(prompt, 'gpt-4o', api_keys.get('openai_api_key'))
+        return call_openai(prompt, 'gpt-4o', api_keys.get('openai_api_key'), response_schema)
     else:
         raise ValueError(f"サポートされていないAIモデル: {ai_model}")
 
 
-def call_gemini(prompt: str, api_key: Optional[str]) -> str:
+def _call_ai_cached(
+    task: str,
+    inputs,
+    prompt: str,
+    ai_model: str,
+    api_keys: Dict[str, str],
+    tenant_id: Optional[int] = None,
+    validate: Optional[Callable[[str], bool]] = None,
+    response_schema: Optional[Dict] = None
+) -> str:
+    """
+    同じ入力の応答がAIキャッシュにあればそれを返し、無ければ call_ai を呼んで保存する
+    
+    Args:
+        task: 処理名（PROMPT_VERSIONS のキー）
+        inputs: プロンプトに埋め込んだ入力（キャッシュキーに使う）
+        prompt: プロンプト
+        ai_model: AIモデル名
+        api_keys: APIキーの辞書
+        tenant_id: テナントID（テナントごとにキャッシュを分ける）
+        validate: 応答を保存してよいか判定する関数（使えない応答を保存しない）
+        response_schema: 応答をJSONに制約する場合のJSON Schema
+    
+    Returns:
+        AI応答テキスト
+    """
+    key = make_ai_cache_key(task, PROMPT_VERSIONS[task], ai_model, inputs, tenant_id, api_keys)
+    cached = get_cached_response(key, ai_model)
+    if cached is not None:
+        return cached
+    
+    started = time.perf_counter()
+    response = call_ai(prompt, ai_model, api_keys, response_schema)
+    latency_ms = (time.perf_counter() - started) * 1000
+    if response and (validate is None or validate(response)):
+        store_response(key, task, ai_model, response, latency_ms, tenant_id)
+    return response
+
+
+def _gemini_schema(schema: Dict):
+    """JSON Schema（型に 'null' を含めた書き方）を Gemini の Schema に変換"""
+    from google.ai import generativelanguage as glm
+    
+    types = schema['type'] if isinstance(schema['type'], list) else [schema['type']]
+    kwargs = {
+        'type_': getattr(glm.Type, next(t for t in types if t != 'null').upper()),
+        'nullable': 'null' in types,
+    }
+    if 'enum' in schema:
+        kwargs['format_'] = 'enum'
+        kwargs['enum'] = [value for value in schema['enum'] if value is not None]
+    if 'properties' in schema:
+        kwargs['properties'] = {name: _gemini_schema(prop) for name, prop in schema['properties'].items()}
+        kwargs['required'] = schema.get('required', [])
+    if 'items' in schema:
+        kwargs['items'] = _gemini_schema(schema['items'])
+    return glm.Schema(**kwargs)
+
+
+def call_gemini(prompt: str, api_key: Optional[str], response_schema: Optional[Dict] = None) -> str:
     """
     Google Gemini APIを呼び出し
     
     Args:
         prompt: プロンプト
         api_key: Google API Key
+        response_schema: 応答をJSONに制約する場合のJSON Schema
     
     Returns:
         AI応答テキスト
@@ -76,16 +214,31 @@ def call_gemini(prompt: str, api_key: Optional[str]) -> str:
     if not api_key:
         raise ValueError("Google API Keyが設定されていません")
     
-    import google.generativeai as genai
-    
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel('gemini-1.5-flash')
-    
-    response = model.generate_content(prompt)
-    return response.text
+    from google.ai import generativelanguage as glm
+    from .http_clients import AI_READ_TIMEOUT, get_gemini_client
+    
+    # genai.configure はプロセス全体の設定を書き換えるため、キーごとのクライアントを使う
+    client = get_gemini_client(api_key)
+    generation_config = None
+    if response_schema:
+        generation_config = glm.GenerationConfig(
+            response_mime_type='application/json',
+            response_schema=_gemini_schema(response_schema),
+        )
+    response = client.generate_content(
+        request=glm.GenerateContentRequest(
+            model='models/gemini-1.5-flash',
+            contents=[glm.Content(role='user', parts=[glm.Part(text=prompt)])],
+            generation_config=generation_config,
+        ),
+        timeout=AI_READ_TIMEOUT,
+    )
+    if not response.candidates:
+        raise ValueError("Gemini APIの応答が空でした")
+    return ''.join(part.text for part in response.candidates[0].content.parts)
 
 
-def call_openai(prompt: str, model: str, api_key: Optional[str]) -> str:
+def call_openai(prompt: str, model: str, api_key: Optional[str], response_schema: Optional[Dict] = None) -> str:
     """
     OpenAI APIを呼び出し
     
@@ -93,6 +246,7 @@ def call_openai(prompt: str, model: str, api_key: Optional[str]) -> str:
         prompt: プロンプト
         model: モデル名（'gpt-4o-mini' or 'gpt-4o'）
         api_key: OpenAI API Key
+        response_schema: 応答をJSONに制約する場合のJSON Schema（Structured Outputs の strict モード）
     
     Returns:
         AI応答テキスト
@@ -100,10 +254,16 @@ def call_openai(prompt: str, model: str, api_key: Optional[str]) -> str:
     if not api_key:
         raise ValueError("OpenAI API Keyが設定されていません")
     
-    from openai import OpenAI
+    from .http_clients import get_openai_client
     
-    client = OpenAI(api_key=api_key)
+    client = get_openai_client(api_key)
     
+    options = {}
+    if response_schema:
+        options['response_format'] = {
+            'type': 'json_schema',
+            'json_schema': {'name': 'response', 'strict': True, 'schema': response_schema},
+        }
     response = client.chat.completions.create(
         model=model,
         messages=[
@@ -111,19 +271,27 @@ def call_openai(prompt: str, model: str, api_key: Optional[str]) -> str:
             {"role": "user", "content": prompt}
         ],
         temperature=0.3,
+        **options,
     )
     
     return response.choices[0].message.content
 
 
-def correct_ocr_text(ocr_text: str, ai_model: str, api_keys: Dict[str, str]) -> str:
+@timed('ai.correct_ocr_text')
+def correct_ocr_text(
+    ocr_text: str,
+    ai_model: str,
+    api_keys: Dict[str, str],
+    tenant_id: Optional[int] = None
+) -> str:
     """
-    OCR結果をAIで補正
+    OCR結果をAIで補正（同じテキストの補正結果はAIキャッシュから返す）
     
     Args:
         ocr_text: OCRで抽出されたテキスト
         ai_model: 使用するAIモデル
         api_keys: APIキーの辞書
+        tenant_id: テナントID
     
     Returns:
         補正されたテキスト
@@ -147,21 +315,23 @@ OCRの誤認識を修正し、正確なテキストに補正してください
 """
     
     try:
-        return call_ai(prompt, ai_model, api_keys)
+        return _call_ai_cached('correct_ocr_text', ocr_text, prompt, ai_model, api_keys, tenant_id)
     except Exception as e:
         print(f"AI補正エラー: {e}")
         return ocr_text  # エラー時は元のテキストを返す
 
 
+@timed('ai.estimate_account_subject_with_ai')
 def estimate_account_subject_with_ai(
     ocr_text: str,
     company_name: Optional[str],
     amount: Optional[float],
     ai_model: str,
-    api_keys: Dict[str, str]
+    api_keys: Dict[str, str],
+    tenant_id: Optional[int] = None
 ) -> Dict[str, str]:
     """
-    AIを使用して勘定科目を推定
+    AIを使用して勘定科目を推定（同じ内容の推定結果はAIキャッシュから返す）
     
     Args:
         ocr_text: OCRで抽出されたテキスト
@@ -169,6 +339,7 @@ def estimate_account_subject_with_ai(
         amount: 金額
         ai_model: 使用するAIモデル
         api_keys: APIキーの辞書
+        tenant_id: テナントID
     
     Returns:
         推定結果の辞書（勘定科目、摘要）
@@ -210,24 +381,16 @@ JSONのみを出力し、説明は不要です。
 """
     
     try:
-        response = call_ai(prompt, ai_model, api_keys)
-        
-        # JSON部分を抽出
-        import json
-        import re
-        
-        # JSONブロックを抽出（```json ... ``` または { ... }）
-        json_match = re.search(r'```json\s*(\{.*?\})\s*```', response, re.DOTALL)
-        if json_match:
-            json_str = json_match.group(1)
-        else:
-            json_match = re.search(r'\{.*?\}', response, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(0)
-            else:
-                json_str = response
-        
-        result = json.loads(json_str)
+        response = _call_ai_cached(
+            'estimate_account_subject',
+            [ocr_text, company_name, amount],
+            prompt,
+            ai_model,
+            api_keys,
+            tenant_id,
+            validate=_is_json_response,
+        )
+        result = _parse_json_response(response)
         return {
             'account_subject': result.get('account_subject', '雑費'),
             'description': result.get('description', ''),
@@ -240,18 +403,44 @@ JSONのみを出力し、説明は不要です。
         }
 
 
+def _parse_json_response(response: str) -> Dict:
+    """AI応答からJSON部分を取り出して読み込む"""
+    # JSONブロックを抽出（```json ... ``` または { ... }）
+    json_match = re.search(r'```json\s*(\{.*?\})\s*```', response, re.DOTALL)
+    if json_match:
+        json_str = json_match.group(1)
+    else:
+        json_match = re.search(r'\{.*?\}', response, re.DOTALL)
+        if json_match:
+            json_str = json_match.group(0)
+        else:
+            json_str = response
+    
+    return json.loads(json_str)
+
+
+def _is_json_response(response: str) -> bool:
+    try:
+        return isinstance(_parse_json_response(response), dict)
+    except ValueError:
+        return False
+
+
+@timed('ai.normalize_company_name_with_ai')
 def normalize_company_name_with_ai(
     company_name: str,
     ai_model: str,
-    api_keys: Dict[str, str]
+    api_keys: Dict[str, str],
+    tenant_id: Optional[int] = None
 ) -> str:
     """
-    AIを使用して会社名を正規化
+    AIを使用して会社名を正規化（同じ会社名の正規化結果はAIキャッシュから返す）
     
     Args:
         company_name: 会社名
         ai_model: 使用するAIモデル
         api_keys: APIキーの辞書
+        tenant_id: テナントID
     
     Returns:
         正規化された会社名
@@ -273,12 +462,149 @@ def normalize_company_name_with_ai(
 """
     
     try:
-        return call_ai(prompt, ai_model, api_keys).strip()
+        return _call_ai_cached(
+            'normalize_company_name', company_name, prompt, ai_model, api_keys, tenant_id,
+            validate=lambda response: bool(response.strip()),
+        ).strip()
     except Exception as e:
         print(f"AI会社名正規化エラー: {e}")
         return company_name
 
 
+def parse_voucher_extraction(response: str) -> Dict:
+    """
+    extract_voucher_with_ai の応答を VOUCHER_EXTRACTION_SCHEMA どおりか確かめて読み込む
+    
+    応答全体がJSONでなければ、前後の説明文やコードブロックから取り出すことはせずエラーにする
+    
+    Args:
+        response: AI応答テキスト
+    
+    Returns:
+        抽出結果の辞書
+    
+    Raises:
+        ValueError: JSONでない、項目が足りない・多い、型や値の形式が違う
+    """
+    data = json.loads(response)
+    if not isinstance(data, dict):
+        raise ValueError("応答がJSONオブジェクトではありません")
+    expected = set(VOUCHER_EXTRACTION_SCHEMA['required'])
+    if set(data) != expected:
+        raise ValueError(f"項目が一致しません: 不足 {sorted(expected - set(data))} / 余分 {sorted(set(data) - expected)}")
+    
+    for key in ('company_name', 'normalized_company_name', 'invoice_number', 'date'):
+        if data[key] is not None and not isinstance(data[key], str):
+            raise ValueError(f"{key} が文字列ではありません")
+        if isinstance(data[key], str):
+            data[key] = data[key].strip() or None
+    for key in ('phone_numbers', 'addresses'):
+        if not isinstance(data[key], list) or not all(isinstance(v, str) for v in data[key]):
+            raise ValueError(f"{key} が文字列の配列ではありません")
+        data[key] = [v.strip() for v in data[key] if v.strip()]
+    if data['amount'] is not None and (isinstance(data['amount'], bool) or not isinstance(data['amount'], (int, float))):
+        raise ValueError("amount が数値ではありません")
+    if data['date'] is not None and not _DATE_RE.match(data['date']):
+        raise ValueError(f"date の形式が不正です: {data['date']}")
+    if data['invoice_number'] is not None:
+        data['invoice_number'] = data['invoice_number'].upper().replace('-', '').replace(' ', '')
+        if not _INVOICE_RE.match(data['invoice_number']):
+            raise ValueError(f"invoice_number の形式が不正です: {data['invoice_number']}")
+    if data['account_subject'] not in ACCOUNT_SUBJECTS:
+        raise ValueError(f"account_subject が選択肢にありません: {data['account_subject']}")
+    if not isinstance(data['description'], str):
+        raise ValueError("description が文字列ではありません")
+    return data
+
+
+def _is_voucher_extraction(response: str) -> bool:
+    try:
+        parse_voucher_extraction(response)
+        return True
+    except ValueError:
+        return False
+
+
+@timed('ai.extract_voucher_with_ai')
+def extract_voucher_with_ai(
+    ocr_text: str,
+    ai_model: str,
+    api_keys: Dict[str, str],
+    tenant_id: Optional[int] = None
+) -> Optional[Dict]:
+    """
+    1回のAI呼び出しで、OCR補正・会社名正規化・勘定科目推定をまとめて行う
+    
+    correct_ocr_text → normalize_company_name_with_ai → estimate_account_subject_with_ai と
+    3回OCRテキストを送る代わりに、応答をJSON Schemaで制約して必要な項目だけを返させる。
+    応答が VOUCHER_EXTRACTION_SCHEMA どおりでなければ、理由を添えて1回だけ再試行する。
+    
+    Args:
+        ocr_text: OCRで抽出されたテキスト
+        ai_model: 使用するAIモデル
+        api_keys: APIキーの辞書
+        tenant_id: テナントID
+    
+    Returns:
+        {'company_name', 'normalized_company_name', 'phone_numbers', 'addresses', 'invoice_number',
+         'date', 'amount', 'account_subject', 'description'}。失敗した場合はNone
+    """
+    subjects = "\n".join(f"- {name}（{examples}）" for name, examples in ACCOUNT_SUBJECTS.items())
+    prompt = f"""
+以下はレシート・領収書からOCRで抽出されたテキストです。
+OCRの誤認識（「林式会社」→「株式会社」、0とO、1とl など）を補正したうえで、次の項目を抽出してください。
+
+- company_name: 発行元の会社名（レシートの表記のまま。㈱・(株)は株式会社に）
+- normalized_company_name: 会社名の正式名称（略称を正式名称に、前株・後株を正しい位置に、表記ゆれを統一）
+- phone_numbers: 電話番号（ハイフン区切り）
+- addresses: 住所
+- invoice_number: インボイス登録番号（T + 13桁）
+- date: 日付（YYYY-MM-DD）
+- amount: 合計金額（円、数値）
+- account_subject: 勘定科目（下の一覧から1つ）
+- description: 仕訳の摘要（具体的な内容を短く）
+
+読み取れない項目は null（配列は空）にしてください。
+
+【勘定科目】
+{subjects}
+
+【OCRテキスト】
+{ocr_text}
+"""
+    
+    _count('combined_calls')
+    error = None
+    for attempt in range(2):
+        retry_note = ''
+        if error:
+            _count('retries')
+            retry_note = f"\n【注意】前回の応答は形式が不正でした（{error}）。指定の項目だけを持つJSONのみを出力してください。\n"
+        try:
+            response = _call_ai_cached(
+                'extract_voucher',
+                ocr_text,
+                prompt + retry_note,
+                ai_model,
+                api_keys,
+                tenant_id,
+                validate=_is_voucher_extraction,
+                response_schema=VOUCHER_EXTRACTION_SCHEMA,
+            )
+        except Exception as e:
+            print(f"AI一括抽出エラー: {e}")
+            break
+        try:
+            return parse_voucher_extraction(response)
+        except ValueError as e:
+            error = str(e)[:200]
+            print(f"AI一括抽出の応答が不正です（{attempt + 1}回目）: {error}")
+    
+    _count('failures')
+    return None
+
+
+@timed('ai.select_best_company_from_candidates')
 def select_best_company_from_candidates(
     candidates: List[Dict],
     ocr_address: Optional[str],
@@ -326,7 +652,6 @@ def select_best_company_from_candidates(
     try:
         response = call_ai(prompt, ai_model, api_keys).strip()
         # 数字のみを抽出
-        import re
         match = re.search(r'\d+', response)
         if match:
             index = int(match.group(0)) - 1
@@ -339,6 +664,14 @@ def select_best_company_from_candidates(
     return candidates[0]
 
 
+def get_ai_extraction_stats() -> Dict:
+    """一括抽出の呼び出し回数・再試行回数・失敗件数"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['enabled'] = AI_COMBINED_EXTRACTION
+    return stats
+
+
 def get_ai_model_info(model_name: str) -> Dict[str, any]:
     """
     AIモデルの情報を取得
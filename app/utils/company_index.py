@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+テナントの企業情報（T_企業情報）のあいまい会社名検索
+OCRで読み取った会社名を国税庁の /4/name に送る前に、登録済みの取引先から探す
+
+- テナントごとに、会社名の文字2-gram の転置インデックスをプロセス内に持つ
+- 類似度は 2-gram 集合のコサイン類似度（|A∩B| / √(|A|·|B|)）で、COMPANY_INDEX_MIN_SCORE 以上を候補とする
+- 短い名前は1文字違いでも類似度が高く出る（山田商会 と 山田商事株式会社 で0.6）ため、
+  法人格を除いた名前の編集距離が長い方の文字数 × COMPANY_INDEX_MAX_EDIT_RATIO 以下のものだけを一致とする
+  （6文字以下なら完全一致のみ、7〜13文字なら1文字違いまで）
+- 類似度が COMPANY_INDEX_TRUST_SCORE 以上の一致だけは国税庁APIを呼ばずにそのまま使い、
+  それ未満の一致は国税庁APIの検索結果と突き合わせる候補として使う（nta_api_enhanced）
+- 比較の前に法人格（株式会社・有限会社など、「林式会社」のようなOCRの誤読も含む）を取り除き、
+  OCRで取り違えやすい文字（口/ロ、工/エ など）を同じ文字にそろえる
+- 登録・編集は 最終更新日 / created_at の差分だけを読み込んで反映する（COMPANY_INDEX_REFRESH 秒ごとに確認）
+  件数が減っていたら（削除）作り直す。このプロセスでの登録・編集・削除は mark_company_index_stale で即時に反映する
+"""
+
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+from .db import get_db, _sql
+
+
+COMPANY_INDEX_ENABLED = os.environ.get('COMPANY_INDEX_ENABLED', '1') in ('1', 'true', 'True')
+COMPANY_INDEX_MIN_SCORE = float(os.environ.get('COMPANY_INDEX_MIN_SCORE', '0.6'))
+COMPANY_INDEX_MAX_EDIT_RATIO = float(os.environ.get('COMPANY_INDEX_MAX_EDIT_RATIO', '0.15'))
+COMPANY_INDEX_TRUST_SCORE = float(os.environ.get('COMPANY_INDEX_TRUST_SCORE', '0.95'))
+COMPANY_INDEX_REFRESH = float(os.environ.get('COMPANY_INDEX_REFRESH', '30'))
+COMPANY_INDEX_MAX_TENANTS = int(os.environ.get('COMPANY_INDEX_MAX_TENANTS', '200'))
+
+# 法人格（OCRで「株」を「林」「抹」と読み違えたものを含む）
+_LEGAL_FORMS = re.compile(
+    r'[株林抹侏][式武弍]会社|有限会社|合同会社|合資会社|合名会社'
+    r'|(?:一般|公益)?(?:社団|財団)法人|医療法人(?:社団|財団)?|学校法人|宗教法人|社会福祉法人'
+    r'|特定非営利活動法人|npo法人'
+)
+_ABBREVIATIONS = {'(株)': '株式会社', '(有)': '有限会社', '(合)': '合同会社', '(資)': '合資会社', '(名)': '合名会社'}
+# OCRで取り違えやすい文字（索引側と検索側の両方に同じ変換をかける）
+_CONFUSABLES = str.maketrans({
+    '口': 'ロ', '工': 'エ', '力': 'カ', '二': 'ニ', '一': 'ー', '夕': 'タ', '卜': 'ト',
+    '八': 'ハ', 'へ': 'ヘ', 'べ': 'ベ', 'ぺ': 'ペ', '-': 'ー', '―': 'ー', '‐': 'ー',
+})
+_PUNCTUATION = re.compile(r'[\s・.,、。\'"()（）「」]')
+
+_COLUMNS = ('id', '会社名', '法人番号', 'インボイス登録番号', '都道府県')
+
+
+def normalize_for_match(name: str) -> str:
+    """照合用に会社名を正規化（法人格の除去・表記ゆれと取り違えやすい文字の統一）"""
+    text = unicodedata.normalize('NFKC', name or '').lower()
+    for abbreviation, full in _ABBREVIATIONS.items():
+        text = text.replace(abbreviation, full)
+    core = _LEGAL_FORMS.sub('', text)
+    # 法人格だけの名前は法人格ごと比較する
+    text = core if _PUNCTUATION.sub('', core) else text
+    return _PUNCTUATION.sub('', text).translate(_CONFUSABLES)
+
+
+def _within_edits(a: str, b: str, limit: int) -> bool:
+    """編集距離（挿入・削除・置換）が limit 以下か"""
+    if abs(len(a) - len(b)) > limit:
+        return False
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return False
+        previous = current
+    return previous[-1] <= limit
+
+
+def _grams(normalized: str) -> Set[str]:
+    """先頭・末尾の印を付けた文字2-gram（1文字の名前でも2つできる）"""
+    padded = f'^{normalized}$'
+    return {padded[i:i + 2] for i in range(len(padded) - 1)}
+
+
+class _TenantIndex:
+    """1テナント分の転置インデックス"""
+
+    def __init__(self):
+        self.entries: Dict[int, Dict] = {}
+        self.postings: Dict[str, Set[int]] = {}
+        self.watermark = None
+        self.count = 0
+        self.next_check = 0.0
+        self.lock = threading.Lock()
+
+    def upsert(self, row: Dict) -> None:
+        self.remove(row['id'])
+        normalized = normalize_for_match(row['会社名'] or '')
+        if not normalized:
+            return
+        grams = _grams(normalized)
+        self.entries[row['id']] = dict(row, normalized=normalized, grams=grams)
+        for gram in grams:
+            self.postings.setdefault(gram, set()).add(row['id'])
+
+    def remove(self, company_id: int) -> None:
+        entry = self.entries.pop(company_id, None)
+        if entry is None:
+            return
+        for gram in entry['grams']:
+            ids = self.postings.get(gram)
+            if ids is not None:
+                ids.discard(company_id)
+                if not ids:
+                    del self.postings[gram]
+
+    def search(self, normalized: str, prefecture: Optional[str], limit: int) -> List[Dict]:
+        grams = _grams(normalized)
+        # 類似度が MIN_SCORE 以上なら共通の 2-gram は MIN_SCORE²×|A| 個以上あるので、
+        # 出現数の少ない順に |A| - その個数 + 1 個の 2-gram のどれかを必ず含む（prefix filtering）
+        required = max(1, math.ceil(COMPANY_INDEX_MIN_SCORE ** 2 * len(grams) - 1e-9))
+        rare_first = sorted(grams, key=lambda g: len(self.postings.get(g, ())))
+        prefix = rare_first[:len(grams) - required + 1]
+        rest = len(grams) - len(prefix)
+        counts: Dict[int, int] = {}
+        for gram in prefix:
+            for company_id in self.postings.get(gram, ()):
+                counts[company_id] = counts.get(company_id, 0) + 1
+
+        matches = []
+        for company_id, count in counts.items():
+            entry = self.entries[company_id]
+            norm = math.sqrt(len(grams) * len(entry['grams']))
+            # 残りの 2-gram がすべて共通でも届かない候補は集合演算をせずに除く
+            if count + rest < COMPANY_INDEX_MIN_SCORE * norm - 1e-9:
+                continue
+            score = len(grams & entry['grams']) / norm
+            if score < COMPANY_INDEX_MIN_SCORE:
+                continue
+            max_edits = int(max(len(normalized), len(entry['normalized'])) * COMPANY_INDEX_MAX_EDIT_RATIO)
+            if _within_edits(normalized, entry['normalized'], max_edits):
+                matches.append((score, prefecture is not None and entry['都道府県'] == prefecture, entry))
+        # 類似度が同じなら都道府県が一致するものを優先
+        matches.sort(key=lambda m: (m[0], m[1]), reverse=True)
+        return [
+            {
+                'company_id': entry['id'],
+                '会社名': entry['会社名'],
+                '法人番号': entry['法人番号'],
+                'インボイス登録番号': entry['インボイス登録番号'],
+                '都道府県': entry['都道府県'],
+                'score': round(score, 3),
+            }
+            for score, _, entry in matches[:limit]
+        ]
+
+
+_indexes: "OrderedDict[int, _TenantIndex]" = OrderedDict()
+_indexes_lock = threading.Lock()
+_stats = {'lookups': 0, 'hits': 0, 'misses': 0, 'refreshes': 0, 'rebuilds': 0, 'lookup_us_total': 0.0}
+_stats_lock = threading.Lock()
+
+
+def _count(key: str, value: float = 1) -> None:
+    with _stats_lock:
+        _stats[key] += value
+
+
+def _tenant_index(tenant_id: int) -> _TenantIndex:
+    with _indexes_lock:
+        index = _indexes.get(tenant_id)
+        if index is None:
+            index = _indexes[tenant_id] = _TenantIndex()
+        _indexes.move_to_end(tenant_id)
+        while len(_indexes) > max(1, COMPANY_INDEX_MAX_TENANTS):
+            _indexes.popitem(last=False)
+        return index
+
+
+def _refresh(tenant_id: int, index: _TenantIndex) -> None:
+    """前回以降に登録・更新された企業を読み込む（削除があれば作り直す）。index.lock を保持して呼ぶ"""
+    conn = get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute(_sql(conn, '''
+            SELECT COUNT(*), MAX(COALESCE(最終更新日, created_at)) FROM "T_企業情報" WHERE tenant_id = %s
+        '''), (tenant_id,))
+        count, watermark = cur.fetchone()
+        count = count or 0
+
+        rebuild = index.watermark is None or count < index.count
+        if not rebuild and watermark == index.watermark and count == index.count:
+            return
+
+        sql = f'SELECT {", ".join(_COLUMNS)} FROM "T_企業情報" WHERE tenant_id = %s'
+        params = [tenant_id]
+        if not rebuild:
+            # 同時刻の更新を取りこぼさないよう、前回の時刻ちょうどのものも読み直す
+            sql += ' AND COALESCE(最終更新日, created_at) >= %s'
+            params.append(index.watermark)
+        cur.execute(_sql(conn, sql), params)
+        rows = cur.fetchall()
+    finally:
+        conn.close()
+
+    if rebuild:
+        index.entries.clear()
+        index.postings.clear()
+        _count('rebuilds')
+    else:
+        _count('refreshes')
+    for row in rows:
+        index.upsert({col: row[i] for i, col in enumerate(_COLUMNS)})
+    index.watermark = watermark
+    index.count = count
+
+
+def match_company(tenant_id: int, company_name: str, prefecture: Optional[str] = None,
+                  limit: int = 1) -> List[Dict]:
+    """
+    テナントの登録済み企業から会社名が近いものを探す
+
+    Args:
+        tenant_id: テナントID
+        company_name: OCRで読み取った会社名
+        prefecture: 住所から取り出した都道府県（同点のときに優先する）
+        limit: 返す件数
+
+    Returns:
+        [{'company_id', '会社名', '法人番号', 'インボイス登録番号', '都道府県', 'score'}, ...]（類似度の高い順）
+    """
+    if not COMPANY_INDEX_ENABLED or not company_name:
+        return []
+    normalized = normalize_for_match(company_name)
+    if not normalized:
+        return []
+
+    index = _tenant_index(tenant_id)
+    with index.lock:
+        now = time.monotonic()
+        if now >= index.next_check:
+            try:
+                _refresh(tenant_id, index)
+            except Exception as e:
+                print(f"企業情報インデックス更新エラー: {e}")
+            index.next_check = now + COMPANY_INDEX_REFRESH
+
+        started = time.perf_counter()
+        matches = index.search(normalized, prefecture, limit)
+        elapsed_us = (time.perf_counter() - started) * 1_000_000
+
+    _count('lookups')
+    _count('hits' if matches else 'misses')
+    _count('lookup_us_total', elapsed_us)
+    return matches
+
+
+def mark_company_index_stale(tenant_id: int, rebuild: bool = False) -> None:
+    """
+    企業情報を登録・編集・削除したときに呼ぶ（次の検索で差分を読み込む）
+
+    Args:
+        tenant_id: テナントID
+        rebuild: 差分ではなく作り直す（削除したとき）
+    """
+    with _indexes_lock:
+        index = _indexes.get(tenant_id)
+    if index is None:
+        return
+    with index.lock:
+        index.next_check = 0.0
+        if rebuild:
+            index.watermark = None
+
+
+def get_company_index_stats() -> Dict:
+    """検索件数・ヒット率・平均検索時間とインデックスの件数"""
+    with _stats_lock:
+        stats = dict(_stats)
+    with _indexes_lock:
+        indexes = list(_indexes.values())
+    lookup_us_total = stats.pop('lookup_us_total')
+    stats['hit_ratio'] = round(stats['hits'] / stats['lookups'], 3) if stats['lookups'] else None
+    stats['avg_lookup_us'] = round(lookup_us_total / stats['lookups'], 1) if stats['lookups'] else None
+    stats['tenants'] = len(indexes)
+    stats['companies'] = sum(len(index.entries) for index in indexes)
+    stats['min_score'] = COMPANY_INDEX_MIN_SCORE
+    stats['max_edit_ratio'] = COMPANY_INDEX_MAX_EDIT_RATIO
+    stats['trust_score'] = COMPANY_INDEX_TRUST_SCORE
+    return stats
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+同じレシートの重複登録検出（警告のみ。アップロードは拒否しない）
+
+1. アップロード時: 同じファイルの再アップロード
+   保存パスは内容の SHA-256 で決まるため、テナント内に同じ画像パスのジョブ
+   （処理待ち・処理中・登録済みの証憑）があれば重複候補としてレスポンスに含める
+2. OCR後: 同じ紙のレシートを撮り直したもの
+   画像全体の知覚ハッシュ（dHash/pHash）はレシート同士の見た目が似すぎていて区別できないため、
+   OCR結果で判定する
+   - 候補: テナント内で「合計金額 + 日付」が一致する登録済み証憑（T_証憑重複指紋 のインデックスで検索）
+   - 確認: OCR全文の文字3-gramの Jaccard 係数と、時刻・レシート番号の一致
+     時刻・レシート番号が両方にあって食い違えば別のレシート（同じ店・同じ日・同じ買い物でも区別できる）
+     時刻は完全一致、レシート番号はOCRの1文字の読み違いまで許して比べる
+     一致すれば係数が _MIN_SIMILARITY 以上で重複、どちらにも無ければ DUPLICATE_TEXT_SIMILARITY 以上で重複
+   - 判定結果はジョブの warning に入れる
+
+しきい値は benchmarks/duplicate_lookup.py（レシートを模したOCRテキストに文字化けを入れたもの）で決めた。
+"""
+
+import os
+import re
+import threading
+import unicodedata
+from typing import Dict, List, Optional, Set, Tuple
+
+from .db import get_db, _sql
+
+
+DUPLICATE_DETECTION_ENABLED = os.environ.get('DUPLICATE_DETECTION', '1') in ('1', 'true', 'True')
+# 時刻・レシート番号で確認できないときに重複とみなす本文の類似度（Jaccard 係数）
+DUPLICATE_TEXT_SIMILARITY = float(os.environ.get('DUPLICATE_TEXT_SIMILARITY', '0.7'))
+
+# 時刻・レシート番号が一致していても、本文がこれより似ていなければ別のレシート
+_MIN_SIMILARITY = 0.3
+_NGRAM = 3
+
+# OCRで数字と取り違えやすい文字
+_DIGIT_LIKE = str.maketrans({'O': '0', 'o': '0', 'D': '0', 'l': '1', 'I': '1', '|': '1', 'B': '8', 'S': '5'})
+_D = r'[\dOoDlI|BS]'
+_TIME_RE = re.compile(rf'(?<![\dOoDlI|BS])({_D}{{1,2}})[:時]({_D}{{2}})(?![\dOoDlI|BS])')
+_RECEIPT_NO_RE = re.compile(rf'(?:No|NO|no|番号|#|取引)\W{{0,2}}({_D}{{3,}})')
+
+_stats = {'upload_checked': 0, 'same_file': 0, 'receipt_checked': 0, 'same_receipt': 0, 'errors': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(key: str) -> None:
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def find_same_file(tenant_id: int, filepath: str, conn=None) -> List[Dict]:
+    """
+    テナント内で同じファイル（同じ内容）を使っているジョブを探す
+
+    Returns:
+        [{'job_id', 'voucher_id', 'status', 'reason': 'same_file'}, ...]
+        処理に失敗したジョブ・証憑が削除済みのジョブは対象外
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute(_sql(conn, '''
+            SELECT j.id, j.voucher_id, j.status
+            FROM "T_証憑ジョブ" j
+            LEFT JOIN "T_証憑" v ON v.id = j.voucher_id
+            WHERE j.tenant_id = %s AND j.画像パス = %s
+              AND j.status <> 'failed'
+              AND (j.status <> 'done' OR v.id IS NOT NULL)
+            ORDER BY j.id
+        '''), (tenant_id, filepath))
+        rows = cur.fetchall()
+    finally:
+        if own_conn:
+            conn.close()
+    return [{'job_id': row[0], 'voucher_id': row[1], 'status': row[2], 'reason': 'same_file'} for row in rows]
+
+
+def check_upload_duplicates(tenant_id: int, filepath: str) -> List[Dict]:
+    """
+    アップロード直後（ジョブ登録前）に同じファイルが登録済みか調べる
+
+    Returns:
+        重複候補の一覧（無効化されている場合や検索に失敗した場合は空）
+    """
+    if not DUPLICATE_DETECTION_ENABLED:
+        return []
+    try:
+        matches = find_same_file(tenant_id, filepath)
+    except Exception as e:
+        _count('errors')
+        print(f"重複チェックエラー（スキップ）: {e}")
+        return []
+    _count('upload_checked')
+    if matches:
+        _count('same_file')
+    return matches
+
+
+def receipt_fingerprint(ocr_result: Dict) -> Optional[str]:
+    """候補検索用のキー（合計金額|日付）。どちらかが読み取れなければNone"""
+    amount = ocr_result.get('amount')
+    date = ocr_result.get('date')
+    if amount is None or not date:
+        return None
+    try:
+        amount = int(round(float(amount)))
+    except (TypeError, ValueError):
+        return None
+    return f"{amount}|{str(date)[:10]}"
+
+
+def _normalize_text(text: str) -> str:
+    return re.sub(r'\s+', '', unicodedata.normalize('NFKC', text or '')).lower()
+
+
+def _ngrams(text: str) -> Set[str]:
+    normalized = _normalize_text(text)
+    return {normalized[i:i + _NGRAM] for i in range(len(normalized) - _NGRAM + 1)}
+
+
+def text_similarity(a: str, b: str) -> float:
+    """OCR全文の文字3-gram集合の Jaccard 係数"""
+    grams_a, grams_b = _ngrams(a), _ngrams(b)
+    if not grams_a or not grams_b:
+        return 0.0
+    return len(grams_a & grams_b) / len(grams_a | grams_b)
+
+
+def receipt_identifiers(text: str) -> Tuple[Set[str], Set[str]]:
+    """レシートごとに異なる値（時刻 HHMM、レシート番号）を取り出す"""
+    normalized = unicodedata.normalize('NFKC', text or '')
+    times = {
+        hour.translate(_DIGIT_LIKE).zfill(2) + minute.translate(_DIGIT_LIKE)
+        for hour, minute in _TIME_RE.findall(normalized)
+    }
+    numbers = {value.translate(_DIGIT_LIKE) for value in _RECEIPT_NO_RE.findall(normalized)}
+    return times, numbers
+
+
+def _nearly_equal(a: str, b: str) -> bool:
+    """編集距離1以内（OCRの1文字の読み違い・欠落を許す）"""
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) == len(b):
+        return sum(x != y for x, y in zip(a, b)) <= 1
+    shorter, longer = (a, b) if len(a) < len(b) else (b, a)
+    return any(longer[:i] + longer[i + 1:] == shorter for i in range(len(longer)))
+
+
+def _overlaps(a: Set[str], b: Set[str]) -> bool:
+    return any(_nearly_equal(x, y) for x in a for y in b)
+
+
+def is_same_receipt(text_a: str, text_b: str) -> Tuple[bool, float]:
+    """
+    合計金額・日付が一致する2枚のOCR全文が同じレシートか
+
+    Returns:
+        (同じレシートか, 本文の類似度)
+    """
+    similarity = text_similarity(text_a, text_b)
+    if similarity < _MIN_SIMILARITY:
+        return False, similarity
+    confirmed = False
+    (times_a, numbers_a), (times_b, numbers_b) = receipt_identifiers(text_a), receipt_identifiers(text_b)
+    # 時刻は4桁しかなく1文字違いを許すと別の時刻と一致しやすいため、完全一致で比べる
+    for ids_a, ids_b, matched in ((times_a, times_b, bool(times_a & times_b)),
+                                  (numbers_a, numbers_b, _overlaps(numbers_a, numbers_b))):
+        if ids_a and ids_b:
+            if not matched:
+                return False, similarity
+            confirmed = True
+    return confirmed or similarity >= DUPLICATE_TEXT_SIMILARITY, similarity
+
+
+def find_same_receipt(tenant_id: int, ocr_result: Dict, conn=None) -> List[Dict]:
+    """
+    OCR結果から、同じレシートと思われる登録済み証憑を探す
+
+    Returns:
+        [{'voucher_id', 'similarity', 'reason': 'same_receipt'}, ...]（類似度の高い順）
+    """
+    fingerprint = receipt_fingerprint(ocr_result)
+    text = ocr_result.get('full_text') or ocr_result.get('raw_text') or ''
+    if not fingerprint or not text:
+        return []
+
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute(_sql(conn, '''
+            SELECT v.id, v.OCR結果_生データ
+            FROM "T_証憑重複指紋" f
+            JOIN "T_証憑" v ON v.id = f.voucher_id
+            WHERE f.tenant_id = %s AND f.fingerprint = %s
+        '''), (tenant_id, fingerprint))
+        rows = cur.fetchall()
+    finally:
+        if own_conn:
+            conn.close()
+
+    matches = []
+    for row in rows:
+        same, similarity = is_same_receipt(text, row[1] or '')
+        if same:
+            matches.append({'voucher_id': row[0], 'similarity': round(similarity, 3), 'reason': 'same_receipt'})
+    matches.sort(key=lambda m: m['similarity'], reverse=True)
+    return matches
+
+
+def check_receipt_duplicates(tenant_id: int, ocr_result: Dict) -> List[Dict]:
+    """パイプラインのOCR後に呼ぶ。失敗しても処理は続ける"""
+    if not DUPLICATE_DETECTION_ENABLED:
+        return []
+    try:
+        matches = find_same_receipt(tenant_id, ocr_result)
+    except Exception as e:
+        _count('errors')
+        print(f"重複チェックエラー（スキップ）: {e}")
+        return []
+    _count('receipt_checked')
+    if matches:
+        _count('same_receipt')
+    return matches
+
+
+def register_receipt(tenant_id: int, voucher_id: Optional[int], ocr_result: Dict) -> None:
+    """登録した証憑を以降の重複チェックの比較対象にする"""
+    fingerprint = receipt_fingerprint(ocr_result)
+    if not DUPLICATE_DETECTION_ENABLED or voucher_id is None or fingerprint is None:
+        return
+    try:
+        conn = get_db()
+        try:
+            cur = conn.cursor()
+            cur.execute(_sql(conn, '''
+                INSERT INTO "T_証憑重複指紋" (tenant_id, voucher_id, fingerprint)
+                VALUES (%s, %s, %s)
+            '''), (tenant_id, voucher_id, fingerprint))
+            if hasattr(conn, 'commit'):
+                conn.commit()
+        finally:
+            conn.close()
+    except Exception as e:
+        _count('errors')
+        print(f"重複チェック用の登録エラー: {e}")
+
+
+def remove_voucher_fingerprints(conn, tenant_id: int, voucher_id: int) -> None:
+    """証憑を削除したときに重複チェック用の行も削除（呼び出し側でコミットする）"""
+    cur = conn.cursor()
+    cur.execute(_sql(conn, '''
+        DELETE FROM "T_証憑重複指紋" WHERE tenant_id = %s AND voucher_id = %s
+    '''), (tenant_id, voucher_id))
+
+
+def format_duplicate_warning(matches: List[Dict]) -> Optional[str]:
+    """重複候補をジョブの警告メッセージにする"""
+    if not matches:
+        return None
+    ids = ', '.join(
+        f"証憑#{m['voucher_id']}" if m.get('voucher_id') else f"ジョブ#{m['job_id']}" for m in matches
+    )
+    return f'同じレシートと思われる証憑が登録済みです（{ids}）'
+
+
+def get_duplicate_stats() -> Dict:
+    """重複チェックの件数"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['enabled'] = DUPLICATE_DETECTION_ENABLED
+    stats['text_similarity'] = DUPLICATE_TEXT_SIMILARITY
+    return stats
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+レシート項目抽出エンジン
+OCRテキストを1回だけ正規化し、インポート時にコンパイルした正規表現で全項目を抽出する
+
+ocr.py の extract_* 関数（会社名・電話番号・住所・郵便番号・金額・日付・
+インボイス番号・法人番号）と同じ優先順位で結果を返す。
+- 正規化は NFKC（全角数字・全角英字・㈱ などを半角／(株) に揃える）
+- 正規表現はすべてインポート時にコンパイル
+- 走査は正規化済みテキスト全体に対して行い、行ごとの Python ループを持たない
+  （47都道府県は1つの正規表現にまとめ、出現位置から住所行を切り出す）
+- 「株式会社」やハイフンなどを含まないテキストでは該当パターンを実行しない
+"""
+
+import re
+import unicodedata
+from typing import Dict, List
+
+
+# ---- 会社名（リスト順が優先順位） ----
+_NAME_CHARS = r'[\u3040-\u309F\u30A0-\u30FF\u4E00-\u9FFFa-zA-Z0-9]+'
+# (パターン, テキストに含まれていなければ実行しなくてよい文字列)
+_COMPANY_PATTERNS = [(re.compile(p), keyword) for p, keyword in (
+    (r'株式会社' + _NAME_CHARS, '株式会社'),
+    (_NAME_CHARS + r'株式会社', '株式会社'),
+    (r'有限会社' + _NAME_CHARS, '有限会社'),
+    (_NAME_CHARS + r'有限会社', '有限会社'),
+    (r'合同会社' + _NAME_CHARS, '合同会社'),
+    (_NAME_CHARS + r'合同会社', '合同会社'),
+    (r'合資会社' + _NAME_CHARS, '合資会社'),
+    (r'合名会社' + _NAME_CHARS, '合名会社'),
+    # 略称対応（NFKC で ㈱ は (株) になる）
+    (r'\(株\)' + _NAME_CHARS, '(株)'),
+    (_NAME_CHARS + r'\(株\)', '(株)'),
+)]
+
+# ---- 電話番号 ----
+_PHONE_PATTERNS = [re.compile(p) for p in (
+    r'\d{2,4}-\d{2,4}-\d{4}',        # 03-1234-5678
+    r'\d{3}-\d{3}-\d{4}',            # 090-1234-5678
+    r'\(\d{2,4}\)\s*\d{2,4}-\d{4}',  # (03) 1234-5678
+    r'\d{10,11}',                    # 09012345678
+)]
+
+# ---- 住所（都道府県を含む行） ----
+PREFECTURES = (
+    '北海道', '青森県', '岩手県', '宮城県', '秋田県', '山形県', '福島県',
+    '茨城県', '栃木県', '群馬県', '埼玉県', '千葉県', '東京都', '神奈川県',
+    '新潟県', '富山県', '石川県', '福井県', '山梨県', '長野県', '岐阜県',
+    '静岡県', '愛知県', '三重県', '滋賀県', '京都府', '大阪府', '兵庫県',
+    '奈良県', '和歌山県', '鳥取県', '島根県', '岡山県', '広島県', '山口県',
+    '徳島県', '香川県', '愛媛県', '高知県', '福岡県', '佐賀県', '長崎県',
+    '熊本県', '大分県', '宮崎県', '鹿児島県', '沖縄県',
+)
+_PREFECTURE_RE = re.compile('|'.join(PREFECTURES))
+
+# ---- 郵便番号 ----
+_POSTAL_RE = re.compile(r'\d{3}-\d{4}')
+
+# ---- 金額 ----
+_AMOUNT_PATTERNS = [re.compile(p) for p in (
+    r'¥\s*([\d,]+)',
+    r'([\d,]+)\s*円',
+    r'合計\s*[:]\s*([\d,]+)',
+    r'小計\s*[:]\s*([\d,]+)',
+)]
+
+# ---- 日付（リスト順が優先順位） ----
+_DATE_PATTERNS = [re.compile(p) for p in (
+    r'(\d{4})[年/\-](\d{1,2})[月/\-](\d{1,2})',  # 2024年1月1日, 2024/1/1, 2024-1-1
+    r'(\d{4})\.(\d{1,2})\.(\d{1,2})',            # 2024.1.1
+)]
+
+# ---- インボイス登録番号・法人番号 ----
+# T の後の13桁はスペース・ハイフンで区切られていてもよい
+_INVOICE_RE = re.compile(r'T[ \-]*(?:\d[ \-]*){12}\d')
+_INVOICE_STRIP = str.maketrans('', '', ' -')
+_CORPORATE_RE = re.compile(r'(?<!T)\b\d{13}\b')
+
+
+def normalize_text(text: str) -> str:
+    """OCRテキストを NFKC 正規化（全角数字・記号を半角に揃える）"""
+    return unicodedata.normalize('NFKC', text or '')
+
+
+def extract_receipt_fields(text: str) -> Dict:
+    """
+    OCRテキストからレシートの全項目を抽出
+
+    Args:
+        text: OCRで抽出されたテキスト
+
+    Returns:
+        process_receipt_image と同じキーを持つ辞書
+        （company_name, phone_numbers, addresses, postal_code, amount, date,
+          invoice_number, corporate_number）
+    """
+    normalized = normalize_text(text)
+    has_hyphen = '-' in normalized
+
+    # 会社名: リスト順に最初に見つかったもの
+    company = None
+    for pattern, keyword in _COMPANY_PATTERNS:
+        if keyword not in normalized:
+            continue
+        match = pattern.search(normalized)
+        if match:
+            company = match.group(0).replace('(株)', '株式会社')
+            break
+
+    # 電話番号: 見つかった順に重複を除く
+    phones: Dict[str, None] = {}
+    for pattern in (_PHONE_PATTERNS if has_hyphen else _PHONE_PATTERNS[2:]):
+        for phone in pattern.findall(normalized):
+            phones.setdefault(phone, None)
+
+    # 住所: 都道府県名の出現位置から行全体を切り出す（1行は1回だけ）
+    addresses = []
+    line_end = -1
+    for match in _PREFECTURE_RE.finditer(normalized):
+        if match.start() < line_end:
+            continue
+        line_start = normalized.rfind('\n', 0, match.start()) + 1
+        line_end = normalized.find('\n', match.end())
+        if line_end < 0:
+            line_end = len(normalized)
+        cleaned = normalized[line_start:line_end].strip()
+        if len(cleaned) > 5:  # 最低限の長さチェック
+            addresses.append(cleaned)
+
+    # 郵便番号（最初の1件）
+    match = _POSTAL_RE.search(normalized) if has_hyphen else None
+    postal_code = match.group(0) if match else None
+
+    # 金額（すべて集めて最大値）
+    amounts: List[float] = []
+    for pattern in _AMOUNT_PATTERNS:
+        for value in pattern.findall(normalized):
+            try:
+                amounts.append(float(value.replace(',', '')))
+            except ValueError:
+                continue
+
+    # 日付: リスト順に最初に見つかったもの
+    date = None
+    for pattern in _DATE_PATTERNS:
+        match = pattern.search(normalized)
+        if match:
+            year, month, day = match.groups()
+            date = f"{year}-{int(month):02d}-{int(day):02d}"
+            break
+
+    # インボイス登録番号（スペース・ハイフンを除いて T + 13桁）
+    invoice_number = None
+    if 'T' in normalized:
+        match = _INVOICE_RE.search(normalized)
+        if match:
+            invoice_number = match.group(0).translate(_INVOICE_STRIP)
+
+    # 法人番号（T の付かない13桁）
+    match = _CORPORATE_RE.search(normalized)
+    corporate_number = match.group(0) if match else None
+
+    return {
+        'company_name': company,
+        'phone_numbers': list(phones),
+        'addresses': addresses,
+        'postal_code': postal_code,
+        'amount': max(amounts) if amounts else None,
+        'date': date,
+        'invoice_number': invoice_number,
+        'corporate_number': corporate_number,
+    }
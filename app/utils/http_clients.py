@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+外部API向けクライアントの共有レジストリ
+国税庁API・Vision REST・AI SDK の呼び出しで、接続（DNS解決・TCP・TLSハンドシェイク）を使い回す
+
+- HTTP は接続先サービスごとに requests.Session を1つ持ち、キープアライブの接続プールで再利用する
+  （プールの大きさはサービスごとに HTTP_POOL_MAXSIZE_<サービス名> で変えられる）
+- タイムアウトは (接続, 読み込み) の組で指定し、接続は短く HTTP_CONNECT_TIMEOUT 秒で打ち切る
+- 接続の確立に失敗したときだけ1回再試行する（送信前なので POST でも安全）
+- AI SDK のクライアントは APIキーごと（＝テナントごと）に作って LRU で保持する
+  genai.configure はプロセス全体の設定を書き換えるため使わず、キーごとの低レベルクライアントを使う
+- fork 後の子プロセスでは親の接続を使わないよう作り直す
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+
+if TYPE_CHECKING:
+    # requests は最初のセッション作成時に読み込む（注釈だけのために import しない）
+    import requests
+
+
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '3.05'))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '10'))
+HTTP_CONNECT_RETRIES = int(os.environ.get('HTTP_CONNECT_RETRIES', '1'))
+AI_CLIENT_CACHE_SIZE = int(os.environ.get('AI_CLIENT_CACHE_SIZE', '64'))
+AI_READ_TIMEOUT = float(os.environ.get('AI_READ_TIMEOUT', '60'))
+AI_MAX_RETRIES = int(os.environ.get('AI_MAX_RETRIES', '2'))
+
+# サービス名 → 既定の読み込みタイムアウト（秒）
+READ_TIMEOUTS = {
+    'nta': 5.0,
+    'vision': 30.0,
+}
+
+_sessions: Dict[str, 'requests.Session'] = {}
+_ai_clients: 'OrderedDict[Tuple[str, str], object]' = OrderedDict()
+_registry_pid: Optional[int] = None
+_lock = threading.Lock()
+
+_stats: Dict[str, Dict] = {}
+_ai_stats = {'created': 0, 'reused': 0, 'evicted': 0}
+
+
+def _check_pid() -> None:
+    """fork 後の子プロセスでは親から引き継いだセッション・クライアントを捨てる（_lock を保持して呼ぶ）"""
+    global _registry_pid
+    pid = os.getpid()
+    if _registry_pid != pid:
+        _sessions.clear()
+        _ai_clients.clear()
+        _stats.clear()
+        _registry_pid = pid
+
+
+def _pool_maxsize(service: str) -> int:
+    return int(os.environ.get(f'HTTP_POOL_MAXSIZE_{service.upper()}', str(HTTP_POOL_MAXSIZE)))
+
+
+def get_session(service: str):
+    """
+    サービス用の共有セッションを取得
+
+    Args:
+        service: 接続先サービス名（'nta', 'vision' など）
+
+    Returns:
+        requests.Session（スレッド間で共有してよい）
+    """
+    with _lock:
+        _check_pid()
+        session = _sessions.get(service)
+        if session is not None:
+            return session
+
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        maxsize = _pool_maxsize(service)
+        retry = Retry(total=HTTP_CONNECT_RETRIES, connect=HTTP_CONNECT_RETRIES,
+                      read=0, status=0, other=0, redirect=False, allowed_methods=None)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=maxsize, max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _sessions[service] = session
+        _stats.setdefault(service, {'requests': 0, 'errors': 0, 'total_ms': 0.0})
+        return session
+
+
+def get_timeout(service: str, read: Optional[float] = None) -> Tuple[float, float]:
+    """(接続, 読み込み) のタイムアウト"""
+    return HTTP_CONNECT_TIMEOUT, read if read is not None else READ_TIMEOUTS.get(service, 30.0)
+
+
+def http_request(service: str, method: str, url: str, read_timeout: Optional[float] = None, **kwargs):
+    """
+    共有セッションでリクエストを送る
+
+    Args:
+        service: 接続先サービス名
+        method: 'GET' / 'POST' など
+        url: URL
+        read_timeout: 読み込みタイムアウト（既定: READ_TIMEOUTS）
+        **kwargs: requests に渡す引数（params, data, headers など）
+
+    Returns:
+        requests.Response
+    """
+    session = get_session(service)
+    started = time.perf_counter()
+    try:
+        response = session.request(method, url, timeout=get_timeout(service, read_timeout), **kwargs)
+    except Exception:
+        _record(service, started, error=True)
+        raise
+    _record(service, started, error=response.status_code >= 500)
+    return response
+
+
+def _record(service: str, started: float, error: bool) -> None:
+    with _lock:
+        stats = _stats.setdefault(service, {'requests': 0, 'errors': 0, 'total_ms': 0.0})
+        stats['requests'] += 1
+        stats['total_ms'] += (time.perf_counter() - started) * 1000
+        if error:
+            stats['errors'] += 1
+
+
+def _key_id(api_key: str) -> str:
+    """キャッシュのキー（APIキーそのものは保持しない）"""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+
+def _cached_ai_client(kind: str, api_key: str, factory):
+    """APIキーごとのクライアントを LRU で保持"""
+    cache_key = (kind, _key_id(api_key))
+    with _lock:
+        _check_pid()
+        client = _ai_clients.get(cache_key)
+        if client is not None:
+            _ai_clients.move_to_end(cache_key)
+            _ai_stats['reused'] += 1
+            return client
+
+    # クライアントの生成はロックの外で行う（同時に作られた場合は先に登録されたほうを使う）
+    client = factory()
+    with _lock:
+        existing = _ai_clients.get(cache_key)
+        if existing is not None:
+            _ai_stats['reused'] += 1
+            return existing
+        _ai_clients[cache_key] = client
+        _ai_stats['created'] += 1
+        while len(_ai_clients) > max(1, AI_CLIENT_CACHE_SIZE):
+            # 使用中のスレッドがあり得るので明示的には閉じず、参照が無くなった時点で解放させる
+            _ai_clients.popitem(last=False)
+            _ai_stats['evicted'] += 1
+    return client
+
+
+def get_openai_client(api_key: str):
+    """APIキーごとの OpenAI クライアント（接続プールを共有する）"""
+    def _create():
+        import httpx
+        from openai import DefaultHttpxClient, OpenAI
+
+        return OpenAI(
+            api_key=api_key,
+            timeout=httpx.Timeout(AI_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            max_retries=AI_MAX_RETRIES,
+            http_client=DefaultHttpxClient(limits=httpx.Limits(
+                max_connections=_pool_maxsize('openai'),
+                max_keepalive_connections=_pool_maxsize('openai'),
+            )),
+        )
+
+    return _cached_ai_client('openai', api_key, _create)
+
+
+def get_gemini_client(api_key: str):
+    """
+    APIキーごとの Gemini（GenerativeService）クライアント
+    genai.configure と違いプロセス全体の設定を変えないので、テナントごとに別のキーを同時に使える
+    """
+    def _create():
+        from google.ai import generativelanguage as glm
+
+        return glm.GenerativeServiceClient(client_options={'api_key': api_key})
+
+    return _cached_ai_client('gemini', api_key, _create)
+
+
+def _pool_stats(session) -> Dict:
+    """urllib3 の接続プールから、新規接続数とリクエスト数を集計"""
+    connections = 0
+    requests_sent = 0
+    pools = 0
+    for adapter in set(session.adapters.values()):
+        container = adapter.poolmanager.pools
+        for key in list(container.keys()):
+            pool = container.get(key)
+            if pool is None:
+                continue
+            pools += 1
+            connections += getattr(pool, 'num_connections', 0)
+            requests_sent += getattr(pool, 'num_requests', 0)
+    return {
+        'host_pools': pools,
+        'connections_opened': connections,
+        'connection_reuse_ratio': round(1 - connections / requests_sent, 3) if requests_sent else None,
+    }
+
+
+def get_http_client_stats() -> Dict:
+    """サービスごとのリクエスト数・エラー数・平均時間・接続の再利用率と AI クライアント数"""
+    with _lock:
+        _check_pid()
+        sessions = dict(_sessions)
+        services = {name: dict(stats) for name, stats in _stats.items()}
+        ai = dict(_ai_stats, cached=len(_ai_clients))
+
+    for name, stats in services.items():
+        total_ms = stats.pop('total_ms')
+        stats['avg_ms'] = round(total_ms / stats['requests'], 1) if stats['requests'] else None
+        stats['pool_maxsize'] = _pool_maxsize(name)
+        if name in sessions:
+            stats.update(_pool_stats(sessions[name]))
+    return {
+        'connect_timeout': HTTP_CONNECT_TIMEOUT,
+        'services': services,
+        'ai_clients': ai,
+    }
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+OCR前の画像前処理
+スマホ写真（4000×3000px・数MB）をOCRに必要な解像度まで縮小してから送信する
+
+処理順:
+1. EXIF の回転情報を反映
+2. メタデータを除去（再エンコード時に EXIF を書き出さない）
+3. グレースケール化
+4. 長辺を OCR_MAX_LONG_EDGE px まで縮小
+5. 書類部分を検出して切り抜き（OpenCV が使える場合）
+6. JPEG（OCR_JPEG_QUALITY）で再エンコード
+
+メモリ使用量:
+- JPEG はドラフトモードで OCR_MAX_LONG_EDGE 付近まで縮小しながらデコードする
+  （24MP の写真をフル解像度で展開しない。グレースケールならデコード時に1チャンネルにする）
+- PNG などは縮小前に整数倍の reduce をかけ、中間画像を小さくする
+- 同時にデコードする画像数をプロセスごとに OCR_DECODE_CONCURRENCY までに制限する
+"""
+
+import io
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+
+OCR_PREPROCESS_ENABLED = os.environ.get('OCR_PREPROCESS', '1') in ('1', 'true', 'True')
+# Vision のドキュメントOCRは長辺2000px前後あれば精度が落ちない
+OCR_MAX_LONG_EDGE = int(os.environ.get('OCR_MAX_LONG_EDGE', '2048'))
+OCR_JPEG_QUALITY = int(os.environ.get('OCR_JPEG_QUALITY', '85'))
+OCR_GRAYSCALE = os.environ.get('OCR_GRAYSCALE', '1') in ('1', 'true', 'True')
+OCR_CROP_DOCUMENT = os.environ.get('OCR_CROP_DOCUMENT', '1') in ('1', 'true', 'True')
+OCR_DECODE_CONCURRENCY = max(1, int(os.environ.get('OCR_DECODE_CONCURRENCY', '2')))
+
+# 書類とみなす輪郭の最小面積（画像全体に対する割合）
+_MIN_DOCUMENT_AREA_RATIO = 0.2
+# 切り抜き時に残す余白（px）
+_CROP_MARGIN = 8
+# 縮小時に先に整数倍の reduce をかける目安（目標サイズの何倍以上なら reduce するか）
+_REDUCING_GAP = 3.0
+
+_decode_semaphore = threading.BoundedSemaphore(OCR_DECODE_CONCURRENCY)
+_decode_stats = {'decodes': 0, 'waits': 0, 'draft_reduced': 0}
+_decode_stats_lock = threading.Lock()
+
+
+def preprocess_signature() -> str:
+    """
+    前処理設定を表す文字列（OCRキャッシュの機能セットに含める）
+    設定を変えるとキャッシュキーも変わる
+    """
+    if not OCR_PREPROCESS_ENABLED:
+        return 'raw'
+    # 末尾の d はドラフトモードでの縮小デコード
+    return (f"pp{OCR_MAX_LONG_EDGE}q{OCR_JPEG_QUALITY}"
+            f"{'g' if OCR_GRAYSCALE else 'c'}{'x' if OCR_CROP_DOCUMENT else ''}d")
+
+
+@contextmanager
+def decode_slot():
+    """
+    画像デコードの同時実行数を OCR_DECODE_CONCURRENCY までに制限する
+    （バッチOCRやヘッジ実行で複数の画像を同時に展開してメモリを使い切らないように）
+    """
+    if not _decode_semaphore.acquire(blocking=False):
+        with _decode_stats_lock:
+            _decode_stats['waits'] += 1
+        _decode_semaphore.acquire()
+    try:
+        with _decode_stats_lock:
+            _decode_stats['decodes'] += 1
+        yield
+    finally:
+        _decode_semaphore.release()
+
+
+def open_reduced(image_path: str, max_long_edge: int, mode: Optional[str] = None) -> Image.Image:
+    """
+    画像を開き、JPEG なら長辺 max_long_edge 以上を保つ範囲で縮小デコードするよう設定する
+
+    Args:
+        image_path: 画像ファイルのパス
+        max_long_edge: 必要な長辺のpx
+        mode: デコード時のモード（'L' ならグレースケールで展開）
+
+    Returns:
+        未展開の PIL 画像（ピクセルは最初のアクセス時にデコードされる）
+    """
+    image = Image.open(image_path)
+    width, height = image.size
+    long_edge = max(width, height)
+    if image.format == 'JPEG' and long_edge > max_long_edge:
+        # draft は要求サイズを下回らない最大の 1/2・1/4・1/8 スケールを選ぶ
+        scale = max_long_edge / long_edge
+        requested = (max(1, int(width * scale)), max(1, int(height * scale)))
+        if image.draft(mode or image.mode, requested) is not None:
+            with _decode_stats_lock:
+                _decode_stats['draft_reduced'] += 1
+    elif image.format == 'JPEG' and mode:
+        image.draft(mode, image.size)
+    return image
+
+
+def detect_document_box(image: Image.Image) -> Optional[Tuple[int, int, int, int]]:
+    """
+    画像中の書類（レシート）部分の外接矩形を検出
+
+    Returns:
+        (left, top, right, bottom)、検出できない場合はNone
+    """
+    try:
+        import cv2
+        import numpy as np
+    except Exception:
+        return None
+
+    gray = np.asarray(image.convert('L'))
+    height, width = gray.shape[:2]
+
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    edges = cv2.Canny(blurred, 50, 150)
+    edges = cv2.dilate(edges, np.ones((5, 5), np.uint8), iterations=2)
+
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+
+    largest = max(contours, key=cv2.contourArea)
+    x, y, w, h = cv2.boundingRect(largest)
+    if w * h < width * height * _MIN_DOCUMENT_AREA_RATIO:
+        return None
+
+    left = max(0, x - _CROP_MARGIN)
+    top = max(0, y - _CROP_MARGIN)
+    right = min(width, x + w + _CROP_MARGIN)
+    bottom = min(height, y + h + _CROP_MARGIN)
+
+    # ほぼ全体なら切り抜かない
+    if (right - left) * (bottom - top) > width * height * 0.95:
+        return None
+    return left, top, right, bottom
+
+
+def preprocess_image(image: Image.Image,
+                     max_long_edge: int = None,
+                     grayscale: bool = None,
+                     crop_document: bool = None) -> Image.Image:
+    """
+    OCR用に画像を前処理（回転補正・グレースケール・縮小・切り抜き）
+
+    Args:
+        image: 元画像
+        max_long_edge: 長辺の最大px（既定: OCR_MAX_LONG_EDGE）
+        grayscale: グレースケール化するか（既定: OCR_GRAYSCALE）
+        crop_document: 書類部分を切り抜くか（既定: OCR_CROP_DOCUMENT）
+
+    Returns:
+        前処理後の画像
+    """
+    max_long_edge = max_long_edge or OCR_MAX_LONG_EDGE
+    grayscale = OCR_GRAYSCALE if grayscale is None else grayscale
+    crop_document = OCR_CROP_DOCUMENT if crop_document is None else crop_document
+
+    image = ImageOps.exif_transpose(image)
+
+    if grayscale:
+        image = image.convert('L')
+    elif image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    if max(image.size) > max_long_edge:
+        image.thumbnail((max_long_edge, max_long_edge), Image.LANCZOS, reducing_gap=_REDUCING_GAP)
+
+    if crop_document:
+        box = detect_document_box(image)
+        if box:
+            image = image.crop(box)
+
+    return image
+
+
+def encode_jpeg(image: Image.Image, quality: int = None) -> bytes:
+    """メタデータなしの JPEG にエンコード"""
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality or OCR_JPEG_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+
+def _decode_mode() -> Optional[str]:
+    return 'L' if OCR_GRAYSCALE else None
+
+
+def preprocess_image_file(image_path: str) -> bytes:
+    """
+    画像ファイルを前処理して JPEG バイト列を返す
+    """
+    with decode_slot():
+        with open_reduced(image_path, OCR_MAX_LONG_EDGE, _decode_mode()) as image:
+            processed = preprocess_image(image)
+        try:
+            return encode_jpeg(processed)
+        finally:
+            processed.close()
+
+
+def load_ocr_image_bytes(image_path: str) -> bytes:
+    """
+    OCRエンジンに渡す画像バイト列を取得
+    前処理が無効、または失敗した場合は元ファイルをそのまま返す
+    """
+    if OCR_PREPROCESS_ENABLED:
+        try:
+            return preprocess_image_file(image_path)
+        except Exception as e:
+            print(f"画像前処理エラー（元画像を使用）: {e}")
+
+    with open(image_path, 'rb') as f:
+        return f.read()
+
+
+def load_ocr_image(image_path: str) -> Image.Image:
+    """
+    Tesseract 用に前処理済みの PIL 画像を取得
+    """
+    if not OCR_PREPROCESS_ENABLED:
+        return Image.open(image_path)
+    try:
+        with decode_slot():
+            with open_reduced(image_path, OCR_MAX_LONG_EDGE, _decode_mode()) as image:
+                return preprocess_image(image)
+    except Exception as e:
+        print(f"画像前処理エラー（元画像を使用）: {e}")
+        return Image.open(image_path)
+
+
+def get_decode_stats() -> Dict:
+    """画像デコードの件数・待ち回数など（プロセス単位）"""
+    with _decode_stats_lock:
+        stats = dict(_decode_stats)
+    stats['concurrency'] = OCR_DECODE_CONCURRENCY
+    return stats
@@ -64,12 +64,18 @@ ACCOUNT_SUBJECTS = {
     '接待交際費': {'type': '費用', 'category': '販売費及び一般管理費'},
     '会議費': {'type': '費用', 'category': '販売費及び一般管理費'},
     '新聞図書費': {'type': '費用', 'category': '販売費及び一般管理費'},
+    '研修費': {'type': '費用', 'category': '販売費及び一般管理費'},
     '修繕費': {'type': '費用', 'category': '販売費及び一般管理費'},
     '車両費': {'type': '費用', 'category': '販売費及び一般管理費'},
     '雑費': {'type': '費用', 'category': '販売費及び一般管理費'},
     '支払利息': {'type': '費用', 'category': '営業外費用'},
 }
 
+# AIの選択肢（ai_helper.ACCOUNT_SUBJECTS）と勘定科目マスタで名前が違うもの
+ACCOUNT_SUBJECT_ALIASES = {
+    '保険料': '支払保険料',
+}
+
 
 # キーワードベースの勘定科目推定ルール
 KEYWORD_RULES = {
@@ -124,7 +130,8 @@ def estimate_account_subject(
     ocr_text: Optional[str] = None,
     use_ai: bool = False,
     ai_model: Optional[str] = None,
-    api_keys: Optional[Dict] = None
+    api_keys: Optional[Dict] = None,
+    tenant_id: Optional[int] = None
 ) -> Tuple[str, str]:
     """
     摘要と金額から勘定科目を推定
@@ -137,6 +144,7 @@ def estimate_account_subject(
         use_ai: AIを使用するか
         ai_model: AIモデル名
         api_keys: APIキーの辞書
+        tenant_id: テナントID（AI応答のキャッシュをテナントごとに分ける）
     
     Returns:
         (推定された勘定科目, 摘要)
@@ -150,7 +158,8 @@ def estimate_account_subject(
                 company_name,
                 amount,
                 ai_model,
-                api_keys
+                api_keys,
+                tenant_id=tenant_id
             )
             return result['account_subject'], result['description']
         except Exception as e:
@@ -183,7 +192,7 @@ def generate_journal_entry(
     証憑データから仕訳を自動生成
     
     Args:
-        voucher_data: 証憑データ
+        voucher_data: 証憑データ（'勘定科目' があれば証憑処理でAIが推定した科目として使う）
         company_data: 企業情報データ（任意）
         payment_method: 支払方法（現金、普通預金など）
     
@@ -199,8 +208,11 @@ def generate_journal_entry(
     description = voucher_data.get('摘要', '')
     company_name = company_data.get('会社名', '') if company_data else ''
     
-    # 勘定科目の推定
-    expense_subject = estimate_account_subject(description, amount, company_name)
+    # 勘定科目: 証憑処理で推定済みならそれを使い、無ければキーワードで推定
+    expense_subject = voucher_data.get('勘定科目')
+    expense_subject = ACCOUNT_SUBJECT_ALIASES.get(expense_subject, expense_subject)
+    if expense_subject not in ACCOUNT_SUBJECTS:
+        expense_subject, _ = estimate_account_subject(description, amount, company_name)
     
     # 仕訳の生成（借方：費用、貸方：現金/預金）
     journal_entry = {
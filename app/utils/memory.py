@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+プロセスのメモリ使用量（RSS）
+ワーカーのジョブごとのピークRSSをログに出すために使う
+
+Linux では /proc/self/clear_refs に '5' を書くとピークRSS（VmHWM）をリセットできるので、
+ジョブ開始時にリセットして終了時に読めばそのジョブ中のピークになる。
+リセットできない環境ではプロセス起動以降のピーク（ru_maxrss）を返す。
+"""
+
+import sys
+from typing import Optional
+
+
+def _read_status_kb(field: str) -> Optional[int]:
+    """/proc/self/status の値（kB）"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def reset_peak_rss() -> bool:
+    """ピークRSSを現在のRSSにリセット（できなければFalse）"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb() -> Optional[float]:
+    """ピークRSS（MB）"""
+    kb = _read_status_kb('VmHWM')
+    if kb is None:
+        try:
+            import resource
+        except ImportError:
+            return None
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS はバイト単位、Linux は kB 単位
+        kb = maxrss // 1024 if sys.platform == 'darwin' else maxrss
+    return round(kb / 1024, 1)
+
+
+def current_rss_mb() -> Optional[float]:
+    """現在のRSS（MB）"""
+    kb = _read_status_kb('VmRSS')
+    return round(kb / 1024, 1) if kb is not None else None
@@ -3,13 +3,157 @@
 国税庁インボイス登録番号検索API連携ユーティリティ
 """
 
-import requests
+import os
+import time
 from typing import Dict, Optional, List
 import re
 
+import requests
+
+from .timing import timed
+from .http_clients import READ_TIMEOUTS, http_request
+from .nta_cache import get_cached_lookup, make_nta_cache_key, store_lookup
+from .nta_mirror import NTA_MIRROR_FALLBACK, lookup_number, mirror_available, search_name
+from .singleflight import SingleFlight
+from .resilience import (CircuitBreaker, CircuitOpenError, RateLimitedError, RetryBudget,
+                         TokenBucket, backoff_delay)
+
+
+# 国税庁Web-APIの呼び出し制限（プロセス単位。契約・利用規約の上限をワーカー数で割った値にする）
+NTA_RATE_LIMIT = float(os.environ.get('NTA_RATE_LIMIT', '10'))
+NTA_RATE_BURST = int(os.environ.get('NTA_RATE_BURST', '10'))
+# トークンが無いときに待つ上限秒数
+NTA_RATE_WAIT = float(os.environ.get('NTA_RATE_WAIT', '2'))
+# 通信エラー・タイムアウト・429・5xx の再試行回数と、1回の検索にかける時間の上限
+NTA_MAX_RETRIES = int(os.environ.get('NTA_MAX_RETRIES', '2'))
+NTA_CALL_DEADLINE = float(os.environ.get('NTA_CALL_DEADLINE', '8'))
+NTA_BACKOFF_BASE = float(os.environ.get('NTA_BACKOFF_BASE', '0.2'))
+NTA_BACKOFF_CAP = float(os.environ.get('NTA_BACKOFF_CAP', '2'))
+# 再試行はリクエスト数のこの割合まで
+NTA_RETRY_BUDGET_RATIO = float(os.environ.get('NTA_RETRY_BUDGET_RATIO', '0.2'))
+# 連続でこの回数失敗したら NTA_BREAKER_RESET 秒間は呼び出さずに失敗させる
+NTA_BREAKER_FAILURES = int(os.environ.get('NTA_BREAKER_FAILURES', '5'))
+NTA_BREAKER_RESET = float(os.environ.get('NTA_BREAKER_RESET', '30'))
+
+_rate_limiter = TokenBucket(NTA_RATE_LIMIT, NTA_RATE_BURST)
+_retry_budget = RetryBudget(NTA_RETRY_BUDGET_RATIO)
+_breaker = CircuitBreaker('nta', NTA_BREAKER_FAILURES, NTA_BREAKER_RESET)
+
+
+# 都道府県（JIS X 0401 の都道府県コード順。コード = 添字 + 1）
+PREFECTURES = [
+    '北海道', '青森県', '岩手県', '宮城県', '秋田県', '山形県', '福島県',
+    '茨城県', '栃木県', '群馬県', '埼玉県', '千葉県', '東京都', '神奈川県',
+    '新潟県', '富山県', '石川県', '福井県', '山梨県', '長野県', '岐阜県',
+    '静岡県', '愛知県', '三重県', '滋賀県', '京都府', '大阪府', '兵庫県',
+    '奈良県', '和歌山県', '鳥取県', '島根県', '岡山県', '広島県', '山口県',
+    '徳島県', '香川県', '愛媛県', '高知県', '福岡県', '佐賀県', '長崎県',
+    '熊本県', '大分県', '宮崎県', '鹿児島県', '沖縄県'
+]
+
+# 同時アップロードで同じ番号・会社名を検索する場合に、ミラー・キャッシュ・Web-API の検索を1回にまとめる
+_lookups = SingleFlight()
+
+
+def _copy_result(result):
+    """相乗りした呼び出し元どうしで同じ辞書を共有しないよう複製する"""
+    if isinstance(result, list):
+        return [dict(item) for item in result]
+    return dict(result) if result is not None else None
+
+
+def _retry_after(response) -> Optional[float]:
+    """Retry-After ヘッダー（秒数）"""
+    value = response.headers.get('Retry-After', '')
+    return float(value) if value.replace('.', '', 1).isdigit() else None
+
+
+def _nta_get(url: str, params: Dict):
+    """
+    国税庁Web-APIへの GET（レート制限・再試行・サーキットブレーカー付き）
+
+    通信エラー・タイムアウト・429・5xx は NTA_CALL_DEADLINE 秒の範囲で
+    ジッター付き指数バックオフで再試行する。再試行しても失敗した場合は
+    サーキットブレーカーに失敗として記録する（429 は混雑なので失敗に数えない）
+
+    Returns:
+        requests.Response（再試行しても 429・5xx の場合はその応答）
+
+    Raises:
+        RateLimitedError: 待ち時間内にレート制限のトークンを得られなかった
+        CircuitOpenError: 国税庁APIが異常とみなされている
+        requests.RequestException: 再試行しても通信エラー・タイムアウトだった
+    """
+    # open 中はトークンを使わず、待たずに失敗させる
+    if not _breaker.allow():
+        raise CircuitOpenError('国税庁APIが応答しないため一時的に呼び出しを停止しています')
+    if not _rate_limiter.acquire(timeout=NTA_RATE_WAIT):
+        _breaker.release()
+        raise RateLimitedError('国税庁APIの呼び出し上限に達しています')
+    _retry_budget.deposit()
+
+    deadline = time.monotonic() + NTA_CALL_DEADLINE
+    attempt = 0
+    while True:
+        attempt += 1
+        remaining = deadline - time.monotonic()
+        error = None
+        response = None
+        try:
+            response = http_request('nta', 'GET', url, params=params,
+                                    read_timeout=max(0.5, min(remaining, READ_TIMEOUTS['nta'])))
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            error = e
+        except Exception:
+            _breaker.record_failure()
+            raise
+
+        if response is not None and response.status_code != 429 and response.status_code < 500:
+            _breaker.record_success()
+            return response
+
+        delay = backoff_delay(attempt, NTA_BACKOFF_BASE, NTA_BACKOFF_CAP)
+        if response is not None:
+            delay = max(delay, min(_retry_after(response) or 0, NTA_BACKOFF_CAP))
+        give_up = (
+            attempt > NTA_MAX_RETRIES
+            or time.monotonic() + delay >= deadline
+            or not _retry_budget.withdraw()
+            or not _rate_limiter.acquire(timeout=0)
+        )
+        if give_up:
+            if response is not None and response.status_code == 429:
+                _breaker.record_success()
+            else:
+                _breaker.record_failure()
+            if error is not None:
+                raise error
+            return response
+        time.sleep(delay)
+
+
+def get_nta_resilience_stats() -> Dict:
+    """サーキットブレーカーの状態・拒否件数、レート制限と再試行予算の状況"""
+    return {
+        'breaker': _breaker.stats(),
+        'rate_limiter': _rate_limiter.stats(),
+        'retry_budget': _retry_budget.stats(),
+        'max_retries': NTA_MAX_RETRIES,
+        'call_deadline': NTA_CALL_DEADLINE,
+    }
+
+
+def get_lookup_flight_stats() -> Dict:
+    """検索の実行回数と、実行中の検索に相乗りした回数"""
+    return _lookups.stats()
+
 
 class NTAInvoiceAPI:
-    """国税庁インボイス登録番号検索APIクライアント"""
+    """
+    国税庁インボイス登録番号検索APIクライアント
+    ローカルミラー（nta_mirror）を最初に引き、無い場合だけ Web-API に問い合わせる
+    Web-API の検索結果（見つからなかった結果も含む）は nta_cache に保存し、期限内はAPIを呼ばない
+    """
     
     # 国税庁インボイス登録番号公表サイトWeb-API
     INVOICE_BASE_URL = "https://web-api.invoice-kohyo.nta.go.jp"
@@ -25,6 +169,7 @@ class NTAInvoiceAPI:
         """
         self.api_id = api_id
     
+    @timed('nta.search_by_invoice_number')
     def search_by_invoice_number(self, invoice_number: str) -> Optional[Dict]:
         """
         インボイス登録番号で検索
@@ -44,6 +189,21 @@ class NTAInvoiceAPI:
         if not re.match(r'^\d{13}$', number):
             return None
         
+        return _copy_result(_lookups.do(('invoice', number, self.api_id),
+                                        lambda: self._lookup_invoice_number(number)))
+    
+    def _lookup_invoice_number(self, number: str) -> Optional[Dict]:
+        """ミラー → キャッシュ → Web-API の順にインボイス登録番号（数字13桁）を検索"""
+        if mirror_available():
+            company = lookup_number(number, invoice=True)
+            if company or not NTA_MIRROR_FALLBACK:
+                return company
+        
+        cache_key = make_nta_cache_key('invoice', number)
+        hit, cached = get_cached_lookup(cache_key)
+        if hit:
+            return cached
+        
         try:
             # 国税庁APIエンドポイント（実際のエンドポイントに合わせて調整）
             url = f"{self.INVOICE_BASE_URL}/4/num"
@@ -53,14 +213,17 @@ class NTAInvoiceAPI:
                 'type': '12',  # 法人番号指定
             }
             
-            response = requests.get(url, params=params, timeout=10)
+            response = _nta_get(url, params)
             
             if response.status_code == 200:
                 data = response.json()
                 
                 # レスポンスデータの解析
+                result = None
                 if data and 'count' in data and data['count'] > 0:
-                    return self._parse_response(data)
+                    result = self._parse_response(data)
+                store_lookup(cache_key, result)
+                return result
             
             return None
             
@@ -68,6 +231,7 @@ class NTAInvoiceAPI:
             print(f"国税庁API検索エラー: {e}")
             return None
     
+    @timed('nta.search_by_corporate_number')
     def search_by_corporate_number(self, corporate_number: str) -> Optional[Dict]:
         """
         法人番号で検索
@@ -85,6 +249,29 @@ class NTAInvoiceAPI:
         if not re.match(r'^\d{13}$', number):
             return None
         
+        return _copy_result(_lookups.do(('corporate', number, self.api_id),
+                                        lambda: self._lookup_corporate_number(number)))
+    
+    def _lookup_corporate_number(self, number: str) -> Optional[Dict]:
+        """
+        ミラー → キャッシュ → Web-API の順に法人番号を検索
+        ミラーにインボイスの情報が無い（インボイス登録有無が不明な）ときは、フォールバックが有効なら Web-API の結果を使う
+        （Web-API で見つからない・失敗したときはミラーの結果を返す）
+        """
+        mirror_company = None
+        if mirror_available():
+            company = lookup_number(number, invoice=False)
+            if not NTA_MIRROR_FALLBACK:
+                return company
+            if company and company['インボイス登録有無'] is not None:
+                return company
+            mirror_company = company
+        
+        cache_key = make_nta_cache_key('corporate', number)
+        hit, cached = get_cached_lookup(cache_key)
+        if hit:
+            return cached or mirror_company
+        
         try:
             url = f"{self.INVOICE_BASE_URL}/4/num"
             params = {
@@ -93,20 +280,24 @@ class NTAInvoiceAPI:
                 'type': '12',
             }
             
-            response = requests.get(url, params=params, timeout=10)
+            response = _nta_get(url, params)
             
             if response.status_code == 200:
                 data = response.json()
                 
+                result = None
                 if data and 'count' in data and data['count'] > 0:
-                    return self._parse_response(data)
+                    result = self._parse_response(data)
+                store_lookup(cache_key, result)
+                return result or mirror_company
             
-            return None
+            return mirror_company
             
         except Exception as e:
             print(f"国税庁API検索エラー: {e}")
-            return None
+            return mirror_company
     
+    @timed('nta.search_by_name')
     def search_by_name(self, company_name: str, prefecture: Optional[str] = None) -> List[Dict]:
         """
         会社名で検索
@@ -118,6 +309,21 @@ class NTAInvoiceAPI:
         Returns:
             企業情報のリスト
         """
+        key = ('name', make_nta_cache_key('name', company_name, prefecture), self.api_id)
+        return _copy_result(_lookups.do(key, lambda: self._lookup_name(company_name, prefecture)))
+    
+    def _lookup_name(self, company_name: str, prefecture: Optional[str]) -> List[Dict]:
+        """ミラー → キャッシュ → Web-API の順に会社名を検索"""
+        if mirror_available():
+            results = search_name(company_name, prefecture)
+            if results or not NTA_MIRROR_FALLBACK:
+                return results
+        
+        cache_key = make_nta_cache_key('name', company_name, prefecture)
+        hit, cached = get_cached_lookup(cache_key)
+        if hit:
+            return list(cached or [])
+        
         try:
             url = f"{self.INVOICE_BASE_URL}/4/name"
             params = {
@@ -129,18 +335,19 @@ class NTAInvoiceAPI:
             if prefecture:
                 params['address'] = prefecture
             
-            response = requests.get(url, params=params, timeout=10)
+            response = _nta_get(url, params)
             
             if response.status_code == 200:
                 data = response.json()
                 
+                results = []
                 if data and 'count' in data and data['count'] > 0:
-                    results = []
                     for item in data.get('corporations', []):
                         parsed = self._parse_corporation_data(item)
                         if parsed:
                             results.append(parsed)
-                    return results
+                store_lookup(cache_key, results)
+                return results
             
             return []
             
@@ -299,17 +506,7 @@ def extract_prefecture_from_address(address: str) -> Optional[str]:
     Returns:
         都道府県名
     """
-    prefectures = [
-        '北海道', '青森県', '岩手県', '宮城県', '秋田県', '山形県', '福島県',
-        '茨城県', '栃木県', '群馬県', '埼玉県', '千葉県', '東京都', '神奈川県',
-        '新潟県', '富山県', '石川県', '福井県', '山梨県', '長野県', '岐阜県',
-        '静岡県', '愛知県', '三重県', '滋賀県', '京都府', '大阪府', '兵庫県',
-        '奈良県', '和歌山県', '鳥取県', '島根県', '岡山県', '広島県', '山口県',
-        '徳島県', '香川県', '愛媛県', '高知県', '福岡県', '佐賀県', '長崎県',
-        '熊本県', '大分県', '宮崎県', '鹿児島県', '沖縄県'
-    ]
-    
-    for prefecture in prefectures:
+    for prefecture in PREFECTURES:
         if prefecture in address:
             return prefecture
     
@@ -380,18 +577,8 @@ def search_company_by_address(address: str, api_id: Optional[str] = None) -> Lis
         企業情報のリスト
     """
     # 都道府県を抽出
-    prefectures = [
-        '北海道', '青森県', '岩手県', '宮城県', '秋田県', '山形県', '福島県',
-        '茨城県', '栃木県', '群馬県', '埼玉県', '千葉県', '東京都', '神奈川県',
-        '新潟県', '富山県', '石川県', '福井県', '山梨県', '長野県', '岐阜県',
-        '静岡県', '愛知県', '三重県', '滋賀県', '京都府', '大阪府', '兵庫県',
-        '奈良県', '和歌山県', '鳥取県', '島根県', '岡山県', '広島県', '山口県',
-        '徳島県', '香川県', '愛媛県', '高知県', '福岡県', '佐賀県', '長崎県',
-        '熊本県', '大分県', '宮崎県', '鹿児島県', '沖縄県'
-    ]
-    
     prefecture = None
-    for pref in prefectures:
+    for pref in PREFECTURES:
         if pref in address:
             prefecture = pref
             break
@@ -3,26 +3,78 @@
 電話番号・住所から法人番号を検索し、インボイス番号を取得する
 """
 
-import requests
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Optional, List, Tuple
 import re
-from .nta_api import NTAInvoiceAPI, extract_prefecture_from_address
+from .nta_api import NTAInvoiceAPI, extract_prefecture_from_address, get_lookup_flight_stats
+from .company_index import COMPANY_INDEX_TRUST_SCORE, match_company
+from .timing import span, timed
 
 
+# 1件の証憑で並行して実行する国税庁検索のスレッド数（プロセス全体で共有）
+NTA_LOOKUP_WORKERS = int(os.environ.get('NTA_LOOKUP_WORKERS', '8'))
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_pid: Optional[int] = None
+_executor_lock = threading.Lock()
+
+_stats = {'searches': 0, 'parallel': 0, 'coalesced': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(key: str) -> None:
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """検索用スレッドプール（fork 後の子プロセスでは作り直す）"""
+    global _executor, _executor_pid
+    pid = os.getpid()
+    with _executor_lock:
+        if _executor is None or _executor_pid != pid:
+            _executor = ThreadPoolExecutor(max_workers=max(1, NTA_LOOKUP_WORKERS),
+                                           thread_name_prefix='nta-lookup')
+            _executor_pid = pid
+        return _executor
+
+
+def _submit(func, *args):
+    """呼び出し元のトレースにスパンが記録されるよう、コンテキストごと別スレッドで実行"""
+    context = contextvars.copy_context()
+    return _get_executor().submit(context.run, func, *args)
+
+
+def _digits(number: Optional[str]) -> str:
+    """インボイス登録番号・法人番号から13桁の数字部分を取り出す"""
+    return (number or '').strip().upper().lstrip('T').replace('-', '').replace(' ', '')
+
+
+@timed('nta.search_corporate_number_by_contact')
 def search_corporate_number_by_contact(
     phone_number: Optional[str] = None,
     address: Optional[str] = None,
     company_name: Optional[str] = None,
-    api_id: Optional[str] = None
+    api_id: Optional[str] = None,
+    tenant_id: Optional[int] = None
 ) -> Optional[str]:
     """
     電話番号・住所・会社名から法人番号を検索
     
+    会社名はまずテナントの登録済み企業（T_企業情報）からあいまい検索する
+    - 類似度が COMPANY_INDEX_TRUST_SCORE 以上ならその企業の番号を使い、国税庁APIは呼ばない
+    - それ未満なら国税庁APIの会社名検索も行い、結果に登録済み企業の番号があればそれを、
+      無ければ国税庁APIの先頭の候補を使う（国税庁APIで見つからなければ登録済み企業の番号）
+    
     Args:
         phone_number: 電話番号
         address: 住所
         company_name: 会社名
         api_id: APIのID
+        tenant_id: テナントID（指定時は登録済み企業を先に探す）
     
     Returns:
         法人番号（13桁）、見つからない場合はNone
@@ -35,11 +87,27 @@ def search_corporate_number_by_contact(
         if address:
             prefecture = extract_prefecture_from_address(address)
         
+        local_number = None
+        if tenant_id is not None:
+            with span('nta.local_company_match'):
+                local = match_company(tenant_id, company_name, prefecture)
+            # 番号の無い企業は国税庁APIで番号を探す
+            number = _digits(local[0]['法人番号'] or local[0]['インボイス登録番号']) if local else ''
+            if len(number) == 13 and number.isdigit():
+                if local[0]['score'] >= COMPANY_INDEX_TRUST_SCORE:
+                    return number
+                local_number = number
+        
         results = api.search_by_name(company_name, prefecture)
         
         if results and len(results) > 0:
-            # 最初の候補の法人番号を返す
+            # 登録済み企業が候補に含まれていればそれを優先し、無ければ最初の候補の法人番号を返す
+            if local_number and any(result.get('法人番号') == local_number for result in results):
+                return local_number
             return results[0].get('法人番号')
+        
+        if local_number:
+            return local_number
     
     # TODO: 電話番号や住所のみでの検索は国税庁APIでは直接サポートされていないため、
     # 別の企業データベースAPIを使用するか、会社名の推定が必要
@@ -47,6 +115,7 @@ def search_corporate_number_by_contact(
     return None
 
 
+@timed('nta.search_invoice_by_corporate_number')
 def search_invoice_by_corporate_number(
     corporate_number: str,
     api_id: Optional[str] = None
@@ -92,9 +161,11 @@ def verify_invoice_number(
         return False, f"警告: OCRで読み取ったインボイス番号（{ocr_invoice_number}）と検索結果（{searched_invoice_number}）が一致しません"
 
 
+@timed('nta.enhanced_company_search')
 def enhanced_company_search(
     ocr_result: Dict,
-    api_id: Optional[str] = None
+    api_id: Optional[str] = None,
+    tenant_id: Optional[int] = None
 ) -> Dict:
     """
     OCR結果から企業情報を検索（拡張版）
@@ -105,9 +176,14 @@ def enhanced_company_search(
     3. 法人番号からインボイス番号を検索
     4. OCRで読み取った番号と検索結果を照合
     
+    1 と 2 は互いに依存しないので並行して実行し、3 は 2 の結果を待って実行する。
+    2 で見つかった法人番号が 1 の番号と同じなら、3 は実行せず 1 の結果を使う（同じ番号の再検索になるため）。
+    同じ番号・会社名の検索が他のアップロードで実行中の場合は NTAInvoiceAPI 側で1回にまとめられる。
+    
     Args:
         ocr_result: OCR結果の辞書
         api_id: APIのID
+        tenant_id: テナントID（会社名を登録済み企業から先に探す）
     
     Returns:
         検索結果の辞書
@@ -120,31 +196,44 @@ def enhanced_company_search(
         'verification_passed': True,
         'warning_message': None,
     }
+    _count('searches')
     
-    # 1. OCRでインボイス番号が読み取れた場合
+    # 1. OCRでインボイス番号が読み取れた場合（2 と並行して実行）
     ocr_invoice = ocr_result.get('invoice_number')
-    if ocr_invoice:
-        api = NTAInvoiceAPI(api_id)
-        company_info = api.search_by_invoice_number(ocr_invoice)
-        
-        if company_info:
-            result['company_info'] = company_info
-            result['invoice_number'] = company_info.get('インボイス登録番号')
-            result['corporate_number'] = company_info.get('法人番号')
-    
-    # 2. 電話番号・住所・会社名から法人番号を検索
+    api = NTAInvoiceAPI(api_id)
+    company_name = ocr_result.get('company_name')
+    invoice_future = None
+    if ocr_invoice and company_name:
+        invoice_future = _submit(api.search_by_invoice_number, ocr_invoice)
+        _count('parallel')
+
+    # 2. 電話番号・住所・会社名から法人番号を検索（呼び出し元のスレッドで実行）
     corporate_number = search_corporate_number_by_contact(
         phone_number=ocr_result.get('phone_numbers', [None])[0] if ocr_result.get('phone_numbers') else None,
         address=ocr_result.get('addresses', [None])[0] if ocr_result.get('addresses') else None,
-        company_name=ocr_result.get('company_name'),
-        api_id=api_id
+        company_name=company_name,
+        api_id=api_id,
+        tenant_id=tenant_id
     )
     
+    if invoice_future:
+        invoice_info = invoice_future.result()
+    else:
+        invoice_info = api.search_by_invoice_number(ocr_invoice) if ocr_invoice else None
+    if invoice_info:
+        result['company_info'] = invoice_info
+        result['invoice_number'] = invoice_info.get('インボイス登録番号')
+        result['corporate_number'] = invoice_info.get('法人番号')
+    
     if corporate_number:
         result['corporate_number'] = corporate_number
         
-        # 3. 法人番号からインボイス番号を検索
-        company_info = search_invoice_by_corporate_number(corporate_number, api_id)
+        # 3. 法人番号からインボイス番号を検索（1 で同じ番号を取得済みならその結果を使う）
+        if invoice_info and _digits(invoice_info.get('法人番号') or ocr_invoice) == _digits(corporate_number):
+            company_info = invoice_info
+            _count('coalesced')
+        else:
+            company_info = search_invoice_by_corporate_number(corporate_number, api_id)
         
         if company_info:
             if not result['company_info']:
@@ -164,3 +253,11 @@ def enhanced_company_search(
                 result['invoice_number'] = searched_invoice
     
     return result
+
+
+def get_nta_lookup_stats() -> Dict:
+    """拡張検索の件数（並行実行・同じ番号の再検索を省いた回数）と、検索の相乗り回数"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['single_flight'] = get_lookup_flight_stats()
+    return stats
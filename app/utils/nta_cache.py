@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+国税庁API検索結果キャッシュ
+インボイス登録番号・法人番号・会社名（正規化）+都道府県をキーに、検索結果を期限付きで保存する
+
+同じコンビニチェーンやタクシー会社など、何度も解決済みの取引先で国税庁APIを呼ばずに済ませる。
+- 1段目: プロセス内 LRU（NTA_CACHE_LRU_SIZE 件）
+- 2段目: T_国税庁キャッシュ テーブル（全プロセス共有）
+- 見つからなかった結果も NTA_CACHE_NEGATIVE_TTL 秒だけ保存する
+  （OCRの誤読で存在しない番号になった場合に、同じ番号で何度もAPIを呼ばない）
+- 通信エラーや 200 以外の応答は保存しない
+- 期限切れの行はワーカーの定期処理（app.worker.maintain_caches）で削除する
+"""
+
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from .db import get_db, _sql
+
+
+NTA_CACHE_ENABLED = os.environ.get('NTA_CACHE_ENABLED', '1') in ('1', 'true', 'True')
+NTA_CACHE_TTL = int(os.environ.get('NTA_CACHE_TTL', str(7 * 24 * 3600)))
+NTA_CACHE_NEGATIVE_TTL = int(os.environ.get('NTA_CACHE_NEGATIVE_TTL', str(24 * 3600)))
+NTA_CACHE_LRU_SIZE = int(os.environ.get('NTA_CACHE_LRU_SIZE', '1024'))
+
+# ヒット/ミス集計（プロセス単位）
+_stats = {
+    'memory_hits': 0,
+    'db_hits': 0,
+    'negative_hits': 0,
+    'misses': 0,
+    'stores': 0,
+    'errors': 0,
+}
+_stats_lock = threading.Lock()
+
+# キー → (期限のエポック秒, 結果)
+_lru: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+_lru_lock = threading.Lock()
+
+# 会社名の表記ゆれ（NFKC 正規化後）
+_COMPANY_ABBREVIATIONS = {
+    '(株)': '株式会社',
+    '(有)': '有限会社',
+    '(合)': '合同会社',
+    '(資)': '合資会社',
+    '(名)': '合名会社',
+}
+
+
+def _count(name: str) -> None:
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def normalize_company_name(name: str) -> str:
+    """キャッシュキー用に会社名を正規化（全角半角・略称・空白の違いを吸収）"""
+    normalized = unicodedata.normalize('NFKC', name or '')
+    for abbreviation, full in _COMPANY_ABBREVIATIONS.items():
+        normalized = normalized.replace(abbreviation, full)
+    return re.sub(r'\s+', '', normalized).lower()
+
+
+def make_nta_cache_key(kind: str, value: str, prefecture: Optional[str] = None) -> str:
+    """
+    キャッシュキー
+
+    Args:
+        kind: 'invoice'（インボイス登録番号）/ 'corporate'（法人番号）/ 'name'（会社名）
+        value: 13桁の番号、または会社名
+        prefecture: 会社名検索の都道府県
+    """
+    if kind == 'name':
+        return f"name:{normalize_company_name(value)}|{prefecture or ''}"
+    return f"{kind}:{value}"
+
+
+def _lru_get(key: str) -> Optional[Tuple[float, Any]]:
+    with _lru_lock:
+        entry = _lru.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del _lru[key]
+            return None
+        _lru.move_to_end(key)
+        return entry
+
+
+def _lru_put(key: str, expires_at: float, result: Any) -> None:
+    if NTA_CACHE_LRU_SIZE <= 0:
+        return
+    with _lru_lock:
+        _lru[key] = (expires_at, result)
+        _lru.move_to_end(key)
+        while len(_lru) > NTA_CACHE_LRU_SIZE:
+            _lru.popitem(last=False)
+
+
+def _is_negative(result: Any) -> bool:
+    return result is None or result == []
+
+
+def get_cached_lookup(key: str) -> Tuple[bool, Any]:
+    """
+    キャッシュから検索結果を取得
+
+    Returns:
+        (ヒットしたか, 結果)。「見つからない」を保存したエントリは (True, None または [])
+    """
+    if not NTA_CACHE_ENABLED:
+        return False, None
+
+    entry = _lru_get(key)
+    if entry is not None:
+        _count('negative_hits' if _is_negative(entry[1]) else 'memory_hits')
+        return True, entry[1]
+
+    try:
+        conn = get_db()
+        try:
+            cur = conn.cursor()
+            cur.execute(_sql(conn, '''
+                SELECT result, expires_at FROM "T_国税庁キャッシュ"
+                WHERE cache_key = %s AND expires_at > %s
+            '''), (key, time.time()))
+            row = cur.fetchone()
+            if row:
+                cur.execute(_sql(conn, '''
+                    UPDATE "T_国税庁キャッシュ"
+                    SET hit_count = hit_count + 1, last_hit_at = CURRENT_TIMESTAMP
+                    WHERE cache_key = %s
+                '''), (key,))
+                if hasattr(conn, 'commit'):
+                    conn.commit()
+        finally:
+            conn.close()
+    except Exception as e:
+        _count('errors')
+        print(f"国税庁キャッシュ取得エラー: {e}")
+        return False, None
+
+    if not row:
+        _count('misses')
+        return False, None
+
+    result = json.loads(row[0]) if row[0] else None
+    _lru_put(key, float(row[1]), result)
+    _count('negative_hits' if _is_negative(result) else 'db_hits')
+    return True, result
+
+
+def store_lookup(key: str, result: Any) -> None:
+    """
+    検索結果をキャッシュに保存（既存キーは上書き）
+
+    Args:
+        key: make_nta_cache_key の値
+        result: 企業情報の辞書・リスト。見つからなかった場合は None または []
+    """
+    if not NTA_CACHE_ENABLED:
+        return
+
+    negative = _is_negative(result)
+    expires_at = time.time() + (NTA_CACHE_NEGATIVE_TTL if negative else NTA_CACHE_TTL)
+    result_json = None if result is None else json.dumps(result, ensure_ascii=False)
+
+    try:
+        conn = get_db()
+        try:
+            cur = conn.cursor()
+            cur.execute(_sql(conn, '''
+                INSERT INTO "T_国税庁キャッシュ" (cache_key, result, found, expires_at)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (cache_key) DO UPDATE SET
+                    result = excluded.result,
+                    found = excluded.found,
+                    expires_at = excluded.expires_at,
+                    created_at = CURRENT_TIMESTAMP
+            '''), (key, result_json, 0 if negative else 1, expires_at))
+            if hasattr(conn, 'commit'):
+                conn.commit()
+        finally:
+            conn.close()
+    except Exception as e:
+        _count('errors')
+        print(f"国税庁キャッシュ保存エラー: {e}")
+        return
+
+    _lru_put(key, expires_at, result)
+    _count('stores')
+
+
+def purge_expired_nta_cache() -> int:
+    """期限切れのエントリを削除し、削除件数を返す"""
+    conn = get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute(_sql(conn, 'DELETE FROM "T_国税庁キャッシュ" WHERE expires_at <= %s'), (time.time(),))
+        deleted = cur.rowcount
+        if hasattr(conn, 'commit'):
+            conn.commit()
+    finally:
+        conn.close()
+    return deleted
+
+
+def get_nta_cache_stats() -> Dict:
+    """キャッシュのヒット率などの集計値"""
+    with _stats_lock:
+        stats = dict(_stats)
+    hits = stats['memory_hits'] + stats['db_hits'] + stats['negative_hits']
+    lookups = hits + stats['misses']
+    stats['hit_ratio'] = round(hits / lookups, 3) if lookups else None
+    stats['lru_entries'] = len(_lru)
+    stats['lru_capacity'] = NTA_CACHE_LRU_SIZE
+    stats['ttl'] = NTA_CACHE_TTL
+    stats['negative_ttl'] = NTA_CACHE_NEGATIVE_TTL
+    return stats
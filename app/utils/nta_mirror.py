@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+"""
+国税庁データのローカルミラー
+法人番号公表サイト・インボイス制度公表サイトの一括ダウンロードファイル（CSV / XML、zip 可）を
+T_国税庁ミラー に取り込み、NTAInvoiceAPI の一次情報源にする
+
+- 取込はファイルを1行（1要素）ずつ読み、NTA_MIRROR_BATCH_SIZE 件ごとにまとめて書き込む
+  （PostgreSQL は execute_values の複数行 INSERT、SQLite は executemany）
+- 全件ファイルも差分ファイルも同じ処理で、番号ごとに UPSERT する
+  差分の「削除」は行を消し、インボイスの失効・取消は登録なし（invoice_registered = 0）にする
+- 取り込んだファイル名を T_国税庁ミラー取込 に記録し、同じ差分を二重に適用しない
+- ミラーに無い番号・会社名は、NTA_MIRROR_FALLBACK が有効ならキャッシュ・Web-API に問い合わせる
+- インボイスのファイルを一度も取り込んでいない間は、行にインボイスの情報が無くても「登録なし」とは限らないため、
+  検索結果のインボイス登録有無を None（不明）にする
+
+1つの行に法人番号の情報とインボイス登録の情報をまとめる。
+法人のインボイス登録番号は T + 法人番号、個人事業者は法人番号と重ならない13桁の番号なので、
+どちらも corporate_number 列（13桁）をキーにする。
+"""
+
+import csv
+import io
+import os
+import threading
+import time
+import zipfile
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from xml.etree import ElementTree
+
+from .db import get_db, _sql, _is_pg
+
+
+NTA_MIRROR_ENABLED = os.environ.get('NTA_MIRROR_ENABLED', '1') in ('1', 'true', 'True')
+NTA_MIRROR_FALLBACK = os.environ.get('NTA_MIRROR_FALLBACK', '1') in ('1', 'true', 'True')
+NTA_MIRROR_BATCH_SIZE = int(os.environ.get('NTA_MIRROR_BATCH_SIZE', '5000'))
+# ミラーにデータがあるかの確認結果を使い回す秒数
+_AVAILABILITY_TTL = 300
+
+# 法人番号公表サイト 全件・差分ファイル（CSV はヘッダ無し、XML は <corporation> 要素）の項目
+CORPORATE_COLUMNS = (
+    'sequenceNumber', 'corporateNumber', 'process', 'correct', 'updateDate', 'changeDate',
+    'name', 'nameImageId', 'kind', 'prefectureName', 'cityName', 'streetNumber',
+    'addressImageId', 'prefectureCode', 'cityCode', 'postCode', 'addressOutside',
+    'addressOutsideImageId', 'closeDate', 'closeCause', 'successorCorporateNumber',
+    'changeCause', 'assignmentDate', 'latest', 'enName', 'enPrefectureName', 'enCityName',
+    'enAddressOutside', 'furigana', 'hihyoji',
+)
+
+# インボイス制度公表サイト 全件・差分ファイル（CSV はヘッダ無し、XML は <announcement> 要素）の項目
+INVOICE_COLUMNS = (
+    'sequenceNumber', 'registratedNumber', 'process', 'correct', 'kind', 'country', 'latest',
+    'registrationDate', 'updateDate', 'disposalDate', 'expireDate', 'address',
+    'addressPrefectureCode', 'addressCityCode', 'addressRequest', 'addressRequestPrefectureCode',
+    'addressRequestCityCode', 'kana', 'name', 'addressInside', 'addressInsidePrefectureCode',
+    'addressInsideCityCode', 'tradeName', 'popularName_previousName',
+)
+
+SOURCES = {
+    'corporate': (CORPORATE_COLUMNS, 'corporation'),
+    'invoice': (INVOICE_COLUMNS, 'announcement'),
+}
+
+# 処理区分: 削除
+_PROCESS_DELETE = '99'
+
+_CORPORATE_FIELDS = ('corporate_number', 'name', 'name_normalized', 'kana', 'prefecture', 'city',
+                     'street', 'postal_code', 'kind', 'closed', 'updated_date')
+_INVOICE_FIELDS = ('corporate_number', 'name', 'name_normalized', 'kana', 'prefecture', 'street',
+                   'kind', 'invoice_registered', 'invoice_registration_date', 'invoice_end_date',
+                   'updated_date')
+
+_availability: Dict[str, float] = {'checked_at': 0.0, 'available': 0, 'invoice': 0}
+_stats = {'hits': 0, 'misses': 0, 'errors': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(key: str) -> None:
+    with _stats_lock:
+        _stats[key] += 1
+
+
+# ---- ファイルの読み込み ----
+
+def detect_source(path: str) -> str:
+    """ファイル名から種類（'corporate' / 'invoice'）を推定"""
+    name = os.path.basename(path).lower()
+    if 'invoice' in name or 'announcement' in name or 'tekikaku' in name:
+        return 'invoice'
+    return 'corporate'
+
+
+def _open_members(path: str, encoding: str) -> Iterator[Tuple[str, io.TextIOBase]]:
+    """ファイル（zip なら中の CSV / XML）を (名前, テキストストリーム) で順に返す"""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for member in archive.namelist():
+                if member.lower().endswith(('.csv', '.xml')):
+                    with archive.open(member) as raw:
+                        yield member, io.TextIOWrapper(raw, encoding=encoding, newline='')
+        return
+    with open(path, encoding=encoding, newline='') as f:
+        yield path, f
+
+
+def _iter_csv(stream, columns: Tuple[str, ...]) -> Iterator[Dict[str, str]]:
+    reader = csv.reader(stream)
+    for row in reader:
+        if not row:
+            continue
+        if row[0] == columns[0]:
+            # 見出し行付きのファイル
+            continue
+        yield dict(zip(columns, (value.strip() for value in row)))
+
+
+def _iter_xml(stream, element: str) -> Iterator[Dict[str, str]]:
+    """要素を1件ずつ読み、処理済みの要素は破棄してメモリを一定に保つ"""
+    for _, node in ElementTree.iterparse(stream, events=('end',)):
+        if node.tag == element:
+            yield {child.tag: (child.text or '').strip() for child in node}
+            node.clear()
+
+
+def iter_records(path: str, source: str, encoding: str = 'utf-8-sig') -> Iterator[Dict[str, str]]:
+    """ダウンロードファイルのレコードを順に返す"""
+    columns, element = SOURCES[source]
+    for member, stream in _open_members(path, encoding):
+        if member.lower().endswith('.xml'):
+            yield from _iter_xml(stream, element)
+        else:
+            yield from _iter_csv(stream, columns)
+
+
+# ---- レコード → 行 ----
+
+def _prefecture_from_code(code: str) -> Optional[str]:
+    from .nta_api import PREFECTURES
+
+    if code and code.isdigit() and 1 <= int(code) <= len(PREFECTURES):
+        return PREFECTURES[int(code) - 1]
+    return None
+
+
+def _corporate_row(record: Dict[str, str]) -> Tuple[str, str, Optional[Tuple]]:
+    """法人番号のレコード → (番号, 'upsert' / 'delete', 行)"""
+    from .nta_cache import normalize_company_name
+
+    number = record.get('corporateNumber', '')
+    if record.get('process') == _PROCESS_DELETE:
+        return number, 'delete', None
+    name = record.get('name') or None
+    return number, 'upsert', (
+        number,
+        name,
+        normalize_company_name(name) if name else None,
+        record.get('furigana') or None,
+        record.get('prefectureName') or None,
+        record.get('cityName') or None,
+        record.get('streetNumber') or None,
+        record.get('postCode') or None,
+        record.get('kind') or None,
+        1 if record.get('closeDate') else 0,
+        record.get('updateDate') or None,
+    )
+
+
+def _invoice_row(record: Dict[str, str]) -> Tuple[str, str, Optional[Tuple]]:
+    """インボイス登録のレコード → (番号, 'upsert' / 'end', 行)"""
+    from .nta_cache import normalize_company_name
+
+    number = record.get('registratedNumber', '').upper().lstrip('T')
+    end_date = record.get('disposalDate') or record.get('expireDate') or None
+    action = 'end' if record.get('process') == _PROCESS_DELETE else 'upsert'
+    name = record.get('name') or None
+    prefecture = _prefecture_from_code(record.get('addressPrefectureCode', ''))
+    address = record.get('address') or None
+    if address and prefecture and address.startswith(prefecture):
+        address = address[len(prefecture):]
+    return number, action, (
+        number,
+        name,
+        normalize_company_name(name) if name else None,
+        record.get('kana') or None,
+        prefecture,
+        address,
+        record.get('kind') or None,
+        0 if (end_date or action == 'end') else 1,
+        record.get('registrationDate') or None,
+        end_date,
+        record.get('updateDate') or None,
+    )
+
+
+# ---- 書き込み ----
+
+def _upsert_sql(source: str) -> Tuple[str, Tuple[str, ...]]:
+    """ミラーへの UPSERT 文（VALUES 句は呼び出し側で付ける）"""
+    if source == 'corporate':
+        fields = _CORPORATE_FIELDS
+        updates = ', '.join(f'{f} = excluded.{f}' for f in fields[1:])
+    else:
+        fields = _INVOICE_FIELDS
+        # 名称・所在地は法人番号側の情報を優先し、無い場合（個人事業者など）だけ埋める
+        keep = ('name', 'name_normalized', 'kana', 'prefecture', 'street', 'kind')
+        updates = ', '.join(
+            f'{f} = COALESCE("T_国税庁ミラー".{f}, excluded.{f})' if f in keep else f'{f} = excluded.{f}'
+            for f in fields[1:]
+        )
+    head = f'INSERT INTO "T_国税庁ミラー" ({", ".join(fields)}) VALUES'
+    tail = f'ON CONFLICT (corporate_number) DO UPDATE SET {updates}, imported_at = CURRENT_TIMESTAMP'
+    return f'{head} %s {tail}', fields
+
+
+def _write_batch(conn, source: str, batch: Dict[str, Tuple[str, Optional[Tuple]]]) -> Dict[str, int]:
+    """1バッチ分を書き込む（同じ番号はバッチ内の最後のレコードだけが残っている）"""
+    upserts = [row for action, row in batch.values() if action == 'upsert']
+    deletes = [(number,) for number, (action, _) in batch.items() if action == 'delete']
+    ends = [(number,) for number, (action, _) in batch.items() if action == 'end']
+    sql, fields = _upsert_sql(source)
+
+    cur = conn.cursor()
+    if upserts:
+        if _is_pg(conn):
+            from psycopg2.extras import execute_values
+            execute_values(cur, sql, upserts, page_size=len(upserts))
+        else:
+            placeholders = '(' + ', '.join(['?'] * len(fields)) + ')'
+            cur.executemany(sql.replace('%s', placeholders, 1), upserts)
+    if deletes:
+        cur.executemany(_sql(conn, 'DELETE FROM "T_国税庁ミラー" WHERE corporate_number = %s'), deletes)
+    if ends:
+        cur.executemany(_sql(conn, '''
+            UPDATE "T_国税庁ミラー" SET invoice_registered = 0, imported_at = CURRENT_TIMESTAMP
+            WHERE corporate_number = %s
+        '''), ends)
+    if hasattr(conn, 'commit'):
+        conn.commit()
+    return {'upserted': len(upserts), 'deleted': len(deletes), 'ended': len(ends)}
+
+
+def _already_imported(conn, file_name: str) -> bool:
+    cur = conn.cursor()
+    cur.execute(_sql(conn, 'SELECT 1 FROM "T_国税庁ミラー取込" WHERE file_name = %s'), (file_name,))
+    return cur.fetchone() is not None
+
+
+def _record_import(conn, file_name: str, source: str, records: int) -> None:
+    cur = conn.cursor()
+    cur.execute(_sql(conn, '''
+        INSERT INTO "T_国税庁ミラー取込" (file_name, source, records)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (file_name) DO UPDATE SET
+            records = excluded.records, imported_at = CURRENT_TIMESTAMP
+    '''), (file_name, source, records))
+    if hasattr(conn, 'commit'):
+        conn.commit()
+
+
+def import_file(path: str, source: Optional[str] = None, encoding: str = 'utf-8-sig',
+                batch_size: int = None, force: bool = False,
+                report=None) -> Dict:
+    """
+    ダウンロードファイルを1つ取り込む
+
+    Args:
+        path: CSV / XML / zip のパス
+        source: 'corporate'（法人番号）/ 'invoice'（インボイス）。省略時はファイル名から推定
+        encoding: 文字コード（Unicode 版は utf-8-sig、Shift-JIS 版は cp932）
+        batch_size: まとめて書き込む件数（既定: NTA_MIRROR_BATCH_SIZE）
+        force: 取込済みのファイルでも取り込み直す
+        report: バッチを書き込むたびに件数（集計値の辞書）を受け取る関数
+
+    Returns:
+        {'file', 'source', 'records', 'upserted', 'deleted', 'ended', 'skipped', 'elapsed_sec'}
+    """
+    source = source or detect_source(path)
+    if source not in SOURCES:
+        raise ValueError(f"source は {', '.join(SOURCES)} のいずれか: {source}")
+    batch_size = batch_size or NTA_MIRROR_BATCH_SIZE
+    to_row = _corporate_row if source == 'corporate' else _invoice_row
+    file_name = os.path.basename(path)
+
+    started = time.perf_counter()
+    result = {'file': file_name, 'source': source, 'records': 0,
+              'upserted': 0, 'deleted': 0, 'ended': 0, 'skipped': False}
+    conn = get_db()
+    try:
+        if not force and _already_imported(conn, file_name):
+            result['skipped'] = True
+            return result
+
+        batch: Dict[str, Tuple[str, Optional[Tuple]]] = {}
+
+        def _flush():
+            for key, value in _write_batch(conn, source, batch).items():
+                result[key] += value
+            batch.clear()
+            if report:
+                report(dict(result))
+
+        for record in iter_records(path, source, encoding):
+            if record.get('latest') == '0':
+                # 差分ファイルに含まれる過去の履歴
+                continue
+            number, action, row = to_row(record)
+            if len(number) != 13 or not number.isdigit():
+                continue
+            result['records'] += 1
+            batch.pop(number, None)
+            batch[number] = (action, row)
+            if len(batch) >= batch_size:
+                _flush()
+        if batch:
+            _flush()
+
+        _record_import(conn, file_name, source, result['records'])
+    finally:
+        conn.close()
+
+    _availability['checked_at'] = 0.0
+    result['elapsed_sec'] = round(time.perf_counter() - started, 1)
+    return result
+
+
+# ---- 検索 ----
+
+def _check_availability() -> None:
+    """ミラーのデータ・インボイスの取込の有無を確認する（結果は一定時間使い回す）"""
+    now = time.time()
+    if now - _availability['checked_at'] < _AVAILABILITY_TTL:
+        return
+    try:
+        conn = get_db()
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1 FROM "T_国税庁ミラー" LIMIT 1')
+            available = cur.fetchone() is not None
+            cur.execute(_sql(conn, 'SELECT 1 FROM "T_国税庁ミラー取込" WHERE source = %s LIMIT 1'), ('invoice',))
+            invoice = cur.fetchone() is not None
+        finally:
+            conn.close()
+    except Exception as e:
+        _count('errors')
+        print(f"国税庁ミラー確認エラー: {e}")
+        available = invoice = False
+    _availability.update(checked_at=now, available=int(available), invoice=int(invoice))
+
+
+def mirror_available() -> bool:
+    """ミラーが有効で、データが取り込まれているか"""
+    if not NTA_MIRROR_ENABLED:
+        return False
+    _check_availability()
+    return bool(_availability['available'])
+
+
+def invoice_data_available() -> bool:
+    """インボイス制度公表サイトのファイルを取り込み済みか（未取込ならミラーのインボイス登録有無は使えない）"""
+    if not NTA_MIRROR_ENABLED:
+        return False
+    _check_availability()
+    return bool(_availability['invoice'])
+
+
+_SELECT_COLUMNS = '''corporate_number, name, kana, postal_code, prefecture, city, street, kind,
+                     invoice_registered, invoice_registration_date'''
+
+
+def _to_company(row) -> Dict:
+    """
+    ミラーの行を NTAInvoiceAPI の検索結果と同じ形にする
+    インボイスのファイルが未取込なら、インボイス登録有無は None（不明）
+    """
+    prefecture, city, street = row[4], row[5], row[6]
+    registered = row[8]
+    if registered is None and not invoice_data_available():
+        invoice_status = None
+    else:
+        invoice_status = 1 if registered == 1 else 0
+    return {
+        '法人番号': row[0],
+        'インボイス登録番号': f"T{row[0]}" if registered is not None else None,
+        '会社名': row[1],
+        '会社名カナ': row[2],
+        '郵便番号': row[3],
+        '住所': ''.join(part for part in (prefecture, city, street) if part),
+        '都道府県': prefecture,
+        '市区町村': city,
+        '番地': street,
+        'インボイス登録有無': invoice_status,
+        'インボイス登録日': row[9],
+        '法人種別': row[7],
+    }
+
+
+def _query(sql: str, params: Iterable) -> List:
+    try:
+        conn = get_db()
+        try:
+            cur = conn.cursor()
+            cur.execute(_sql(conn, sql), tuple(params))
+            return cur.fetchall()
+        finally:
+            conn.close()
+    except Exception as e:
+        _count('errors')
+        print(f"国税庁ミラー検索エラー: {e}")
+        return []
+
+
+def lookup_number(number: str, invoice: bool = False) -> Optional[Dict]:
+    """
+    13桁の番号でミラーを検索
+
+    Args:
+        number: 法人番号、またはインボイス登録番号の数字部分
+        invoice: インボイス登録のある番号に限る
+
+    Returns:
+        企業情報の辞書、ミラーに無ければNone
+    """
+    condition = ' AND invoice_registered IS NOT NULL' if invoice else ''
+    rows = _query(f'SELECT {_SELECT_COLUMNS} FROM "T_国税庁ミラー" WHERE corporate_number = %s{condition}',
+                  (number,))
+    _count('hits' if rows else 'misses')
+    return _to_company(rows[0]) if rows else None
+
+
+def search_name(company_name: str, prefecture: Optional[str] = None, limit: int = 20) -> List[Dict]:
+    """正規化した会社名（+都道府県）の完全一致でミラーを検索（閉鎖した法人は除く）"""
+    from .nta_cache import normalize_company_name
+
+    sql = f'SELECT {_SELECT_COLUMNS} FROM "T_国税庁ミラー" WHERE name_normalized = %s AND closed = 0'
+    params = [normalize_company_name(company_name)]
+    if prefecture:
+        sql += ' AND prefecture = %s'
+        params.append(prefecture)
+    sql += ' ORDER BY corporate_number LIMIT %s'
+    params.append(limit)
+    rows = _query(sql, params)
+    _count('hits' if rows else 'misses')
+    return [_to_company(row) for row in rows]
+
+
+def get_mirror_stats() -> Dict:
+    """ミラー検索の件数"""
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups else None
+    stats['enabled'] = NTA_MIRROR_ENABLED
+    stats['available'] = bool(_availability['available'])
+    stats['invoice_available'] = bool(_availability['invoice'])
+    stats['fallback'] = NTA_MIRROR_FALLBACK
+    return stats
@@ -8,9 +8,64 @@ import re
 import os
 import json
 import base64
-import requests
 from typing import Dict, Optional, List
-from PIL import Image
+
+from .image_preprocess import load_ocr_image, load_ocr_image_bytes, preprocess_signature
+from .field_extraction import extract_receipt_fields
+from .pdf_ingest import is_pdf, extract_text_from_pdf
+from .tesseract_pool import tesseract_image_to_string
+from .ocr_engines import OCREngine, FunctionOCREngine, run_ocr_engines
+from .timing import span
+from .http_clients import http_request
+from .storage import store_upload
+
+
+VISION_ANNOTATE_URL = 'https://vision.googleapis.com/v1/images:annotate'
+# images:annotate 1リクエストあたりの上限
+VISION_MAX_IMAGES_PER_REQUEST = 16
+VISION_MAX_REQUEST_BYTES = int(os.environ.get('VISION_MAX_REQUEST_BYTES', str(9 * 1024 * 1024)))
+# バッチ送信の同時実行数
+VISION_BATCH_CONCURRENCY = int(os.environ.get('VISION_BATCH_CONCURRENCY', '4'))
+
+
+def _build_vision_request(image_content: str) -> Dict:
+    """images:annotate の1画像分のリクエスト"""
+    return {
+        'image': {
+            'content': image_content
+        },
+        'features': [
+            {
+                'type': 'DOCUMENT_TEXT_DETECTION',
+                'maxResults': 1
+            }
+        ],
+        'imageContext': {
+            'languageHints': ['ja', 'en']
+        }
+    }
+
+
+def _parse_vision_response(response: Dict) -> str:
+    """
+    images:annotate の1画像分のレスポンスからテキストを取り出す
+    画像単位のエラーは例外にする
+    """
+    # エラーチェック
+    if 'error' in response:
+        raise Exception(f"Vision API Response Error: {response['error']}")
+    
+    # fullTextAnnotationから全テキストを取得
+    full_text_annotation = response.get('fullTextAnnotation', {})
+    text = full_text_annotation.get('text', '')
+    
+    # フォールバック: textAnnotationsから取得
+    if not text:
+        text_annotations = response.get('textAnnotations', [])
+        if text_annotations:
+            text = text_annotations[0].get('description', '')
+    
+    return text
 
 
 def extract_text_with_google_vision_api_key(image_path: str, api_key: str) -> str:
@@ -24,33 +79,20 @@ def extract_text_with_google_vision_api_key(image_path: str, api_key: str) -> st
     Returns:
         抽出されたテキスト
     """
-    # 画像をbase64エンコード
-    with open(image_path, 'rb') as f:
-        image_content = base64.b64encode(f.read()).decode('utf-8')
+    # 前処理（縮小・グレースケール等）した画像をbase64エンコード
+    image_content = base64.b64encode(load_ocr_image_bytes(image_path)).decode('utf-8')
     
     # Vision API REST APIエンドポイント
-    url = f'https://vision.googleapis.com/v1/images:annotate?key={api_key}'
+    url = f'{VISION_ANNOTATE_URL}?key={api_key}'
     
     payload = {
-        'requests': [
-            {
-                'image': {
-                    'content': image_content
-                },
-                'features': [
-                    {
-                        'type': 'DOCUMENT_TEXT_DETECTION',
-                        'maxResults': 1
-                    }
-                ],
-                'imageContext': {
-                    'languageHints': ['ja', 'en']
-                }
-            }
-        ]
+        'requests': [_build_vision_request(image_content)]
     }
+    # JSON化したら元の dict と base64 文字列は解放する（送信中に二重に保持しない）
+    body = json.dumps(payload)
+    del payload, image_content
     
-    response = requests.post(url, json=payload, timeout=30)
+    response = http_request('vision', 'POST', url, data=body, headers={'Content-Type': 'application/json'})
     response.raise_for_status()
     
     result = response.json()
@@ -63,28 +105,273 @@ def extract_text_with_google_vision_api_key(image_path: str, api_key: str) -> st
     if not responses:
         return ""
     
-    first_response = responses[0]
-    
-    # エラーチェック
-    if 'error' in first_response:
-        raise Exception(f"Vision API Response Error: {first_response['error']}")
-    
-    # fullTextAnnotationから全テキストを取得
-    full_text_annotation = first_response.get('fullTextAnnotation', {})
-    text = full_text_annotation.get('text', '')
-    
-    # フォールバック: textAnnotationsから取得
-    if not text:
-        text_annotations = first_response.get('textAnnotations', [])
-        if text_annotations:
-            text = text_annotations[0].get('description', '')
-    
-    return text
+    return _parse_vision_response(responses[0])
+
+
+def plan_vision_batches(image_paths: List[str],
+                        max_images: int = VISION_MAX_IMAGES_PER_REQUEST,
+                        max_bytes: int = VISION_MAX_REQUEST_BYTES,
+                        sizes: Optional[Dict[str, int]] = None) -> List[List[str]]:
+    """
+    画像を images:annotate のバッチに分割する
+    1バッチは max_images 枚以下、base64後の合計サイズが max_bytes 以下になるよう詰める
+    （単独で上限を超える画像は1枚だけのバッチにする）
+
+    Args:
+        sizes: 送信するバイト数（前処理後）。省略時はファイルサイズを使う
+    """
+    batches = []
+    current = []
+    current_bytes = 0
+
+    for path in image_paths:
+        try:
+            raw_size = sizes[path] if sizes and path in sizes else os.path.getsize(path)
+            encoded_size = (raw_size + 2) // 3 * 4
+        except OSError:
+            encoded_size = 0
+
+        if current and (len(current) >= max_images or current_bytes + encoded_size > max_bytes):
+            batches.append(current)
+            current = []
+            current_bytes = 0
+
+        current.append(path)
+        current_bytes += encoded_size
+
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _annotate_vision_batch(image_paths: List[str], api_key: str,
+                           payloads: Optional[Dict[str, bytes]] = None) -> Dict[str, Dict]:
+    """1バッチ分を images:annotate に送信し、画像ごとの結果を返す"""
+    results = {}
+    requests_payload = []
+    sent_paths = []
+
+    for path in image_paths:
+        try:
+            content = payloads[path] if payloads and path in payloads else load_ocr_image_bytes(path)
+            requests_payload.append(_build_vision_request(base64.b64encode(content).decode('utf-8')))
+            sent_paths.append(path)
+        except OSError as e:
+            results[path] = {'text': None, 'error': f"画像読み込みエラー: {e}"}
+
+    if not requests_payload:
+        return results
+
+    # base64 の一覧は JSON化したら解放する（バッチは数MBになる）
+    request_body = json.dumps({'requests': requests_payload})
+    del requests_payload
+
+    try:
+        response = http_request(
+            'vision', 'POST',
+            f'{VISION_ANNOTATE_URL}?key={api_key}',
+            data=request_body,
+            headers={'Content-Type': 'application/json'},
+            read_timeout=60
+        )
+        response.raise_for_status()
+        body = response.json()
+        if 'error' in body:
+            raise Exception(f"Vision API Error: {body['error']}")
+        responses = body.get('responses', [])
+    except Exception as e:
+        for path in sent_paths:
+            results[path] = {'text': None, 'error': str(e)}
+        return results
+
+    # responses はリクエストと同じ順序で返る
+    for i, path in enumerate(sent_paths):
+        if i >= len(responses):
+            results[path] = {'text': None, 'error': 'Vision API のレスポンスが不足しています'}
+            continue
+        try:
+            results[path] = {'text': _parse_vision_response(responses[i]), 'error': None}
+        except Exception as e:
+            results[path] = {'text': None, 'error': str(e)}
+
+    return results
+
+
+def extract_texts_with_google_vision_api_key_batch(image_paths: List[str], api_key: str,
+                                                   max_workers: Optional[int] = None) -> Dict[str, Dict]:
+    """
+    複数画像をまとめて Google Cloud Vision API（APIキー認証）でOCR
+
+    画像を最大16枚・ペイロード上限以下のバッチに分け、バッチを並列に送信する。
+
+    Args:
+        image_paths: 画像ファイルのパスのリスト
+        api_key: Google Cloud Vision APIキー
+        max_workers: 同時に送信するバッチ数（既定: VISION_BATCH_CONCURRENCY）
+
+    Returns:
+        {画像パス: {'text': 抽出テキスト or None, 'error': エラーメッセージ or None}}
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    results = {}
+    payloads = {}
+    for path in dict.fromkeys(image_paths):
+        try:
+            payloads[path] = load_ocr_image_bytes(path)
+        except OSError as e:
+            results[path] = {'text': None, 'error': f"画像読み込みエラー: {e}"}
+
+    # 前処理後のサイズでバッチを組む
+    batches = plan_vision_batches(
+        list(payloads),
+        sizes={path: len(content) for path, content in payloads.items()}
+    )
+    if not batches:
+        return results
+
+    workers = max(1, min(max_workers or VISION_BATCH_CONCURRENCY, len(batches)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch_result in executor.map(lambda batch: _annotate_vision_batch(batch, api_key, payloads), batches):
+            results.update(batch_result)
+
+    print(f"Google Cloud Vision API バッチOCR: {len(results)}枚 / {len(batches)}リクエスト")
+    return results
+
+
+# Vision API に送る機能セット（キャッシュキーにも使う）
+VISION_FEATURES = 'DOCUMENT_TEXT_DETECTION:ja,en'
+TESSERACT_FEATURES = 'jpn'
+
+# 抽出ロジックを変更したら上げる（キャッシュ済みの抽出項目を無効化する）
+EXTRACTOR_VERSION = 2
+
+
+def select_ocr_engine(use_google_vision: bool = True, google_vision_api_key: str = None) -> tuple:
+    """
+    設定から最優先で使われるOCRエンジンを判定
+
+    Returns:
+        (エンジン名, 機能セット)
+    """
+    # 前処理設定が変わると OCR 結果も変わり得るため機能セットに含める
+    signature = preprocess_signature()
+    if google_vision_api_key:
+        return 'vision-apikey', f"{VISION_FEATURES}|{signature}"
+    if use_google_vision and os.environ.get('GOOGLE_APPLICATION_CREDENTIALS'):
+        return 'vision-sa', f"{VISION_FEATURES}|{signature}"
+    return 'tesseract', f"{TESSERACT_FEATURES}|{signature}"
+
+
+def _run_ocr_engines(image_path: str, use_google_vision: bool = True, google_vision_api_key: str = None) -> tuple:
+    """
+    OCRエンジンを優先順に、ヘッジ付きで実行してテキストを抽出
+    （応答の遅いエンジンは OCR_HEDGE_DELAY 秒後に次のエンジンと並行実行）
+
+    Returns:
+        (抽出されたテキスト, 実際に使ったエンジン名)
+    """
+    # PDFは埋め込みテキストを優先し、足りないページだけ画像化してOCR
+    if is_pdf(image_path):
+        try:
+            return extract_text_from_pdf(
+                image_path,
+                lambda page_path: _run_ocr_engines(page_path, use_google_vision, google_vision_api_key)
+            )
+        except Exception as e:
+            print(f"PDF処理エラー: {e}")
+            return "", None
+
+    engines = build_ocr_engines(use_google_vision, google_vision_api_key)
+    result = run_ocr_engines(image_path, engines)
+    return result['text'], result['engine']
+
+
+def _extract_text_with_tesseract(image_path: str) -> str:
+    """Tesseract OCR（常駐ワーカープール）で画像からテキストを抽出"""
+    image = load_ocr_image(image_path)
+    try:
+        return tesseract_image_to_string(image, lang='jpn')
+    finally:
+        image.close()
+
+
+def build_ocr_engines(use_google_vision: bool = True, google_vision_api_key: str = None) -> List[OCREngine]:
+    """
+    設定に応じたOCRエンジンを優先順に並べる
+    Vision（APIキー）→ Vision（サービスアカウント）→ Tesseract
+    """
+    engines = []
+    # Google Cloud Vision API（APIキーベース）を優先的に使用
+    if google_vision_api_key:
+        engines.append(FunctionOCREngine(
+            'vision-apikey',
+            lambda path: extract_text_with_google_vision_api_key(path, google_vision_api_key),
+            paid=True
+        ))
+    # Google Cloud Vision API（サービスアカウント認証。select_ocr_engine と同じ条件）
+    if use_google_vision and os.environ.get('GOOGLE_APPLICATION_CREDENTIALS'):
+        engines.append(FunctionOCREngine('vision-sa', extract_text_with_google_vision, paid=True))
+    # フォールバック: Tesseract OCR
+    engines.append(FunctionOCREngine('tesseract', _extract_text_with_tesseract))
+    return engines
+
+
+def _ocr_with_cache(image_path: str, use_google_vision: bool, google_vision_api_key: str,
+                    image_sha256: Optional[str] = None, store: bool = True, use_cache: bool = True) -> Dict:
+    """
+    OCRキャッシュを確認してからOCRを実行
+    store=False の場合、呼び出し側が抽出項目と一緒に保存する
+    use_cache=False の場合はキャッシュを見ずにOCRし、結果でキャッシュを上書きする
+
+    Returns:
+        {'text', 'cached'（キャッシュエントリ or None）, 'image_sha256', 'engine', 'features',
+         'cacheable'（この結果をキャッシュキーに紐付けてよいか）}
+    """
+    from .ocr_cache import file_sha256, get_cached_ocr, store_ocr_result
+
+    engine, features = select_ocr_engine(use_google_vision, google_vision_api_key)
+    try:
+        image_sha256 = image_sha256 or file_sha256(image_path)
+    except OSError as e:
+        print(f"画像ハッシュ計算エラー: {e}")
+        image_sha256 = None
+
+    if image_sha256 and use_cache:
+        with span('ocr.cache_lookup'):
+            cached = get_cached_ocr(image_sha256, engine, features)
+        if cached is not None:
+            print(f"OCRキャッシュヒット: {image_sha256[:12]} ({engine})")
+            return {
+                'text': cached['full_text'],
+                'cached': cached,
+                'image_sha256': image_sha256,
+                'engine': engine,
+                'features': features,
+                'cacheable': True,
+            }
+
+    text, used_engine = _run_ocr_engines(image_path, use_google_vision, google_vision_api_key)
+
+    # フォールバックしたエンジンの結果はキーと一致しないため保存しない
+    cacheable = bool(image_sha256 and text and used_engine == engine)
+    if cacheable and store:
+        store_ocr_result(image_sha256, engine, features, text)
+
+    return {
+        'text': text,
+        'cached': None,
+        'image_sha256': image_sha256,
+        'engine': engine,
+        'features': features,
+        'cacheable': cacheable,
+    }
 
 
 def extract_text_from_image(image_path: str, use_google_vision: bool = True, google_vision_api_key: str = None) -> str:
     """
     画像からテキストを抽出
+    同じ画像（SHA-256一致）を同じエンジンで処理済みの場合はOCRキャッシュを返す
     
     Args:
         image_path: 画像ファイルのパス
@@ -94,34 +381,49 @@ def extract_text_from_image(image_path: str, use_google_vision: bool = True, goo
     Returns:
         抽出されたテキスト
     """
-    # Google Cloud Vision API（APIキーベース）を優先的に使用
-    if google_vision_api_key:
-        try:
-            print(f"Google Cloud Vision API（APIキー認証）でOCR処理中: {image_path}")
-            text = extract_text_with_google_vision_api_key(image_path, google_vision_api_key)
-            print(f"Google Cloud Vision API OCR成功: {len(text)}文字")
-            return text
-        except Exception as e:
-            print(f"Google Vision API（APIキー）エラー: {e}")
-            print("Tesseract OCRにフォールバック")
-    
-    # Google Cloud Vision API（サービスアカウント認証）を試みる
-    if use_google_vision:
+    return _ocr_with_cache(image_path, use_google_vision, google_vision_api_key)['text']
+
+
+def prefetch_ocr_batch(image_paths: List[str], google_vision_api_key: str) -> Dict[str, Dict]:
+    """
+    複数画像をバッチOCRしてOCRキャッシュに格納する
+    その後の process_receipt_image / extract_text_from_image はキャッシュから結果を得る
+
+    Args:
+        image_paths: 画像ファイルのパスのリスト
+        google_vision_api_key: Google Cloud Vision APIキー
+
+    Returns:
+        バッチOCRした画像の {画像パス: {'text', 'error'}}（キャッシュ済みの画像は含まない）
+    """
+    from .ocr_cache import file_sha256, get_cached_ocr, store_ocr_result
+
+    if not google_vision_api_key or not image_paths:
+        return {}
+
+    engine, features = select_ocr_engine(True, google_vision_api_key)
+    hashes = {}
+    for path in image_paths:
+        # PDFは画像エンドポイントに送れないため個別処理に任せる
+        if is_pdf(path):
+            continue
         try:
-            return extract_text_with_google_vision(image_path)
-        except Exception as e:
-            print(f"Google Vision API（サービスアカウント）エラー: {e}")
-            print("Tesseract OCRにフォールバック")
-    
-    # フォールバック: Tesseract OCR
-    try:
-        import pytesseract
-        image = Image.open(image_path)
-        text = pytesseract.image_to_string(image, lang='jpn')
-        return text
-    except Exception as e:
-        print(f"Tesseract OCRエラー: {e}")
-        return ""
+            sha = file_sha256(path)
+        except OSError:
+            continue
+        if get_cached_ocr(sha, engine, features) is None:
+            hashes[path] = sha
+
+    if not hashes:
+        return {}
+
+    results = extract_texts_with_google_vision_api_key_batch(list(hashes), google_vision_api_key)
+    for path, result in results.items():
+        if result.get('text'):
+            store_ocr_result(hashes[path], engine, features, result['text'])
+        elif result.get('error'):
+            print(f"バッチOCRエラー: {path}: {result['error']}")
+    return results
 
 
 def extract_text_with_google_vision(image_path: str) -> str:
@@ -135,7 +437,6 @@ def extract_text_with_google_vision(image_path: str) -> str:
         抽出されたテキスト
     """
     from google.cloud import vision
-    import io
     
     # 環境変数からAPIキーを取得
     google_credentials = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
@@ -145,9 +446,8 @@ def extract_text_with_google_vision(image_path: str) -> str:
     # Vision APIクライアントを初期化
     client = vision.ImageAnnotatorClient()
     
-    # 画像ファイルを読み込み
-    with io.open(image_path, 'rb') as image_file:
-        content = image_file.read()
+    # 画像ファイルを読み込み（前処理済み）
+    content = load_ocr_image_bytes(image_path)
     
     image = vision.Image(content=content)
     
@@ -399,7 +699,8 @@ def extract_date(text: str) -> Optional[str]:
     return None
 
 
-def process_receipt_image(image_path: str, use_google_vision: bool = True, google_vision_api_key: str = None) -> Dict[str, any]:
+def process_receipt_image(image_path: str, use_google_vision: bool = True, google_vision_api_key: str = None,
+                          use_cache: bool = True) -> Dict[str, any]:
     """
     レシート画像を処理して情報を抽出
     
@@ -407,58 +708,58 @@ def process_receipt_image(image_path: str, use_google_vision: bool = True, googl
         image_path: 画像ファイルのパス
         use_google_vision: Google Cloud Vision APIを使用するか
         google_vision_api_key: Google Cloud Vision APIキー（設定されている場合優先使用）
+        use_cache: False の場合はOCRキャッシュを使わずに再OCRし、結果でキャッシュを上書きする
     
     Returns:
         抽出された情報の辞書
     """
-    # OCRでテキスト抽出
-    text = extract_text_from_image(
+    from .ocr_cache import store_ocr_result
+
+    # OCRでテキスト抽出（キャッシュ優先）
+    ocr = _ocr_with_cache(
         image_path,
-        use_google_vision=use_google_vision,
-        google_vision_api_key=google_vision_api_key
+        use_google_vision,
+        google_vision_api_key,
+        store=False,
+        use_cache=use_cache
     )
+    text = ocr['text']
+    cached = ocr['cached']
+    
+    # 抽出済み項目がキャッシュにあればそのまま使う
+    if cached and cached.get('fields') and cached['fields'].get('extractor_version') == EXTRACTOR_VERSION:
+        result = {k: v for k, v in cached['fields'].items() if k != 'extractor_version'}
+        result['full_text'] = text
+        result['raw_text'] = text
+        return result
     
-    # 各種情報を抽出
+    # 各種情報を抽出（1パスの抽出エンジン）
     result = {
         'full_text': text,
         'raw_text': text,  # 後方互換性のため
-        'company_name': extract_company_name(text),
-        'phone_numbers': extract_phone_numbers(text),
-        'addresses': extract_addresses(text),
-        'postal_code': extract_postal_code(text),
-        'amount': extract_amount(text),
-        'date': extract_date(text),
-        'invoice_number': extract_invoice_number(text),  # インボイス番号
-        'corporate_number': extract_corporate_number(text),  # 法人番号
     }
+    with span('ocr.extract_fields'):
+        result.update(extract_receipt_fields(text))
+    
+    # 抽出項目もキャッシュに保存（OCR結果がキャッシュ対象の場合のみ）
+    if ocr['cacheable']:
+        fields = {k: v for k, v in result.items() if k not in ('full_text', 'raw_text')}
+        fields['extractor_version'] = EXTRACTOR_VERSION
+        store_ocr_result(ocr['image_sha256'], ocr['engine'], ocr['features'], text, fields)
     
     return result
 
 
-def save_uploaded_file(file, upload_folder: str = 'uploads') -> str:
+def save_uploaded_file(file, upload_folder: str = None) -> str:
     """
     アップロードされたファイルを保存
+    内容の SHA-256 で決まるパス（<保存先>/ab/cd/<sha256>.<ext>）に保存する
     
     Args:
         file: アップロードされたファイルオブジェクト
-        upload_folder: 保存先フォルダ
+        upload_folder: 保存先フォルダ（既定: UPLOAD_FOLDER）
     
     Returns:
         保存されたファイルのパス
     """
-    os.makedirs(upload_folder, exist_ok=True)
-    
-    # ファイル名を安全にする
-    filename = file.filename
-    filepath = os.path.join(upload_folder, filename)
-    
-    # 同名ファイルがある場合は連番を付ける
-    base, ext = os.path.splitext(filename)
-    counter = 1
-    while os.path.exists(filepath):
-        filename = f"{base}_{counter}{ext}"
-        filepath = os.path.join(upload_folder, filename)
-        counter += 1
-    
-    file.save(filepath)
-    return filepath
+    return store_upload(file, upload_folder)
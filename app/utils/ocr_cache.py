@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+OCR結果キャッシュ
+画像バイト列の SHA-256 + OCRエンジン + 機能セットをキーに、抽出テキストと抽出項目を保存する
+
+同じレシートを再アップロードした場合に Google Vision / Tesseract を呼ばずに済ませる。
+- 1段目: プロセス内 LRU（OCR_CACHE_LRU_SIZE 件）
+- 2段目: T_OCRキャッシュ テーブル（全プロセス共有）
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from .db import get_db, _sql
+from .storage import sha256_from_path
+
+
+OCR_CACHE_ENABLED = os.environ.get('OCR_CACHE_ENABLED', '1') in ('1', 'true', 'True')
+OCR_CACHE_LRU_SIZE = int(os.environ.get('OCR_CACHE_LRU_SIZE', '256'))
+
+# ヒット/ミス集計（プロセス単位）
+_stats = {
+    'memory_hits': 0,
+    'db_hits': 0,
+    'misses': 0,
+    'stores': 0,
+    'errors': 0,
+}
+_stats_lock = threading.Lock()
+
+_lru: "OrderedDict[str, Dict]" = OrderedDict()
+_lru_lock = threading.Lock()
+
+
+def _count(name: str) -> None:
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def file_sha256(image_path: str) -> str:
+    """
+    画像ファイルの SHA-256（16進）
+    内容アドレスで保存したファイルはパスから取り出し、読み込まない
+    """
+    sha256 = sha256_from_path(image_path)
+    if sha256:
+        return sha256
+    h = hashlib.sha256()
+    with open(image_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def make_cache_key(image_sha256: str, engine: str, features: str) -> str:
+    """キャッシュキー（画像ハッシュ:エンジン:機能セット）"""
+    return f"{image_sha256}:{engine}:{features}"
+
+
+def _lru_get(key: str) -> Optional[Dict]:
+    with _lru_lock:
+        entry = _lru.get(key)
+        if entry is not None:
+            _lru.move_to_end(key)
+        return entry
+
+
+def _lru_put(key: str, entry: Dict) -> None:
+    if OCR_CACHE_LRU_SIZE <= 0:
+        return
+    with _lru_lock:
+        _lru[key] = entry
+        _lru.move_to_end(key)
+        while len(_lru) > OCR_CACHE_LRU_SIZE:
+            _lru.popitem(last=False)
+
+
+def get_cached_ocr(image_sha256: str, engine: str, features: str) -> Optional[Dict]:
+    """
+    キャッシュからOCR結果を取得
+
+    Returns:
+        {'full_text': str, 'fields': dict or None, 'engine': str}、無い場合はNone
+    """
+    if not OCR_CACHE_ENABLED:
+        return None
+
+    key = make_cache_key(image_sha256, engine, features)
+    entry = _lru_get(key)
+    if entry is not None:
+        _count('memory_hits')
+        return entry
+
+    try:
+        conn = get_db()
+        try:
+            cur = conn.cursor()
+            cur.execute(_sql(conn, '''
+                SELECT full_text, fields, engine FROM "T_OCRキャッシュ" WHERE cache_key = %s
+            '''), (key,))
+            row = cur.fetchone()
+            if row:
+                cur.execute(_sql(conn, '''
+                    UPDATE "T_OCRキャッシュ"
+                    SET hit_count = hit_count + 1, last_hit_at = CURRENT_TIMESTAMP
+                    WHERE cache_key = %s
+                '''), (key,))
+                if hasattr(conn, 'commit'):
+                    conn.commit()
+        finally:
+            conn.close()
+    except Exception as e:
+        _count('errors')
+        print(f"OCRキャッシュ取得エラー: {e}")
+        return None
+
+    if not row:
+        _count('misses')
+        return None
+
+    entry = {
+        'full_text': row[0] or '',
+        'fields': json.loads(row[1]) if row[1] else None,
+        'engine': row[2],
+    }
+    _lru_put(key, entry)
+    _count('db_hits')
+    return entry
+
+
+def store_ocr_result(image_sha256: str, engine: str, features: str,
+                     full_text: str, fields: Optional[Dict] = None) -> None:
+    """
+    OCR結果をキャッシュに保存（既存キーは上書き）
+
+    Args:
+        image_sha256: 画像の SHA-256
+        engine: 実際にテキストを抽出したエンジン
+        features: 機能セット（言語ヒント等）
+        full_text: 抽出テキスト
+        fields: 抽出済み項目（extractor_version を含む辞書、任意）
+    """
+    if not OCR_CACHE_ENABLED:
+        return
+
+    key = make_cache_key(image_sha256, engine, features)
+    fields_json = json.dumps(fields, ensure_ascii=False) if fields is not None else None
+
+    try:
+        conn = get_db()
+        try:
+            cur = conn.cursor()
+            cur.execute(_sql(conn, '''
+                INSERT INTO "T_OCRキャッシュ" (cache_key, image_sha256, engine, features, full_text, fields)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (cache_key) DO UPDATE SET
+                    full_text = excluded.full_text,
+                    fields = COALESCE(excluded.fields, "T_OCRキャッシュ".fields)
+            '''), (key, image_sha256, engine, features, full_text, fields_json))
+            if hasattr(conn, 'commit'):
+                conn.commit()
+        finally:
+            conn.close()
+    except Exception as e:
+        _count('errors')
+        print(f"OCRキャッシュ保存エラー: {e}")
+        return
+
+    previous = _lru_get(key)
+    if fields is None and previous is not None:
+        fields = previous.get('fields')
+    _lru_put(key, {'full_text': full_text, 'fields': fields, 'engine': engine})
+    _count('stores')
+
+
+def get_ocr_cache_stats() -> Dict:
+    """キャッシュのヒット率などの集計値"""
+    with _stats_lock:
+        stats = dict(_stats)
+    hits = stats['memory_hits'] + stats['db_hits']
+    lookups = hits + stats['misses']
+    stats['hit_ratio'] = round(hits / lookups, 3) if lookups else None
+    stats['lru_entries'] = len(_lru)
+    stats['lru_capacity'] = OCR_CACHE_LRU_SIZE
+    return stats
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+OCR抽出結果の信頼度スコア
+process_receipt_image の結果を項目の有無・形式・チェックディジットで採点し、
+AI補正（correct_ocr_text / normalize_company_name_with_ai）が必要か判定する
+
+スコアは 0〜100。テナントの ai_confidence_threshold（未設定なら AI_CONFIDENCE_THRESHOLD）
+未満のときだけ AI を呼ぶ。
+- AI補正: 全体のスコアがしきい値未満のとき
+- 会社名の正規化: 会社名の項目の点数（0〜100 に換算）がしきい値未満のとき
+どちらもしきい値 0 なら行わない。
+"""
+
+import os
+import re
+import threading
+from datetime import date
+from typing import Dict, Optional
+
+
+AI_CONFIDENCE_THRESHOLD = int(os.environ.get('AI_CONFIDENCE_THRESHOLD', '80'))
+
+# 項目ごとの配点（合計100）
+FIELD_WEIGHTS = {
+    'registration_number': 30,  # インボイス登録番号 or 法人番号
+    'company_name': 25,
+    'date': 20,
+    'amount': 15,
+    'contact': 10,  # 電話番号 or 住所
+}
+
+_LEGAL_FORMS = ('株式会社', '有限会社', '合同会社', '合資会社', '合名会社')
+_NAME_NOISE_RE = re.compile(r'[^\u3040-\u309F\u30A0-\u30FF\u4E00-\u9FFFa-zA-Z0-9&\s]')
+_DATE_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})$')
+
+# AI 呼び出しの実行／スキップ件数（プロセス単位）
+_stats = {
+    'evaluated': 0,
+    'ai_correction_run': 0,
+    'ai_correction_skipped': 0,
+    'normalize_run': 0,
+    'normalize_skipped': 0,
+}
+_stats_lock = threading.Lock()
+
+
+def corporate_number_check_digit(base12: str) -> int:
+    """
+    法人番号の検査用数字（先頭1桁）を計算
+
+    Args:
+        base12: 基礎番号（検査用数字を除いた12桁）
+
+    Returns:
+        検査用数字 = 9 - (Σ Pn × Qn mod 9)
+        Pn は最下位を1桁目とした n 桁目の数字、Qn は n が奇数なら1、偶数なら2
+    """
+    total = 0
+    for n, digit in enumerate(reversed(base12), start=1):
+        total += int(digit) * (1 if n % 2 else 2)
+    return 9 - total % 9
+
+
+def is_valid_corporate_number(number: Optional[str]) -> bool:
+    """13桁の法人番号として検査用数字が正しいか"""
+    if not number or len(number) != 13 or not number.isdigit():
+        return False
+    return int(number[0]) == corporate_number_check_digit(number[1:])
+
+
+def is_valid_invoice_number(number: Optional[str]) -> bool:
+    """インボイス登録番号（T + 13桁）として検査用数字が正しいか"""
+    if not number or len(number) != 14 or number[0] != 'T':
+        return False
+    return is_valid_corporate_number(number[1:])
+
+
+def _score_date(value: Optional[str]) -> float:
+    if not value:
+        return 0.0
+    match = _DATE_RE.match(value)
+    if not match:
+        return 0.3
+    try:
+        parsed = date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+    except ValueError:
+        return 0.3
+    # 未来日や古すぎる日付は読み取り誤りの可能性が高い
+    today = date.today()
+    if parsed > today or parsed.year < today.year - 10:
+        return 0.5
+    return 1.0
+
+
+def _score_amount(value) -> float:
+    if value is None:
+        return 0.0
+    try:
+        amount = float(value)
+    except (TypeError, ValueError):
+        return 0.0
+    if amount <= 0 or amount >= 100_000_000:
+        return 0.3
+    return 1.0
+
+
+def _score_company_name(value: Optional[str]) -> float:
+    if not value:
+        return 0.0
+    if not any(form in value for form in _LEGAL_FORMS):
+        return 0.5
+    body = value
+    for form in _LEGAL_FORMS:
+        body = body.replace(form, '')
+    if len(body) < 1 or len(value) > 60:
+        return 0.5
+    # 記号が混じっている場合はOCRの誤認識を疑う
+    if _NAME_NOISE_RE.search(value):
+        return 0.6
+    return 1.0
+
+
+def _score_registration_number(ocr_result: Dict) -> float:
+    invoice_number = ocr_result.get('invoice_number')
+    corporate_number = ocr_result.get('corporate_number')
+    if is_valid_invoice_number(invoice_number) or is_valid_corporate_number(corporate_number):
+        return 1.0
+    if invoice_number or corporate_number:
+        # 桁数は合っているが検査用数字が合わない
+        return 0.3
+    return 0.0
+
+
+def score_ocr_result(ocr_result: Dict) -> Dict:
+    """
+    OCR抽出結果の信頼度を採点
+
+    Args:
+        ocr_result: process_receipt_image の戻り値
+
+    Returns:
+        {'score': 0〜100, 'fields': {項目: 0.0〜1.0}}
+    """
+    fields = {
+        'registration_number': _score_registration_number(ocr_result),
+        'company_name': _score_company_name(ocr_result.get('company_name')),
+        'date': _score_date(ocr_result.get('date')),
+        'amount': _score_amount(ocr_result.get('amount')),
+        'contact': 1.0 if (ocr_result.get('phone_numbers') or ocr_result.get('addresses')) else 0.0,
+    }
+    score = sum(FIELD_WEIGHTS[name] * value for name, value in fields.items())
+    with _stats_lock:
+        _stats['evaluated'] += 1
+    return {'score': round(score), 'fields': fields}
+
+
+def needs_ai_correction(confidence: Dict, threshold: Optional[int] = None) -> bool:
+    """
+    信頼度がしきい値未満なら AI 補正が必要と判定し、実行／スキップ件数を数える
+    """
+    threshold = AI_CONFIDENCE_THRESHOLD if threshold is None else threshold
+    needed = confidence['score'] < threshold
+    with _stats_lock:
+        _stats['ai_correction_run' if needed else 'ai_correction_skipped'] += 1
+    return needed
+
+
+def needs_company_normalization(confidence: Dict, threshold: Optional[int] = None) -> bool:
+    """
+    会社名の AI 正規化が必要か判定
+    全体の信頼度ではなく会社名の項目の点数（法人格の有無・記号の混入）を 0〜100 に換算してしきい値と比べる
+    （全体の信頼度が高くても略称のままの会社名は正規化する。しきい値 0 なら行わない）
+    会社名が読み取れていない場合は正規化するものが無いため、呼び出し側で除く
+    """
+    threshold = AI_CONFIDENCE_THRESHOLD if threshold is None else threshold
+    needed = confidence['fields']['company_name'] * 100 < threshold
+    with _stats_lock:
+        _stats['normalize_run' if needed else 'normalize_skipped'] += 1
+    return needed
+
+
+def get_ai_gate_stats() -> Dict:
+    """AI 呼び出しの実行／スキップ件数"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['threshold_default'] = AI_CONFIDENCE_THRESHOLD
+    return stats
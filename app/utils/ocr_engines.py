@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+OCRエンジンの共通インターフェースとオーケストレーター
+
+エンジンを優先順に並べ、全体のレイテンシ予算（OCR_LATENCY_BUDGET 秒）の中で実行する。
+- 先頭のエンジンを起動し、OCR_HEDGE_DELAY 秒以内に結果が無ければ次のエンジンも並行して起動する
+  ただし有料のエンジン（Vision など）の実行中に別の有料エンジンを並行起動するのは OCR_HEDGE_PAID=1 のときだけ
+  （既定では Tesseract のような無料のエンジンだけを並行起動し、有料エンジンは前のエンジンが失敗したときに使う）
+- エンジンがエラーになった場合は待たずに次のエンジンを起動する
+- 最初に得られた十分な結果（空白を除いて OCR_MIN_TEXT_CHARS 文字以上）を採用し、残りはキャンセルする
+  （実行中の HTTP リクエストなどは止められないため、結果を捨てる）
+- それより短い結果は、次のエンジンを起動して予算内で他のエンジンの結果を待つ
+  十分な結果が得られなければ、短い結果のうち最も長いものを返す
+- 採用したエンジンと所要時間をエンジン別に集計する
+"""
+
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, List, Optional
+
+from .timing import span
+
+
+OCR_LATENCY_BUDGET = float(os.environ.get('OCR_LATENCY_BUDGET', '30'))
+OCR_HEDGE_DELAY = float(os.environ.get('OCR_HEDGE_DELAY', '4'))
+# 有料エンジンの実行中に別の有料エンジンを並行起動する（止められないため両方に課金される）
+OCR_HEDGE_PAID = os.environ.get('OCR_HEDGE_PAID', '0') in ('1', 'true', 'True')
+# これより短い結果（空白を除いた文字数）は読み取り失敗とみなし、他のエンジンの結果を待つ
+OCR_MIN_TEXT_CHARS = int(os.environ.get('OCR_MIN_TEXT_CHARS', '20'))
+
+
+class OCREngine:
+    """
+    OCRエンジンのインターフェース
+    name はキャッシュキーや集計に使うエンジン名
+    paid は呼び出しごとに課金されるエンジンか（並行起動の判断に使う）
+    """
+
+    name = 'base'
+    paid = False
+
+    def extract(self, image_path: str) -> str:
+        """画像からテキストを抽出（失敗時は例外）"""
+        raise NotImplementedError
+
+
+class FunctionOCREngine(OCREngine):
+    """関数をOCRエンジンとして扱う"""
+
+    def __init__(self, name: str, func: Callable[[str], str], paid: bool = False):
+        self.name = name
+        self.paid = paid
+        self._func = func
+
+    def extract(self, image_path: str) -> str:
+        return self._func(image_path)
+
+
+# エンジン別の集計（プロセス単位）
+_stats: Dict[str, Dict] = {}
+_hedge_stats = {'runs': 0, 'hedged': 0, 'budget_exceeded': 0, 'no_result': 0, 'weak_results': 0, 'weak_accepted': 0}
+_stats_lock = threading.Lock()
+
+
+def _engine_stats(name: str) -> Dict:
+    if name not in _stats:
+        _stats[name] = {'wins': 0, 'hedged_wins': 0, 'failures': 0, 'win_ms_total': 0.0}
+    return _stats[name]
+
+
+def _record_win(name: str, elapsed_ms: float, hedged: bool) -> None:
+    with _stats_lock:
+        stats = _engine_stats(name)
+        stats['wins'] += 1
+        stats['win_ms_total'] += elapsed_ms
+        if hedged:
+            stats['hedged_wins'] += 1
+
+
+def _record_failure(name: str) -> None:
+    with _stats_lock:
+        _engine_stats(name)['failures'] += 1
+
+
+def _text_length(text: Optional[str]) -> int:
+    """空白を除いた文字数"""
+    return len(''.join((text or '').split()))
+
+
+def _extract_with_span(engine: OCREngine, image_path: str) -> str:
+    with span(f'ocr.{engine.name}'):
+        return engine.extract(image_path)
+
+
+def run_ocr_engines(image_path: str, engines: List[OCREngine],
+                    budget: float = None, hedge_delay: float = None) -> Dict:
+    """
+    エンジンをヘッジ付きで実行し、最初に得られた結果を返す
+
+    Args:
+        image_path: 画像ファイルのパス
+        engines: 優先順に並べたエンジン
+        budget: 全体の待ち時間の上限秒数（既定: OCR_LATENCY_BUDGET）
+        hedge_delay: 次のエンジンを並行起動するまでの秒数（既定: OCR_HEDGE_DELAY）
+
+    Returns:
+        {'text': str, 'engine': 採用したエンジン名 or None, 'elapsed_ms': float, 'hedged': bool}
+    """
+    budget = budget or OCR_LATENCY_BUDGET
+    hedge_delay = OCR_HEDGE_DELAY if hedge_delay is None else hedge_delay
+
+    started = time.monotonic()
+    deadline = started + budget
+    with _stats_lock:
+        _hedge_stats['runs'] += 1
+
+    if not engines:
+        return {'text': '', 'engine': None, 'elapsed_ms': 0.0, 'hedged': False}
+
+    executor = ThreadPoolExecutor(max_workers=len(engines), thread_name_prefix='ocr-engine')
+    running = {}
+    pending = list(engines)
+    launched = 0
+    # エラーにはならなかったが短すぎた結果のうち最も長いもの（他に結果が無ければこれを返す）
+    weak_text = ''
+    weak_engine: Optional[str] = None
+
+    def _next_engine() -> Optional[OCREngine]:
+        """次に起動できるエンジン（有料エンジンの実行中は、有料エンジンを飛ばす）"""
+        paid_running = any(engine.paid for engine in running.values())
+        for engine in pending:
+            if not (engine.paid and paid_running and not OCR_HEDGE_PAID):
+                return engine
+        return None
+
+    def _launch(engine: OCREngine) -> float:
+        nonlocal launched
+        pending.remove(engine)
+        launched += 1
+        # 呼び出し元のトレースにエンジン別の所要時間を記録する
+        context = contextvars.copy_context()
+        running[executor.submit(context.run, _extract_with_span, engine, image_path)] = engine
+        if launched > 1:
+            print(f"OCRエンジン追加起動: {engine.name}")
+        return time.monotonic() + hedge_delay
+
+    def _finish(text: str, engine_name: Optional[str]) -> Dict:
+        elapsed_ms = (time.monotonic() - started) * 1000
+        hedged = launched > 1
+        if hedged:
+            with _stats_lock:
+                _hedge_stats['hedged'] += 1
+        if engine_name and text:
+            _record_win(engine_name, elapsed_ms, hedged)
+            print(f"OCR採用エンジン: {engine_name}（{elapsed_ms:.0f}ms）")
+        return {'text': text, 'engine': engine_name, 'elapsed_ms': elapsed_ms, 'hedged': hedged}
+
+    try:
+        next_launch_at = _launch(pending[0])
+        while running or pending:
+            now = time.monotonic()
+            if now >= deadline:
+                with _stats_lock:
+                    _hedge_stats['budget_exceeded'] += 1
+                print(f"OCRレイテンシ予算（{budget}秒）を超過しました")
+                break
+
+            candidate = _next_engine()
+            if candidate is not None and (not running or now >= next_launch_at):
+                next_launch_at = _launch(candidate)
+                continue
+
+            wait_until = deadline
+            if candidate is not None:
+                wait_until = min(wait_until, next_launch_at)
+            done, _ = wait(running, timeout=max(0.0, wait_until - now), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                engine = running.pop(future)
+                try:
+                    text = future.result()
+                except Exception as e:
+                    _record_failure(engine.name)
+                    print(f"OCRエンジンエラー（{engine.name}）: {e}")
+                    # 失敗したら次のエンジンをすぐ起動する
+                    next_launch_at = time.monotonic()
+                    continue
+                length = _text_length(text)
+                if length >= OCR_MIN_TEXT_CHARS:
+                    return _finish(text, engine.name)
+                if length:
+                    with _stats_lock:
+                        _hedge_stats['weak_results'] += 1
+                    print(f"OCR結果が短いため他のエンジンを待ちます（{engine.name}: {length}文字）")
+                if weak_engine is None or length > _text_length(weak_text):
+                    weak_text, weak_engine = text or '', engine.name
+                # 次のエンジンをすぐ起動する
+                next_launch_at = time.monotonic()
+    finally:
+        # 未開始のものは取り消し、実行中のものは待たずに結果を捨てる
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    with _stats_lock:
+        if weak_text.strip():
+            _hedge_stats['weak_accepted'] += 1
+        else:
+            _hedge_stats['no_result'] += 1
+    return _finish(weak_text if weak_text.strip() else '', weak_engine)
+
+
+def get_ocr_engine_stats() -> Dict:
+    """エンジン別の採用回数・平均所要時間など"""
+    with _stats_lock:
+        engines = {}
+        for name, stats in _stats.items():
+            engines[name] = {
+                'wins': stats['wins'],
+                'hedged_wins': stats['hedged_wins'],
+                'failures': stats['failures'],
+                'avg_win_ms': round(stats['win_ms_total'] / stats['wins'], 1) if stats['wins'] else None,
+            }
+        return {'engines': engines, **_hedge_stats}
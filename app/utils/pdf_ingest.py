@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+PDF証憑の取り込み
+請求書PDFなど複数ページのPDFからテキストを取り出す
+
+- テキストが埋め込まれているページはそのテキストを使い、OCRしない
+- 埋め込みテキストの無いページ（スキャンPDF）だけを PDF_RENDER_DPI で画像化してOCR
+- ページは1枚ずつ画像化し、OCR中のページ数を PDF_OCR_CONCURRENCY までに抑える
+  （文書全体を一度に画像化しないのでメモリ使用量はページ数に比例しない）
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, List, Optional, Tuple
+
+
+PDF_RENDER_DPI = int(os.environ.get('PDF_RENDER_DPI', '200'))
+PDF_OCR_CONCURRENCY = int(os.environ.get('PDF_OCR_CONCURRENCY', '4'))
+PDF_MAX_PAGES = int(os.environ.get('PDF_MAX_PAGES', '20'))
+# これ未満の文字数しか埋め込まれていないページはスキャン画像とみなしてOCRする
+PDF_MIN_TEXT_CHARS = int(os.environ.get('PDF_MIN_TEXT_CHARS', '20'))
+PDF_JPEG_QUALITY = int(os.environ.get('OCR_JPEG_QUALITY', '85'))
+
+# 埋め込みテキストだけで処理できた場合のエンジン名
+PDF_TEXT_ENGINE = 'pdf-text'
+
+# PDFium はスレッドセーフではないため、ライブラリ呼び出しは直列化する
+_pdfium_lock = threading.Lock()
+
+
+def is_pdf(path: str) -> bool:
+    """ファイル先頭のシグネチャでPDFか判定"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(5) == b'%PDF-'
+    except OSError:
+        return False
+
+
+def _page_text(page) -> str:
+    """ページの埋め込みテキストを取得"""
+    textpage = page.get_textpage()
+    try:
+        return (textpage.get_text_bounded() or '').replace('\r\n', '\n')
+    finally:
+        textpage.close()
+
+
+def _render_page(page, path: str, dpi: int) -> None:
+    """ページをグレースケールJPEGとして書き出す"""
+    bitmap = page.render(scale=dpi / 72, grayscale=True)
+    try:
+        image = bitmap.to_pil()
+        image.save(path, format='JPEG', quality=PDF_JPEG_QUALITY)
+        image.close()
+    finally:
+        bitmap.close()
+
+
+def extract_text_from_pdf(pdf_path: str,
+                          ocr_page: Callable[[str], Tuple[str, Optional[str]]],
+                          dpi: int = None,
+                          max_workers: int = None,
+                          max_pages: int = None) -> Tuple[str, Optional[str]]:
+    """
+    PDFからテキストを抽出
+
+    Args:
+        pdf_path: PDFファイルのパス
+        ocr_page: ページ画像のパスを受け取り (テキスト, エンジン名) を返す関数
+        dpi: 画像化の解像度（既定: PDF_RENDER_DPI）
+        max_workers: 同時にOCRするページ数（既定: PDF_OCR_CONCURRENCY）
+        max_pages: 処理する最大ページ数（既定: PDF_MAX_PAGES）
+
+    Returns:
+        (ページ順に連結したテキスト, OCRに使ったエンジン名。OCR不要だった場合は PDF_TEXT_ENGINE)
+    """
+    import pypdfium2 as pdfium
+
+    dpi = dpi or PDF_RENDER_DPI
+    max_workers = max(1, max_workers or PDF_OCR_CONCURRENCY)
+    max_pages = max_pages or PDF_MAX_PAGES
+
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(pdf_path)
+        page_count = len(pdf)
+    if page_count > max_pages:
+        print(f"PDFのページ数が上限を超えています: {page_count}ページ（先頭{max_pages}ページのみ処理）")
+        page_count = max_pages
+
+    texts: List[str] = [''] * page_count
+    engines = []
+    ocr_count = 0
+    pending = {}
+    workdir = tempfile.mkdtemp(prefix='voucher-pdf-')
+
+    def _collect(done) -> None:
+        for future in done:
+            index, page_path = pending.pop(future)
+            try:
+                text, engine = future.result()
+                texts[index] = text or ''
+                if engine:
+                    engines.append(engine)
+            except Exception as e:
+                print(f"PDFページOCRエラー: {index + 1}ページ目: {e}")
+            finally:
+                try:
+                    os.remove(page_path)
+                except OSError:
+                    pass
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for index in range(page_count):
+                # OCR待ちのページが上限に達していたら、どれかが終わるまで次を画像化しない
+                while len(pending) >= max_workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    _collect(done)
+
+                page_path = None
+                with _pdfium_lock:
+                    page = pdf[index]
+                    try:
+                        embedded = _page_text(page)
+                        if len(embedded.strip()) < PDF_MIN_TEXT_CHARS:
+                            page_path = os.path.join(workdir, f'page-{index + 1:04d}.jpg')
+                            _render_page(page, page_path, dpi)
+                    finally:
+                        page.close()
+
+                if page_path is None:
+                    texts[index] = embedded
+                    continue
+                ocr_count += 1
+                pending[executor.submit(ocr_page, page_path)] = (index, page_path)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                _collect(done)
+    finally:
+        with _pdfium_lock:
+            pdf.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"PDF処理: {page_count}ページ（OCR {ocr_count}ページ）")
+    text = '\n'.join(t.strip('\n') for t in texts if t)
+    if ocr_count == 0:
+        return text, PDF_TEXT_ENGINE
+    return text, (engines[0] if engines else None)
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+外部API呼び出しの保護（レート制限・再試行予算・サーキットブレーカー）
+
+- TokenBucket: 1秒あたり rate 件・最大 burst 件まで。トークンが無ければ一定時間だけ待ち、それでも無ければ断る
+- RetryBudget: 再試行の総量を通常のリクエスト数の一定割合に抑える
+  （障害時に全リクエストが再試行して負荷を倍増させない）
+- CircuitBreaker: 連続して失敗したら一定時間は呼び出さずに即座に失敗させ（open）、
+  時間が経ったら1件だけ試し（half_open）、成功すれば元に戻す（closed）
+- backoff_delay: 指数バックオフ（full jitter）の待ち時間
+
+いずれもプロセス単位（gunicorn のワーカー数だけ独立に動く）。
+"""
+
+import random
+import threading
+import time
+from typing import Dict
+
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが open のため呼び出さなかった"""
+
+
+class RateLimitedError(Exception):
+    """レート制限のトークンを待ち時間内に得られなかった"""
+
+
+class TokenBucket:
+    """トークンバケット方式のレート制限"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._stats = {'acquired': 0, 'waited': 0, 'rejected': 0}
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, timeout: float = 0.0) -> bool:
+        """トークンを1つ取得（timeout 秒まで待つ）。取得できなければFalse"""
+        if self.rate <= 0:
+            return True
+        deadline = time.monotonic() + timeout
+        waited = False
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self._stats['acquired'] += 1
+                    if waited:
+                        self._stats['waited'] += 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+                if now + wait > deadline:
+                    self._stats['rejected'] += 1
+                    return False
+            waited = True
+            time.sleep(wait)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            self._refill(time.monotonic())
+            return dict(self._stats, rate=self.rate, burst=self.burst, tokens=round(self._tokens, 2))
+
+
+class RetryBudget:
+    """
+    再試行の予算
+    リクエストごとに ratio だけ予算が貯まり（上限 max_tokens）、再試行1回で1消費する
+    """
+
+    def __init__(self, ratio: float, max_tokens: float = 10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._lock = threading.Lock()
+        self._stats = {'retries': 0, 'exhausted': 0}
+
+    def deposit(self) -> None:
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        """再試行してよければ予算を1消費してTrue"""
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self._stats['retries'] += 1
+                return True
+            self._stats['exhausted'] += 1
+            return False
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return dict(self._stats, tokens=round(self._tokens, 2), ratio=self.ratio)
+
+
+class CircuitBreaker:
+    """連続失敗で open になり、reset_timeout 秒後に1件だけ試すサーキットブレーカー"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self._stats = {'rejected': 0, 'opened': 0, 'successes': 0, 'failures': 0}
+
+    def allow(self) -> bool:
+        """呼び出してよいか（open 中は False。half_open では試行の1件だけ True）"""
+        with self._lock:
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    self._stats['rejected'] += 1
+                    return False
+                self._state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self._state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    self._stats['rejected'] += 1
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def release(self) -> None:
+        """allow() の後に呼び出さなかったとき（成功・失敗どちらにも数えず、half_open の試行枠を戻す）"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._stats['successes'] += 1
+            self._failures = 0
+            self._probe_in_flight = False
+            if self._state != self.CLOSED:
+                print(f"サーキットブレーカー復旧: {self.name}")
+            self._state = self.CLOSED
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._stats['failures'] += 1
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self._stats['opened'] += 1
+                    print(f"サーキットブレーカー open: {self.name}（連続失敗 {self._failures}件、"
+                          f"{self.reset_timeout:.0f}秒間は呼び出さない）")
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def stats(self) -> Dict:
+        state = self.state
+        with self._lock:
+            return dict(self._stats, state=state, consecutive_failures=self._failures)
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """attempt 回目（1始まり）の再試行までの待ち時間（0〜min(cap, base×2^(attempt-1)) の一様乱数）"""
+    return random.uniform(0, min(cap, base * (2 ** (attempt - 1))))
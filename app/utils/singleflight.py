@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+同じ処理の同時実行をまとめる（single-flight）
+
+同じキーの処理が実行中なら新たに実行せず、実行中の処理の結果を待って受け取る。
+複数のアップロードが同時に同じ取引先を国税庁APIで検索する場合などに、外部APIの呼び出しを1回にする。
+（結果は保存しない。完了後に来た呼び出しは改めて実行する）
+"""
+
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """キーごとに実行中の処理を1つに保つ"""
+
+    def __init__(self):
+        self._calls: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+        self._stats = {'executed': 0, 'shared': 0}
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        """
+        func を実行して結果を返す（同じキーが実行中ならその結果を待って返す）
+
+        例外も実行中の呼び出し元すべてに同じものが送出される
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self._stats['executed'] += 1
+            else:
+                self._stats['shared'] += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def stats(self) -> Dict:
+        """実行回数・相乗りした回数・実行中の件数"""
+        with self._lock:
+            return dict(self._stats, inflight=len(self._calls))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+アップロードファイルの保存（内容アドレス方式）
+
+アップロードを一時ファイルへ書き込みながら SHA-256 を計算し、
+<保存先>/ab/cd/<sha256>.<拡張子> へアトミックに移動する。
+- 同じ内容のファイルは同じパスになる（重複保存しない）
+- 1ディレクトリのファイル数が増え続けない（256×256 に分散）
+- 複数ワーカーが同時に保存しても os.replace で競合しない
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+from typing import Optional
+
+
+UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'uploads')
+_CHUNK_SIZE = 1024 * 1024
+_EXT_RE = re.compile(r'^[a-z0-9]{1,8}$')
+_KEY_NAME_RE = re.compile(r'^([0-9a-f]{64})(?:\.[a-z0-9]{1,8})?$')
+
+
+def _extension(filename: Optional[str]) -> str:
+    """安全な拡張子（小文字・英数字のみ。無効なら空文字）"""
+    ext = os.path.splitext(filename or '')[1].lstrip('.').lower()
+    return ext if _EXT_RE.match(ext) else ''
+
+
+def storage_key(sha256: str, ext: str = '') -> str:
+    """内容ハッシュから保存キー（ab/cd/<sha256>.<ext>）を作る"""
+    name = f"{sha256}.{ext}" if ext else sha256
+    return os.path.join(sha256[:2], sha256[2:4], name)
+
+
+def resolve_key(key: str, upload_folder: str = None) -> str:
+    """保存キーからファイルパスを得る"""
+    return os.path.join(upload_folder or UPLOAD_FOLDER, key)
+
+
+def sha256_from_path(path: str) -> Optional[str]:
+    """
+    内容アドレスで保存したファイルならパスから SHA-256 を取り出す
+    （ab/cd/<sha256>.<ext> の形式でなければNone）
+    """
+    match = _KEY_NAME_RE.match(os.path.basename(path))
+    if not match:
+        return None
+    sha256 = match.group(1)
+    parent = os.path.dirname(path)
+    if os.path.basename(parent) != sha256[2:4] or os.path.basename(os.path.dirname(parent)) != sha256[:2]:
+        return None
+    return sha256
+
+
+def store_upload(file, upload_folder: str = None) -> str:
+    """
+    アップロードされたファイルを内容アドレスのパスに保存
+
+    Args:
+        file: werkzeug の FileStorage（.stream と .filename を持つ）
+        upload_folder: 保存先フォルダ（既定: UPLOAD_FOLDER）
+
+    Returns:
+        保存されたファイルのパス（<保存先>/ab/cd/<sha256>.<ext>）
+    """
+    upload_folder = upload_folder or UPLOAD_FOLDER
+    # 同じファイルシステム上に一時ファイルを作り、os.replace をアトミックにする
+    tmp_dir = os.path.join(upload_folder, '.tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            stream = getattr(file, 'stream', file)
+            for chunk in iter(lambda: stream.read(_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                out.write(chunk)
+
+        filepath = resolve_key(storage_key(digest.hexdigest(), _extension(file.filename)), upload_folder)
+        if os.path.exists(filepath):
+            # 同じ内容のファイルが保存済み
+            os.remove(tmp_path)
+            return filepath
+
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, filepath)
+        return filepath
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
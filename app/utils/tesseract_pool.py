@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+常駐 Tesseract ワーカープール
+画像ごとに tesseract プロセスを起動して日本語の学習データを読み直す代わりに、
+言語モデルを読み込んだままのワーカープロセスを使い回す
+
+- ワーカー数: TESSERACT_POOL_SIZE（既定: CPUコア数）
+- 空いているワーカーはキューで管理し、全員使用中なら空くまで待つ
+- 1件が TESSERACT_JOB_TIMEOUT 秒を超えたらそのワーカーを停止して作り直す
+- TESSERACT_MAX_JOBS_PER_WORKER 件処理したワーカーは作り直す（メモリ肥大対策）
+
+ワーカー内では tesserocr（Tesseract C API）でエンジンを常駐させる。
+tesserocr は任意（requirements-ocr.txt）で、ビルドには libtesseract-dev / libleptonica-dev が必要（Aptfile）。
+使えない環境では pytesseract で処理する（その場合は常駐の効果は無い）。
+学習データは TESSDATA_PREFIX があればそこから読む（apt buildpack では /app/.apt 以下に入るため）。
+"""
+
+import atexit
+import os
+import queue
+import threading
+import time
+from typing import Dict, Optional
+
+
+TESSERACT_POOL_ENABLED = os.environ.get('TESSERACT_POOL', '1') in ('1', 'true', 'True')
+TESSERACT_POOL_SIZE = int(os.environ.get('TESSERACT_POOL_SIZE', '0')) or (os.cpu_count() or 1)
+TESSERACT_JOB_TIMEOUT = float(os.environ.get('TESSERACT_JOB_TIMEOUT', '60'))
+TESSERACT_MAX_JOBS_PER_WORKER = int(os.environ.get('TESSERACT_MAX_JOBS_PER_WORKER', '200'))
+# ワーカー起動（学習データ読み込み）を待つ秒数
+_STARTUP_TIMEOUT = 30
+
+
+class TesseractTimeout(Exception):
+    """OCRジョブがタイムアウトした"""
+
+
+def _worker_main(conn, lang: str) -> None:
+    """
+    ワーカープロセス本体
+    起動時に ('ready', エンジン名) を送り、以降は
+    ('ocr', mode, size, pixels) を受け取り ('ok', text) か ('error', message) を返す
+    """
+    # プール全体で並列化するため、1プロセス内のスレッドは1本に抑える
+    os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+    from PIL import Image
+
+    api = None
+    try:
+        import tesserocr
+        tessdata = os.environ.get('TESSDATA_PREFIX')
+        api = tesserocr.PyTessBaseAPI(path=tessdata, lang=lang) if tessdata else tesserocr.PyTessBaseAPI(lang=lang)
+        engine = 'tesserocr'
+    except Exception as e:
+        print(f"⚠️ tesserocr を使えないため pytesseract で処理します: {type(e).__name__}: {e}")
+        try:
+            import pytesseract
+            engine = 'pytesseract'
+        except Exception as e:
+            conn.send(('error', f"{type(e).__name__}: {e}"))
+            return
+    conn.send(('ready', engine))
+
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+            if message is None:
+                break
+            try:
+                _, mode, size, pixels = message
+                image = Image.frombytes(mode, size, pixels)
+                if api is not None:
+                    api.SetImage(image)
+                    text = api.GetUTF8Text()
+                else:
+                    text = pytesseract.image_to_string(image, lang=lang)
+                conn.send(('ok', text))
+            except Exception as e:
+                conn.send(('error', f"{type(e).__name__}: {e}"))
+    finally:
+        if api is not None:
+            api.End()
+
+
+class _Worker:
+    """ワーカープロセス1つ分（親プロセス側）"""
+
+    def __init__(self, context, lang: str):
+        self._context = context
+        self.lang = lang
+        self.process = None
+        self.conn = None
+        self.jobs = 0
+        self.engine = None
+
+    def ensure_started(self) -> None:
+        if self.process is not None and self.process.is_alive():
+            return
+        self.stop()
+        parent_conn, child_conn = self._context.Pipe()
+        self.process = self._context.Process(
+            target=_worker_main, args=(child_conn, self.lang), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.jobs = 0
+        if not self.conn.poll(_STARTUP_TIMEOUT):
+            self.stop()
+            raise TesseractTimeout('Tesseractワーカーの起動がタイムアウトしました')
+        status, payload = self.conn.recv()
+        if status != 'ready':
+            self.stop()
+            raise RuntimeError(f'Tesseractワーカーを起動できません: {payload}')
+        self.engine = payload
+
+    def stop(self, graceful: bool = False) -> None:
+        if self.process is None:
+            return
+        if graceful and self.process.is_alive():
+            try:
+                self.conn.send(None)
+                self.process.join(timeout=5)
+            except Exception:
+                pass
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join(timeout=5)
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+        self.process = None
+        self.conn = None
+
+
+class TesseractPool:
+    """
+    常駐 Tesseract ワーカープール
+
+    Args:
+        size: ワーカー数
+        lang: Tesseract の言語
+        timeout: 1件あたりのタイムアウト秒数
+        max_jobs_per_worker: この件数を処理したワーカーを作り直す
+    """
+
+    def __init__(self, size: int = None, lang: str = 'jpn',
+                 timeout: float = None, max_jobs_per_worker: int = None):
+        import multiprocessing
+        # fork だと親の DB 接続などを引き継ぐため spawn で起動する
+        context = multiprocessing.get_context('spawn')
+        self.size = max(1, size or TESSERACT_POOL_SIZE)
+        self.timeout = timeout or TESSERACT_JOB_TIMEOUT
+        self.max_jobs_per_worker = max_jobs_per_worker or TESSERACT_MAX_JOBS_PER_WORKER
+        self._workers = [_Worker(context, lang) for _ in range(self.size)]
+        # 直前に使ったワーカー（起動済み）から再利用する
+        self._idle: "queue.LifoQueue[_Worker]" = queue.LifoQueue()
+        for worker in self._workers:
+            self._idle.put(worker)
+        self._closed = False
+        self._stats_lock = threading.Lock()
+        self.stats = {'jobs': 0, 'errors': 0, 'timeouts': 0, 'recycled': 0, 'waits': 0}
+
+    def _count(self, name: str) -> None:
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def recognize(self, image, timeout: float = None) -> str:
+        """
+        PIL 画像を OCR してテキストを返す
+        空いているワーカーが無い場合は空くまで待つ（待ち時間もタイムアウトに含める）
+        """
+        if self._closed:
+            raise RuntimeError('Tesseractプールは停止済みです')
+        timeout = timeout or self.timeout
+        if image.mode not in ('L', 'RGB'):
+            image = image.convert('RGB')
+        message = ('ocr', image.mode, image.size, image.tobytes())
+
+        deadline = time.monotonic() + timeout
+        try:
+            worker = self._idle.get_nowait()
+        except queue.Empty:
+            self._count('waits')
+            try:
+                worker = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                self._count('timeouts')
+                raise TesseractTimeout(f'空きTesseractワーカー待ちが{timeout}秒を超えました')
+
+        try:
+            worker.ensure_started()
+            worker.conn.send(message)
+            remaining = max(0.0, deadline - time.monotonic())
+            if not worker.conn.poll(remaining):
+                # 処理中のワーカーは止められないため、プロセスごと作り直す
+                worker.stop()
+                self._count('timeouts')
+                raise TesseractTimeout(f'Tesseract OCRが{timeout}秒でタイムアウトしました')
+            status, payload = worker.conn.recv()
+        except (EOFError, OSError, BrokenPipeError) as e:
+            worker.stop()
+            self._count('errors')
+            raise RuntimeError(f'Tesseractワーカーが異常終了しました: {e}')
+        finally:
+            self._release(worker)
+
+        self._count('jobs')
+        if status != 'ok':
+            self._count('errors')
+            raise RuntimeError(payload)
+        return payload
+
+    def _release(self, worker: _Worker) -> None:
+        if worker.process is not None:
+            worker.jobs += 1
+            if worker.jobs >= self.max_jobs_per_worker:
+                worker.stop(graceful=True)
+                self._count('recycled')
+        self._idle.put(worker)
+
+    def status(self) -> Dict:
+        """プールの状態（/healthz 用）"""
+        with self._stats_lock:
+            stats = dict(self.stats)
+        alive = [w for w in self._workers if w.process is not None and w.process.is_alive()]
+        stats.update({
+            'size': self.size,
+            'alive': len(alive),
+            'idle': self._idle.qsize(),
+            'engine': next((w.engine for w in alive if w.engine), None),
+        })
+        return stats
+
+    def close(self) -> None:
+        """全ワーカーを停止"""
+        self._closed = True
+        for worker in self._workers:
+            worker.stop(graceful=True)
+
+
+_pool: Optional[TesseractPool] = None
+_pool_pid: Optional[int] = None
+_pool_lock = threading.Lock()
+
+
+def get_tesseract_pool() -> TesseractPool:
+    """プロセス単位の Tesseract プールを取得（初回呼び出し時に作成）"""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            _pool = TesseractPool()
+            _pool_pid = pid
+            atexit.register(_pool.close)
+    return _pool
+
+
+def get_tesseract_pool_status() -> Optional[Dict]:
+    """作成済みのプールの状態（未作成ならNone）"""
+    if _pool is None or _pool_pid != os.getpid():
+        return None
+    return _pool.status()
+
+
+def tesseract_image_to_string(image, lang: str = 'jpn') -> str:
+    """
+    PIL 画像を Tesseract で OCR
+    プールが有効なら常駐ワーカーで、無効なら pytesseract で処理する
+    """
+    if TESSERACT_POOL_ENABLED and lang == 'jpn':
+        return get_tesseract_pool().recognize(image)
+
+    import pytesseract
+    return pytesseract.image_to_string(image, lang=lang)
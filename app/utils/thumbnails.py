@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+証憑画像のサムネイル・プレビュー生成
+一覧や詳細画面で数MBの元画像をそのまま配信しないよう、縮小した WebP を作る
+
+- thumb（長辺 THUMBNAIL_SIZE px）と preview（長辺 PREVIEW_SIZE px）の2種類
+- 元画像と同じディレクトリに <元ファイル名>.<種類>.webp として保存する
+  （内容アドレス方式なので同じ内容の画像は派生画像も共有される）
+- アップロード時にプロセスプールへ投入し、未生成のまま要求された場合はその場で生成を待つ
+- PDF は1ページ目を画像化して縮小する
+"""
+
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterable, Optional
+
+
+THUMBNAIL_SIZE = int(os.environ.get('THUMBNAIL_SIZE', '320'))
+PREVIEW_SIZE = int(os.environ.get('PREVIEW_SIZE', '1280'))
+THUMBNAIL_QUALITY = int(os.environ.get('THUMBNAIL_QUALITY', '75'))
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', '2'))
+# 未生成の派生画像を要求されたときに生成を待つ上限秒数
+THUMBNAIL_TIMEOUT = float(os.environ.get('THUMBNAIL_TIMEOUT', '20'))
+THUMBNAIL_AT_INGEST = os.environ.get('THUMBNAIL_AT_INGEST', '1') in ('1', 'true', 'True')
+
+# 種類 → 長辺の最大px
+VARIANTS = {
+    'thumb': THUMBNAIL_SIZE,
+    'preview': PREVIEW_SIZE,
+}
+
+# 生成方法を変えたら上げる（ETag に含める）
+DERIVATIVE_VERSION = 1
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_pid: Optional[int] = None
+_executor_lock = threading.Lock()
+
+# 生成中の元画像パス → Future（同じ画像の生成を重複して投入しない）
+_inflight: Dict[str, Future] = {}
+_inflight_lock = threading.Lock()
+
+_stats = {'scheduled': 0, 'generated_on_request': 0, 'served_cached': 0, 'failures': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(key: str) -> None:
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def derivative_path(original_path: str, variant: str) -> str:
+    """派生画像のパス（元画像と同じディレクトリ）"""
+    return f"{original_path}.{variant}.webp"
+
+
+def load_reduced_image(original_path: str, max_edge: int):
+    """
+    元画像を max_edge px 程度まで縮小した状態で読み込む
+    JPEG はドラフトモードで縮小デコードし、PDF は1ページ目だけを画像化する
+    """
+    from PIL import ImageOps
+    from .image_preprocess import open_reduced
+    from .pdf_ingest import is_pdf
+
+    if is_pdf(original_path):
+        import pypdfium2 as pdfium
+
+        pdf = pdfium.PdfDocument(original_path)
+        try:
+            page = pdf[0]
+            try:
+                width, height = page.get_size()
+                scale = max_edge / max(width, height, 1)
+                bitmap = page.render(scale=scale)
+                try:
+                    return bitmap.to_pil().convert('RGB')
+                finally:
+                    bitmap.close()
+            finally:
+                page.close()
+        finally:
+            pdf.close()
+
+    # JPEG は 1/2・1/4・1/8 の縮小デコードで、フル解像度を展開しない
+    with open_reduced(original_path, max_edge, 'RGB') as source:
+        image = ImageOps.exif_transpose(source)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    return image
+
+
+def _write_webp(image, path: str) -> None:
+    """一時ファイルに書き出してから置き換える（生成途中のファイルを配信しない）"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.webp.tmp')
+    os.close(fd)
+    try:
+        image.save(tmp_path, format='WEBP', quality=THUMBNAIL_QUALITY, method=4)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def generate_derivatives(original_path: str, variants: Iterable[str] = None) -> Dict[str, str]:
+    """
+    派生画像を生成（生成済みのものはそのまま）
+
+    元画像は一番大きい種類に必要な解像度で1回だけデコードし、
+    大きい順に縮小しながら書き出す
+
+    Args:
+        original_path: 元画像（またはPDF）のパス
+        variants: 生成する種類（既定: すべて）
+
+    Returns:
+        {種類: 派生画像のパス}
+    """
+    from PIL import Image
+
+    variants = list(variants or VARIANTS)
+    paths = {variant: derivative_path(original_path, variant) for variant in variants}
+    missing = sorted((v for v in variants if not os.path.exists(paths[v])),
+                     key=lambda v: VARIANTS[v], reverse=True)
+    if not missing:
+        return paths
+
+    image = load_reduced_image(original_path, VARIANTS[missing[0]])
+    try:
+        for variant in missing:
+            size = VARIANTS[variant]
+            image.thumbnail((size, size), Image.Resampling.LANCZOS)
+            _write_webp(image, paths[variant])
+    finally:
+        image.close()
+    return paths
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    """プロセス単位の生成プール（fork 後の子プロセスでは作り直す）"""
+    global _executor, _executor_pid
+    pid = os.getpid()
+    with _executor_lock:
+        if _executor is None or _executor_pid != pid:
+            _executor = ProcessPoolExecutor(
+                max_workers=max(1, THUMBNAIL_WORKERS),
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+            _executor_pid = pid
+        return _executor
+
+
+def _discard_executor(executor: ProcessPoolExecutor) -> None:
+    """子プロセスが異常終了して使えなくなったプールを破棄（次回の投入で作り直す）"""
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _submit(original_path: str) -> Future:
+    """生成をプールに投入（同じ画像が生成中ならその Future を返す）"""
+    with _inflight_lock:
+        future = _inflight.get(original_path)
+        if future is not None:
+            return future
+        executor = _get_executor()
+        future = executor.submit(generate_derivatives, original_path)
+        _inflight[original_path] = future
+
+    def _done(f: Future) -> None:
+        with _inflight_lock:
+            _inflight.pop(original_path, None)
+        error = f.exception()
+        if error is not None:
+            _count('failures')
+            print(f"サムネイル生成エラー（{original_path}）: {error}")
+            if isinstance(error, BrokenProcessPool):
+                _discard_executor(executor)
+
+    future.add_done_callback(_done)
+    return future
+
+
+def schedule_derivatives(original_path: str) -> None:
+    """アップロード時に派生画像の生成を投入（完了は待たない）"""
+    if not THUMBNAIL_AT_INGEST:
+        return
+    if all(os.path.exists(derivative_path(original_path, v)) for v in VARIANTS):
+        return
+    try:
+        _submit(original_path)
+        _count('scheduled')
+    except Exception as e:
+        # 生成できなくても表示時に再試行するのでアップロードは失敗させない
+        print(f"サムネイル生成の投入エラー: {e}")
+
+
+def get_derivative(original_path: str, variant: str) -> Optional[str]:
+    """
+    派生画像のパスを取得（未生成ならプールで生成して待つ）
+
+    Args:
+        original_path: 元画像のパス
+        variant: 'thumb' / 'preview'
+
+    Returns:
+        派生画像のパス（生成できなければNone）
+    """
+    path = derivative_path(original_path, variant)
+    if os.path.exists(path):
+        _count('served_cached')
+        return path
+    if not os.path.exists(original_path):
+        return None
+
+    try:
+        _submit(original_path).result(timeout=THUMBNAIL_TIMEOUT)
+    except Exception as e:
+        print(f"サムネイル取得エラー（{original_path}）: {e}")
+        return None
+    _count('generated_on_request')
+    return path if os.path.exists(path) else None
+
+
+def remove_derivatives(original_path: str) -> None:
+    """元画像を削除するときに派生画像も削除"""
+    for variant in VARIANTS:
+        path = derivative_path(original_path, variant)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def get_thumbnail_stats() -> Dict:
+    """派生画像の生成件数など"""
+    with _stats_lock:
+        stats = dict(_stats)
+    with _inflight_lock:
+        stats['inflight'] = len(_inflight)
+    stats['variants'] = dict(VARIANTS)
+    return stats
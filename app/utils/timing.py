@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+処理時間の計測（スパン）
+アップロード・OCR・AI・国税庁API・DB接続などの所要時間を段階別に計測する
+
+- span('ocr.vision-apikey') のように with 文で囲むか、@timed('ai.correct_ocr_text') を付ける
+- リクエスト／ジョブ単位のトレース中であれば、スパンはそのトレースに記録され、
+  終了時に1行のJSONログ（app.logging の JsonFormatter）として出力される
+  リクエストの場合は Server-Timing レスポンスヘッダーにも載せる
+- トレースの有無に関係なく、段階別のレイテンシヒストグラムをプロセス内に集計する
+  （/healthz/timings で参照。ワーカープロセスの集計は worker_stats のスナップショットから合算する）
+"""
+
+import contextvars
+import functools
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+
+# ヒストグラムのバケット上限（ms）
+HISTOGRAM_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+logger = logging.getLogger('app.timing')
+
+# 現在のトレースのスパン一覧 [(name, ms), ...]（未トレースなら None）
+_current_trace: contextvars.ContextVar = contextvars.ContextVar('timing_trace', default=None)
+
+_histograms: Dict[str, Dict] = {}
+_histograms_lock = threading.Lock()
+
+_TOKEN_RE = re.compile(r'[^A-Za-z0-9!#$%&\'*+\-.^_`|~]')
+
+
+def _observe(name: str, elapsed_ms: float) -> None:
+    """ヒストグラムに1件追加"""
+    with _histograms_lock:
+        hist = _histograms.get(name)
+        if hist is None:
+            hist = _histograms[name] = {
+                'count': 0, 'sum_ms': 0.0, 'max_ms': 0.0,
+                'buckets': [0] * (len(HISTOGRAM_BUCKETS_MS) + 1),
+            }
+        hist['count'] += 1
+        hist['sum_ms'] += elapsed_ms
+        hist['max_ms'] = max(hist['max_ms'], elapsed_ms)
+        for i, upper in enumerate(HISTOGRAM_BUCKETS_MS):
+            if elapsed_ms <= upper:
+                hist['buckets'][i] += 1
+                break
+        else:
+            hist['buckets'][-1] += 1
+
+
+def record_span(name: str, elapsed_ms: float) -> None:
+    """計測済みの所要時間を記録"""
+    _observe(name, elapsed_ms)
+    spans = _current_trace.get()
+    if spans is not None:
+        spans.append((name, elapsed_ms))
+
+
+@contextmanager
+def span(name: str):
+    """with 文で囲んだ区間の所要時間を記録"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, (time.perf_counter() - started) * 1000)
+
+
+def timed(name: str):
+    """関数の所要時間を記録するデコレーター"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_trace():
+    """
+    トレースを開始（以降のスパンをこのトレースに記録）
+
+    Returns:
+        end_trace に渡すトークン
+    """
+    return _current_trace.set([])
+
+
+def current_spans() -> List:
+    """現在のトレースのスパン一覧"""
+    return list(_current_trace.get() or [])
+
+
+def end_trace(token, event: str, total_ms: Optional[float] = None, **fields) -> List:
+    """
+    トレースを終了し、スパンの一覧をJSONログに出力
+
+    Args:
+        token: start_trace の戻り値
+        event: ログのイベント名（'request' / 'voucher_job' など）
+        total_ms: 全体の所要時間
+        fields: ログに含める追加項目
+
+    Returns:
+        記録されたスパン一覧 [(name, ms), ...]
+    """
+    spans = current_spans()
+    _current_trace.reset(token)
+    logger.info(event, extra={'fields': {
+        'event': event,
+        'total_ms': round(total_ms, 1) if total_ms is not None else None,
+        'spans': [{'name': name, 'ms': round(ms, 1)} for name, ms in spans],
+        **fields,
+    }})
+    return spans
+
+
+def format_server_timing(spans: List, total_ms: Optional[float] = None) -> str:
+    """
+    スパン一覧を Server-Timing ヘッダーの値に整形
+    同名のスパンは合計して回数を desc に入れる
+    """
+    merged: Dict[str, List] = {}
+    for name, ms in spans:
+        entry = merged.setdefault(_TOKEN_RE.sub('_', name), [0.0, 0])
+        entry[0] += ms
+        entry[1] += 1
+
+    parts = []
+    for name, (ms, count) in merged.items():
+        part = f'{name};dur={ms:.1f}'
+        if count > 1:
+            part += f';desc="x{count}"'
+        parts.append(part)
+    if total_ms is not None:
+        parts.append(f'total;dur={total_ms:.1f}')
+    return ', '.join(parts)
+
+
+def init_request_timing(app) -> None:
+    """
+    Flask アプリにリクエスト単位のトレースを設定
+    静的ファイル以外のレスポンスに Server-Timing ヘッダーを付け、ログを1行出力する
+    """
+    from flask import g, request
+
+    @app.before_request
+    def _start_request_timing():
+        if request.endpoint == 'static':
+            return
+        g.timing_token = start_trace()
+        g.timing_started = time.perf_counter()
+
+    @app.after_request
+    def _add_server_timing(response):
+        token = g.pop('timing_token', None)
+        if token is None:
+            return response
+        total_ms = (time.perf_counter() - g.pop('timing_started')) * 1000
+        _observe(f'request.{request.endpoint or "unknown"}', total_ms)
+        spans = end_trace(token, 'request', total_ms,
+                          method=request.method, path=request.path,
+                          endpoint=request.endpoint, status=response.status_code)
+        response.headers['Server-Timing'] = format_server_timing(spans, total_ms)
+        return response
+
+    @app.teardown_request
+    def _reset_request_timing(exc=None):
+        # 例外で after_request が呼ばれなかった場合のトレースを破棄
+        token = g.pop('timing_token', None)
+        if token is not None:
+            _current_trace.reset(token)
+
+
+def get_raw_histograms() -> Dict:
+    """プロセス内のヒストグラムの集計値（合算用。get_timing_histograms に渡せる）"""
+    with _histograms_lock:
+        return {name: dict(hist, buckets=list(hist['buckets'])) for name, hist in _histograms.items()}
+
+
+def merge_histograms(histograms_list: List[Dict]) -> Dict:
+    """get_raw_histograms の結果（複数プロセス分）を合算"""
+    merged: Dict[str, Dict] = {}
+    for histograms in histograms_list:
+        for name, hist in histograms.items():
+            total = merged.get(name)
+            if total is None:
+                merged[name] = dict(hist, buckets=list(hist['buckets']))
+                continue
+            total['count'] += hist['count']
+            total['sum_ms'] += hist['sum_ms']
+            total['max_ms'] = max(total['max_ms'], hist['max_ms'])
+            total['buckets'] = [a + b for a, b in zip(total['buckets'], hist['buckets'])]
+    return merged
+
+
+def get_timing_histograms(histograms: Optional[Dict] = None) -> Dict:
+    """
+    段階別のレイテンシヒストグラム
+
+    Args:
+        histograms: get_raw_histograms / merge_histograms の結果（省略時はこのプロセスの集計）
+    """
+    labels = [f'le_{upper}' for upper in HISTOGRAM_BUCKETS_MS] + ['le_inf']
+    if histograms is None:
+        histograms = get_raw_histograms()
+    result = {}
+    for name, hist in sorted(histograms.items()):
+        result[name] = {
+            'count': hist['count'],
+            'avg_ms': round(hist['sum_ms'] / hist['count'], 1) if hist['count'] else None,
+            'max_ms': round(hist['max_ms'], 1),
+            'buckets': dict(zip(labels, hist['buckets'])),
+        }
+    return {'buckets_ms': list(HISTOGRAM_BUCKETS_MS), 'stages': result}
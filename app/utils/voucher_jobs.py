@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+証憑処理ジョブキュー
+T_証憑ジョブ テーブルをキューとして使い、アップロード処理をワーカーへ引き渡す
+
+ステータス遷移: queued → running → done / failed
+"""
+
+import os
+from typing import Dict, List, Optional
+
+from .db import get_db, _is_pg, _sql
+
+
+# 実行中のまま放置されたジョブを再キューするまでの秒数
+STALE_JOB_SECONDS = int(os.environ.get('VOUCHER_JOB_STALE_SECONDS', '900'))
+# 1ジョブあたりの最大試行回数
+MAX_JOB_ATTEMPTS = int(os.environ.get('VOUCHER_JOB_MAX_ATTEMPTS', '3'))
+
+JOB_COLUMNS = (
+    'id', 'tenant_id', 'uploaded_by', '画像パス', '元ファイル名', 'status', 'stage',
+    'progress', 'message', 'warning', 'voucher_id', 'attempts',
+    'created_at', 'started_at', 'finished_at',
+)
+
+
+def _row_to_job(row) -> Optional[Dict]:
+    """SELECT結果をジョブ辞書に変換"""
+    if not row:
+        return None
+    return {col: row[i] for i, col in enumerate(JOB_COLUMNS)}
+
+
+def enqueue_voucher_job(tenant_id: int, user_id: int, filepath: str,
+                        original_filename: Optional[str] = None) -> int:
+    """
+    証憑処理ジョブを登録
+
+    Args:
+        tenant_id: テナントID
+        user_id: アップロードしたユーザーID
+        filepath: 保存済みファイルのパス
+        original_filename: クライアント側のファイル名
+
+    Returns:
+        ジョブID
+    """
+    conn = get_db()
+    cur = conn.cursor()
+
+    sql = '''
+        INSERT INTO "T_証憑ジョブ" (tenant_id, uploaded_by, 画像パス, 元ファイル名, status, progress)
+        VALUES (%s, %s, %s, %s, 'queued', 0)
+    '''
+    params = (tenant_id, user_id, filepath, original_filename)
+
+    if _is_pg(conn):
+        cur.execute(sql + ' RETURNING id', params)
+        job_id = cur.fetchone()[0]
+    else:
+        cur.execute(_sql(conn, sql), params)
+        job_id = cur.lastrowid
+
+    if hasattr(conn, 'commit'):
+        conn.commit()
+    conn.close()
+    return job_id
+
+
+def get_voucher_job(job_id: int, tenant_id: Optional[int] = None) -> Optional[Dict]:
+    """
+    ジョブを取得（tenant_id 指定時はそのテナントのジョブのみ）
+    """
+    conn = get_db()
+    cur = conn.cursor()
+
+    sql = f'SELECT {", ".join(JOB_COLUMNS)} FROM "T_証憑ジョブ" WHERE id = %s'
+    params = [job_id]
+    if tenant_id is not None:
+        sql += ' AND tenant_id = %s'
+        params.append(tenant_id)
+
+    cur.execute(_sql(conn, sql), tuple(params))
+    job = _row_to_job(cur.fetchone())
+    conn.close()
+    return job
+
+
+def claim_next_job(conn, tenant_id: Optional[int] = None) -> Optional[Dict]:
+    """
+    待機中のジョブを1件取得して running にする
+
+    PostgreSQL では FOR UPDATE SKIP LOCKED で複数ワーカー間の競合を避ける。
+    SQLite では status 条件付き UPDATE の成否で取得を判定する。
+
+    Args:
+        conn: DB接続
+        tenant_id: 指定時はそのテナントのジョブのみ取得
+    """
+    cur = conn.cursor()
+    tenant_filter = ' AND tenant_id = %s' if tenant_id is not None else ''
+    params = (tenant_id,) if tenant_id is not None else ()
+
+    if _is_pg(conn):
+        cur.execute(f'''
+            UPDATE "T_証憑ジョブ"
+            SET status = 'running',
+                attempts = attempts + 1,
+                started_at = CURRENT_TIMESTAMP,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = (
+                SELECT id FROM "T_証憑ジョブ"
+                WHERE status = 'queued'{tenant_filter}
+                ORDER BY id
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING {", ".join(JOB_COLUMNS)}
+        ''', params)
+        return _row_to_job(cur.fetchone())
+
+    cur.execute(_sql(conn, f'SELECT id FROM "T_証憑ジョブ" WHERE status = \'queued\'{tenant_filter} ORDER BY id LIMIT 1'), params)
+    row = cur.fetchone()
+    if not row:
+        return None
+
+    cur.execute('''
+        UPDATE "T_証憑ジョブ"
+        SET status = 'running',
+            attempts = attempts + 1,
+            started_at = CURRENT_TIMESTAMP,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = ? AND status = 'queued'
+    ''', (row[0],))
+    conn.commit()
+    if cur.rowcount != 1:
+        # 他のワーカーが先に取得した
+        return None
+
+    cur.execute(f'SELECT {", ".join(JOB_COLUMNS)} FROM "T_証憑ジョブ" WHERE id = ?', (row[0],))
+    return _row_to_job(cur.fetchone())
+
+
+def claim_job_batch(conn, limit: int) -> List[Dict]:
+    """
+    待機中のジョブを同一テナントでまとめて最大 limit 件取得する
+    （バッチOCRでまとめて処理するため）
+
+    先頭のジョブがバッチOCR済みでキューに戻されたもの（stage が 'ocr_prefetched'）なら1件だけ返す
+    """
+    first = claim_next_job(conn)
+    if first is None:
+        return []
+    if first['stage'] == 'ocr_prefetched':
+        return [first]
+
+    jobs = [first]
+    while len(jobs) < limit:
+        job = claim_next_job(conn, tenant_id=first['tenant_id'])
+        if job is None:
+            break
+        jobs.append(job)
+    return jobs
+
+
+def release_jobs(conn, job_ids: List[int]) -> None:
+    """
+    取得したがまだ処理していないジョブを queued に戻す（試行回数も戻す）
+    バッチOCRの後に他のワーカーが処理できるようにするため。
+    stage を 'ocr_prefetched' にしておき、次に取得したワーカーがもう一度まとめて取得しないようにする
+    """
+    if not job_ids:
+        return
+    cur = conn.cursor()
+    placeholders = ', '.join(['%s'] * len(job_ids))
+    cur.execute(_sql(conn, f'''
+        UPDATE "T_証憑ジョブ"
+        SET status = 'queued', stage = 'ocr_prefetched', attempts = attempts - 1, started_at = NULL,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id IN ({placeholders}) AND status = 'running'
+    '''), list(job_ids))
+    if hasattr(conn, 'commit'):
+        conn.commit()
+
+
+def update_job_progress(conn, job_id: int, stage: str, progress: int) -> None:
+    """ジョブの処理段階と進捗率を更新"""
+    cur = conn.cursor()
+    cur.execute(_sql(conn, '''
+        UPDATE "T_証憑ジョブ"
+        SET stage = %s, progress = %s, updated_at = CURRENT_TIMESTAMP
+        WHERE id = %s
+    '''), (stage, progress, job_id))
+    if hasattr(conn, 'commit'):
+        conn.commit()
+
+
+def complete_job(conn, job_id: int, voucher_id: Optional[int], warning: Optional[str] = None) -> None:
+    """ジョブを完了にする"""
+    cur = conn.cursor()
+    cur.execute(_sql(conn, '''
+        UPDATE "T_証憑ジョブ"
+        SET status = 'done', stage = 'done', progress = 100,
+            voucher_id = %s, warning = %s, message = NULL,
+            finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+        WHERE id = %s
+    '''), (voucher_id, warning, job_id))
+    if hasattr(conn, 'commit'):
+        conn.commit()
+
+
+def fail_job(conn, job_id: int, message: str, attempts: int) -> None:
+    """
+    ジョブを失敗にする
+    試行回数が上限未満なら queued に戻して再実行させる
+    """
+    status = 'queued' if attempts < MAX_JOB_ATTEMPTS else 'failed'
+    cur = conn.cursor()
+    cur.execute(_sql(conn, '''
+        UPDATE "T_証憑ジョブ"
+        SET status = %s, message = %s,
+            finished_at = CASE WHEN %s = 'failed' THEN CURRENT_TIMESTAMP ELSE NULL END,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = %s
+    '''), (status, message[:1000], status, job_id))
+    if hasattr(conn, 'commit'):
+        conn.commit()
+
+
+def requeue_stale_jobs(conn, stale_seconds: int = STALE_JOB_SECONDS) -> int:
+    """
+    ワーカー停止などで running のまま残ったジョブを queued に戻す
+
+    Returns:
+        再キューしたジョブ数
+    """
+    cur = conn.cursor()
+    if _is_pg(conn):
+        cur.execute('''
+            UPDATE "T_証憑ジョブ"
+            SET status = 'queued', updated_at = CURRENT_TIMESTAMP
+            WHERE status = 'running'
+              AND updated_at < CURRENT_TIMESTAMP - (%s * INTERVAL '1 second')
+        ''', (stale_seconds,))
+    else:
+        cur.execute('''
+            UPDATE "T_証憑ジョブ"
+            SET status = 'queued', updated_at = CURRENT_TIMESTAMP
+            WHERE status = 'running'
+              AND updated_at < datetime('now', ?)
+        ''', (f'-{int(stale_seconds)} seconds',))
+    if hasattr(conn, 'commit'):
+        conn.commit()
+    return cur.rowcount or 0
+
+
+def job_to_status(job: Dict) -> Dict:
+    """ステータスAPI用にジョブ情報を整形"""
+    return {
+        'job_id': job['id'],
+        'status': job['status'],
+        'stage': job['stage'],
+        'progress': job['progress'] or 0,
+        'message': job['message'],
+        'warning': job['warning'],
+        'voucher_id': job['voucher_id'],
+        'filename': job['元ファイル名'],
+    }
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+証憑処理パイプライン
+アップロード済みファイルに対して OCR → AI補正 → 国税庁検索 → DB保存 を実行する
+
+Webリクエストからは呼び出さず、app.worker のワーカープロセスから
+ジョブ単位で実行される。
+"""
+
+from typing import Callable, Dict, Optional
+
+from .db import get_db, _is_pg, _sql
+from .ocr import process_receipt_image
+from .field_extraction import extract_receipt_fields
+from .nta_api_enhanced import enhanced_company_search
+from .company_index import mark_company_index_stale
+from .duplicate_detection import check_receipt_duplicates, register_receipt, format_duplicate_warning
+from .ai_helper import (
+    AI_COMBINED_EXTRACTION, correct_ocr_text, extract_voucher_with_ai, normalize_company_name_with_ai
+)
+from .timing import span
+from .ocr_confidence import score_ocr_result, needs_ai_correction, needs_company_normalization
+
+
+# 進捗コールバック: (stage, progress%) を受け取る
+ProgressCallback = Callable[[str, int], None]
+
+
+def load_tenant_ai_settings(tenant_id: int) -> Dict:
+    """
+    テナントのAI設定・APIキーを取得
+
+    Args:
+        tenant_id: テナントID
+
+    Returns:
+        {'ai_model': ..., 'api_keys': {...}, 'google_vision_api_key': ...,
+         'ai_confidence_threshold': ...（未設定ならNone）}
+    """
+    settings = {
+        'ai_model': 'gemini-1.5-flash',  # デフォルト
+        'api_keys': {},
+        'google_vision_api_key': None,
+        'ai_confidence_threshold': None,
+    }
+
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        cur.execute(_sql(conn, '''
+            SELECT ai_model, openai_api_key, google_api_key, anthropic_api_key, google_vision_api_key
+            FROM "T_テナント" WHERE id = %s
+        '''), (tenant_id,))
+        tenant_settings = cur.fetchone()
+        if tenant_settings:
+            settings['ai_model'] = tenant_settings[0] or 'gemini-1.5-flash'
+            settings['api_keys'] = {
+                'openai_api_key': tenant_settings[1],
+                'google_api_key': tenant_settings[2],
+                'anthropic_api_key': tenant_settings[3],
+            }
+            settings['google_vision_api_key'] = tenant_settings[4] if len(tenant_settings) > 4 else None
+    except Exception as e:
+        print(f"AI設定取得エラー: {e}")
+
+    # AI補正のしきい値（カラム追加前のDBでも他の設定は使えるよう別に取得）
+    try:
+        cur.execute(_sql(conn, 'SELECT ai_confidence_threshold FROM "T_テナント" WHERE id = %s'), (tenant_id,))
+        row = cur.fetchone()
+        if row and row[0] is not None:
+            settings['ai_confidence_threshold'] = int(row[0])
+    except Exception as e:
+        print(f"AI補正しきい値取得エラー: {e}")
+    finally:
+        conn.close()
+
+    return settings
+
+
+def save_company_info(tenant_id: int, company_info: Dict,
+                      corporate_number: Optional[str], invoice_number: Optional[str],
+                      company_name: Optional[str] = None) -> Optional[int]:
+    """
+    企業情報をデータベースに保存（既存の場合はそのIDを返す）
+    company_name は検索結果に会社名が無いときに登録する会社名（正規化後の名称）
+
+    Returns:
+        T_企業情報.id
+    """
+    conn = get_db()
+    cur = conn.cursor()
+
+    # 既存の企業情報をチェック
+    check_sql = _sql(conn, '''
+        SELECT id FROM "T_企業情報"
+        WHERE 法人番号 = %s OR インボイス登録番号 = %s
+    ''')
+    cur.execute(check_sql, (corporate_number, invoice_number))
+    existing = cur.fetchone()
+
+    if existing:
+        company_id = existing[0] if isinstance(existing, tuple) else existing['id']
+    else:
+        # 新規企業情報を登録
+        insert_company_sql = _sql(conn, '''
+            INSERT INTO "T_企業情報" (
+                tenant_id,
+                法人番号,
+                インボイス登録番号,
+                会社名,
+                会社名カナ,
+                郵便番号,
+                住所,
+                都道府県,
+                市区町村,
+                番地,
+                インボイス登録有無,
+                インボイス登録日,
+                法人種別
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ''')
+
+        cur.execute(insert_company_sql, (
+            tenant_id,
+            company_info.get('法人番号'),
+            company_info.get('インボイス登録番号'),
+            company_info.get('会社名') or company_name,
+            company_info.get('会社名カナ'),
+            company_info.get('郵便番号'),
+            company_info.get('住所'),
+            company_info.get('都道府県'),
+            company_info.get('市区町村'),
+            company_info.get('番地'),
+            company_info.get('インボイス登録有無', 0),
+            company_info.get('インボイス登録日'),
+            company_info.get('法人種別')
+        ))
+
+        if hasattr(conn, 'commit'):
+            conn.commit()
+
+        # 挿入されたIDを取得
+        company_id = cur.lastrowid
+        mark_company_index_stale(tenant_id)
+
+    conn.close()
+    return company_id
+
+
+def save_voucher(tenant_id: int, user_id: int, company_id: Optional[int],
+                 filepath: str, ocr_result: Dict,
+                 phone: Optional[str], address: Optional[str]) -> Optional[int]:
+    """
+    証憑情報をデータベースに保存
+
+    Returns:
+        T_証憑.id
+    """
+    conn = get_db()
+    cur = conn.cursor()
+
+    sql = '''
+        INSERT INTO "T_証憑" (
+            tenant_id,
+            uploaded_by,
+            company_id,
+            画像パス,
+            OCR結果_生データ,
+            電話番号,
+            住所,
+            金額,
+            日付,
+            摘要,
+            勘定科目,
+            ステータス
+        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    '''
+    params = (
+        tenant_id,
+        user_id,
+        company_id,
+        filepath,
+        ocr_result['raw_text'],
+        phone,
+        address,
+        ocr_result['amount'],
+        ocr_result['date'],
+        ocr_result.get('description'),
+        ocr_result.get('account_subject'),
+        'pending'
+    )
+
+    if _is_pg(conn):
+        cur.execute(sql + ' RETURNING id', params)
+        row = cur.fetchone()
+        voucher_id = row[0] if row else None
+    else:
+        cur.execute(_sql(conn, sql), params)
+        voucher_id = cur.lastrowid
+
+    if hasattr(conn, 'commit'):
+        conn.commit()
+
+    conn.close()
+    return voucher_id
+
+
+def apply_ai_extraction(ocr_result: Dict, confidence: Dict, threshold: Optional[int],
+                        ai_model: str, api_keys: Dict, tenant_id: int) -> None:
+    """
+    信頼度が低いときだけAIを呼び、結果を ocr_result に反映する
+
+    - OCR補正が必要なとき: extract_voucher_with_ai を1回呼び、電話番号・住所・会社名を置き換え、
+      読み取れなかった番号・日付・金額を補う。正式名称（normalized_company_name）・
+      勘定科目（account_subject）・摘要（description）も同じ応答から入れる
+    - 会社名の正規化だけが必要なとき: OCR全文は送らず、会社名だけを normalize_company_name_with_ai に送る
+      （勘定科目は入れない。仕訳生成時にキーワードで推定する）
+    """
+    need_correction = needs_ai_correction(confidence, threshold)
+    need_normalization = bool(ocr_result.get('company_name')) and needs_company_normalization(confidence, threshold)
+    if not (need_correction or need_normalization):
+        return
+
+    if not need_correction:
+        try:
+            ocr_result['normalized_company_name'] = normalize_company_name_with_ai(
+                ocr_result['company_name'], ai_model, api_keys, tenant_id=tenant_id
+            )
+        except Exception as e:
+            print(f"AI会社名正規化エラー: {e}")
+        return
+
+    extracted = extract_voucher_with_ai(ocr_result.get('full_text', ''), ai_model, api_keys, tenant_id=tenant_id)
+    if not extracted:
+        return
+
+    ocr_result['phone_numbers'] = extracted['phone_numbers']
+    ocr_result['addresses'] = extracted['addresses']
+    ocr_result['company_name'] = extracted['company_name']
+    for key in ('invoice_number', 'date', 'amount'):
+        if not ocr_result.get(key):
+            ocr_result[key] = extracted[key]
+    ocr_result['normalized_company_name'] = extracted['normalized_company_name']
+    ocr_result['account_subject'] = extracted['account_subject']
+    ocr_result['description'] = extracted['description']
+
+
+def run_voucher_pipeline(tenant_id: int, user_id: int, filepath: str,
+                         progress: Optional[ProgressCallback] = None) -> Dict:
+    """
+    アップロード済みファイル1件を処理して T_証憑 に登録
+
+    Args:
+        tenant_id: テナントID
+        user_id: アップロードしたユーザーID
+        filepath: 保存済みファイルのパス
+        progress: 進捗コールバック（任意）
+
+    Returns:
+        {'voucher_id': ..., 'company_id': ..., 'warning': ..., 'account_subject': ..., 'duplicates': [...]}
+        account_subject は一括抽出でAIが推定した勘定科目（AIを使わなかった場合はNone）
+        duplicates は同じレシートと思われる登録済み証憑（警告のみで、登録は行う）
+    """
+    def report(stage: str, percent: int):
+        if progress:
+            progress(stage, percent)
+
+    # AI設定を取得（OCR処理前に取得）
+    report('settings', 5)
+    with span('pipeline.settings'):
+        settings = load_tenant_ai_settings(tenant_id)
+    ai_model = settings['ai_model']
+    api_keys = settings['api_keys']
+
+    # OCR処理（Google Cloud Vision APIキーがあれば使用）
+    report('ocr', 10)
+    with span('pipeline.ocr'):
+        ocr_result = process_receipt_image(filepath, google_vision_api_key=settings['google_vision_api_key'])
+
+    # 抽出結果の信頼度が低いときだけAIで補正する
+    has_ai_key = bool(api_keys.get('google_api_key') or api_keys.get('openai_api_key'))
+    threshold = settings['ai_confidence_threshold']
+    confidence = score_ocr_result(ocr_result)
+    print(f"OCR信頼度: {confidence['score']}")
+
+    # AI補正・会社名正規化・勘定科目推定を1回の呼び出しでまとめて行う
+    report('ai_correction', 40)
+    combined = has_ai_key and AI_COMBINED_EXTRACTION
+    if combined:
+        apply_ai_extraction(ocr_result, confidence, threshold, ai_model, api_keys, tenant_id)
+
+    # AIでOCR結果を補正（AI_COMBINED_EXTRACTION=0 のときは個別に呼び出す）
+    try:
+        if has_ai_key and not combined and needs_ai_correction(confidence, threshold):
+            corrected_text = correct_ocr_text(
+                ocr_result.get('full_text', ''),
+                ai_model,
+                api_keys,
+                tenant_id=tenant_id
+            )
+            # 補正後のテキストを再解析
+            corrected_fields = extract_receipt_fields(corrected_text)
+            ocr_result['phone_numbers'] = corrected_fields['phone_numbers']
+            ocr_result['addresses'] = corrected_fields['addresses']
+            ocr_result['company_name'] = corrected_fields['company_name']
+            confidence = score_ocr_result(ocr_result)
+    except Exception as e:
+        print(f"AI補正エラー: {e}")
+
+    # 電話番号と住所は最初の1件を使用
+    phone = ocr_result['phone_numbers'][0] if ocr_result['phone_numbers'] else None
+    address = ocr_result['addresses'][0] if ocr_result['addresses'] else None
+    company_name = ocr_result.get('normalized_company_name') or ocr_result.get('company_name')
+
+    # AIで会社名を正規化
+    if company_name and has_ai_key and not combined and needs_company_normalization(confidence, threshold):
+        try:
+            company_name = normalize_company_name_with_ai(
+                company_name,
+                ai_model,
+                api_keys,
+                tenant_id=tenant_id
+            ) or company_name
+        except Exception as e:
+            print(f"AI会社名正規化エラー: {e}")
+
+    # 以降の企業検索・登録は正規化後の会社名で行う（OCRで読んだ会社名は ocr_company_name に残す）
+    if company_name and company_name != ocr_result.get('company_name'):
+        ocr_result['ocr_company_name'] = ocr_result.get('company_name')
+        ocr_result['company_name'] = company_name
+
+    # 拡張検索フローを使用
+    report('company_search', 60)
+    with span('pipeline.company_search'):
+        search_result = enhanced_company_search(ocr_result, tenant_id=tenant_id)
+
+    company_id = None
+    invoice_number = search_result.get('invoice_number')
+    corporate_number = search_result.get('corporate_number')
+    company_info = search_result.get('company_info')
+
+    # 検証結果をチェック
+    warnings = []
+    if not search_result.get('verification_passed') and search_result.get('warning_message'):
+        warnings.append(search_result['warning_message'])
+
+    # 同じレシートが登録済みか（OCR結果で判定。警告のみ）
+    with span('pipeline.dedupe'):
+        duplicates = check_receipt_duplicates(tenant_id, ocr_result)
+    if duplicates:
+        warnings.append(format_duplicate_warning(duplicates))
+    warning = ' / '.join(warnings) if warnings else None
+
+    report('saving', 85)
+    with span('pipeline.save'):
+        if company_info:
+            company_id = save_company_info(tenant_id, company_info, corporate_number, invoice_number,
+                                           company_name=company_name)
+
+        # データベースに証憑情報を保存
+        voucher_id = save_voucher(tenant_id, user_id, company_id, filepath, ocr_result, phone, address)
+        register_receipt(tenant_id, voucher_id, ocr_result)
+
+    return {
+        'voucher_id': voucher_id,
+        'company_id': company_id,
+        'warning': warning,
+        'account_subject': ocr_result.get('account_subject'),
+        'duplicates': duplicates,
+    }
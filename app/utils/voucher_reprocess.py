@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+登録済み証憑の一括再処理
+抽出ロジックやOCRエンジンを改善したときに、過去の T_証憑 を処理し直す
+
+モード:
+- extract: 保存済みの OCR結果_生データ に項目抽出（extract_receipt_fields）だけを再実行
+- reocr:   保存済みの画像を再OCRしてから項目抽出（OCR結果_生データ も更新）
+
+- T_証憑 を id のキーセットページング（id > 前回の最大id）でバッチ単位に読み出す
+- バッチをプロセスプールに分配して並列に処理し、結果は親プロセスで executemany でまとめて書き戻す
+- 書き戻しが済んだ位置をチェックポイントファイルに記録し、中断後は続きから再開する
+  （バッチの完了順は前後するため、それより前のバッチがすべて書き戻された位置までを記録する）
+- 新しい抽出結果が空の項目は上書きしない
+- 金額・日付が変わった証憑は、重複チェック用の T_証憑重複指紋 も同じバッチで作り直す
+"""
+
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Callable, Dict, List, Optional
+
+from .db import get_db, _sql
+
+
+MODES = ('extract', 'reocr')
+REPROCESS_BATCH_SIZE = int(os.environ.get('REPROCESS_BATCH_SIZE', '500'))
+
+# 抽出結果で書き戻す T_証憑 の列
+_FIELD_COLUMNS = ('電話番号', '住所', '金額', '日付')
+
+
+def _fields_from_extraction(fields: Dict) -> Dict:
+    """抽出結果を T_証憑 の列の値にする（パイプラインと同じく電話番号・住所は先頭の1件）"""
+    return {
+        '電話番号': fields['phone_numbers'][0] if fields.get('phone_numbers') else None,
+        '住所': fields['addresses'][0] if fields.get('addresses') else None,
+        '金額': fields.get('amount'),
+        '日付': fields.get('date'),
+    }
+
+
+def _normalize(value):
+    """DB の値と抽出結果を比較できる形にそろえる"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (Decimal, float, int)):
+        return float(value)
+    if isinstance(value, (date, datetime)):
+        return value.strftime('%Y-%m-%d')
+    return str(value)
+
+
+def _changed_fields(row: Dict, new_values: Dict) -> Dict:
+    """値が得られ、かつ現在の値と異なる項目"""
+    return {
+        column: value for column, value in new_values.items()
+        if value is not None and _normalize(value) != _normalize(row.get(column))
+    }
+
+
+def process_batch(mode: str, rows: List[Dict]) -> List[Dict]:
+    """
+    1バッチを処理（プロセスプールのワーカーで実行される）
+
+    Args:
+        mode: 'extract' / 'reocr'
+        rows: T_証憑 の行（id, 画像パス, OCR結果_生データ, 現在の項目値, vision_api_key）
+
+    Returns:
+        [{'id', 'fields': {列: 新しい値}, 'raw_text': 再OCRしたテキスト or None, 'error'}, ...]
+    """
+    from .field_extraction import extract_receipt_fields
+
+    results = []
+    for row in rows:
+        try:
+            raw_text = None
+            if mode == 'reocr':
+                from .ocr import process_receipt_image
+                if not row['画像パス'] or not os.path.exists(row['画像パス']):
+                    raise FileNotFoundError(f"画像がありません: {row['画像パス']}")
+                # キャッシュ済みのテキストではなく画像から読み直す（結果でキャッシュも更新される）
+                ocr_result = process_receipt_image(row['画像パス'],
+                                                   google_vision_api_key=row.get('vision_api_key'),
+                                                   use_cache=False)
+                raw_text = ocr_result.get('raw_text') or ''
+                if not raw_text.strip():
+                    # 保存済みのテキストを空で上書きしない
+                    raise ValueError('再OCRの結果が空でした')
+                new_values = _fields_from_extraction(ocr_result)
+            else:
+                new_values = _fields_from_extraction(extract_receipt_fields(row['OCR結果_生データ'] or ''))
+
+            fields = _changed_fields(row, new_values)
+            if raw_text is not None and raw_text != (row['OCR結果_生データ'] or ''):
+                results.append({'id': row['id'], 'fields': fields, 'raw_text': raw_text, 'error': None})
+            elif fields:
+                results.append({'id': row['id'], 'fields': fields, 'raw_text': None, 'error': None})
+        except Exception as e:
+            results.append({'id': row['id'], 'fields': {}, 'raw_text': None, 'error': str(e)})
+    return results
+
+
+def _fetch_batch(conn, after_id: int, limit: int, tenant_id: Optional[int],
+                 status: Optional[str]) -> List[Dict]:
+    """id が after_id より大きい行を id 順に limit 件取得（キーセットページング）"""
+    conditions = ['id > %s']
+    params = [after_id]
+    if tenant_id is not None:
+        conditions.append('tenant_id = %s')
+        params.append(tenant_id)
+    if status:
+        conditions.append('ステータス = %s')
+        params.append(status)
+    params.append(limit)
+
+    cur = conn.cursor()
+    cur.execute(_sql(conn, f'''
+        SELECT id, tenant_id, 画像パス, OCR結果_生データ, 電話番号, 住所, 金額, 日付
+        FROM "T_証憑"
+        WHERE {' AND '.join(conditions)}
+        ORDER BY id
+        LIMIT %s
+    '''), params)
+    columns = ('id', 'tenant_id', '画像パス', 'OCR結果_生データ') + _FIELD_COLUMNS
+    return [{col: row[i] for i, col in enumerate(columns)} for row in cur.fetchall()]
+
+
+def _rewrite_fingerprints(conn, voucher_ids: List[int]) -> None:
+    """書き戻し後の金額・日付で T_証憑重複指紋 を作り直す（呼び出し側でコミットする）"""
+    from .duplicate_detection import receipt_fingerprint
+
+    cur = conn.cursor()
+    placeholders = ', '.join(['%s'] * len(voucher_ids))
+    cur.execute(_sql(conn, f'''
+        SELECT id, tenant_id, 金額, 日付 FROM "T_証憑" WHERE id IN ({placeholders})
+    '''), tuple(voucher_ids))
+    rows = cur.fetchall()
+    cur.execute(_sql(conn, f'''
+        DELETE FROM "T_証憑重複指紋" WHERE voucher_id IN ({placeholders})
+    '''), tuple(voucher_ids))
+    inserts = []
+    for voucher_id, tenant_id, amount, voucher_date in rows:
+        fingerprint = receipt_fingerprint({'amount': amount, 'date': voucher_date})
+        if fingerprint:
+            inserts.append((tenant_id, voucher_id, fingerprint))
+    if inserts:
+        cur.executemany(_sql(conn, '''
+            INSERT INTO "T_証憑重複指紋" (tenant_id, voucher_id, fingerprint)
+            VALUES (%s, %s, %s)
+        '''), inserts)
+
+
+def _write_results(conn, results: List[Dict]) -> int:
+    """
+    処理結果を executemany でまとめて書き戻す
+    項目ごとに COALESCE で「値が無ければ現状維持」にし、1種類の UPDATE 文で済ませる
+    金額・日付が変わった証憑は重複チェック用の指紋も同じバッチで作り直す
+    """
+    params = []
+    fingerprint_ids = []
+    for result in results:
+        if result['error'] or not (result['fields'] or result['raw_text'] is not None):
+            continue
+        fields = result['fields']
+        params.append((
+            result['raw_text'],
+            *(fields.get(column) for column in _FIELD_COLUMNS),
+            result['id'],
+        ))
+        if fields.get('金額') is not None or fields.get('日付') is not None:
+            fingerprint_ids.append(result['id'])
+    if not params:
+        return 0
+
+    cur = conn.cursor()
+    cur.executemany(_sql(conn, '''
+        UPDATE "T_証憑"
+        SET OCR結果_生データ = COALESCE(%s, OCR結果_生データ),
+            電話番号 = COALESCE(%s, 電話番号),
+            住所 = COALESCE(%s, 住所),
+            金額 = COALESCE(%s, 金額),
+            日付 = COALESCE(%s, 日付),
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = %s
+    '''), params)
+    if fingerprint_ids:
+        _rewrite_fingerprints(conn, fingerprint_ids)
+    if hasattr(conn, 'commit'):
+        conn.commit()
+    return len(params)
+
+
+def load_checkpoint(path: str) -> Optional[Dict]:
+    """チェックポイントを読み込む（無ければNone）"""
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_checkpoint(path: str, state: Dict) -> None:
+    """チェックポイントを書き込む（途中で落ちても壊れないよう置き換える）"""
+    if not path:
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def reprocess_vouchers(mode: str = 'extract',
+                       tenant_id: Optional[int] = None,
+                       status: Optional[str] = 'pending',
+                       batch_size: int = None,
+                       workers: int = None,
+                       checkpoint_path: Optional[str] = None,
+                       restart: bool = False,
+                       limit: Optional[int] = None,
+                       dry_run: bool = False,
+                       report: Optional[Callable[[Dict], None]] = None) -> Dict:
+    """
+    T_証憑 を一括で再処理
+
+    Args:
+        mode: 'extract'（保存済みテキストから再抽出）/ 'reocr'（画像を再OCR）
+        tenant_id: 対象テナント（省略時は全テナント）
+        status: 対象のステータス（既定は 'pending'。None なら確認済みも含めてすべて）
+        batch_size: 1バッチの件数（既定: REPROCESS_BATCH_SIZE）
+        workers: プロセス数（既定: CPUコア数）
+        checkpoint_path: チェックポイントファイル（None なら再開しない）
+        restart: チェックポイントを無視して最初から処理する
+        limit: 処理する最大件数
+        dry_run: 書き戻さずに件数だけ数える
+        report: バッチを書き戻すたびに進捗（集計値の辞書）を受け取る関数
+
+    Returns:
+        {'processed', 'updated', 'errors', 'last_id', 'elapsed_sec', 'rate'}
+    """
+    if mode not in MODES:
+        raise ValueError(f"mode は {', '.join(MODES)} のいずれか: {mode}")
+    batch_size = batch_size or REPROCESS_BATCH_SIZE
+    workers = max(1, workers or os.cpu_count() or 1)
+    scope = {'mode': mode, 'tenant_id': tenant_id, 'status': status}
+
+    state = {**scope, 'last_id': 0, 'processed': 0, 'updated': 0, 'errors': 0}
+    checkpoint = None if restart else load_checkpoint(checkpoint_path)
+    if checkpoint:
+        if any(checkpoint.get(key) != value for key, value in scope.items()):
+            raise ValueError(f"チェックポイント {checkpoint_path} は別の条件の処理です（--restart で最初から）")
+        state.update(checkpoint)
+
+    vision_keys: Dict[int, Optional[str]] = {}
+
+    def _vision_key(row_tenant_id: int) -> Optional[str]:
+        if row_tenant_id not in vision_keys:
+            from .voucher_pipeline import load_tenant_ai_settings
+            vision_keys[row_tenant_id] = load_tenant_ai_settings(row_tenant_id)['google_vision_api_key']
+        return vision_keys[row_tenant_id]
+
+    started = time.perf_counter()
+    processed_this_run = 0
+    submitted_this_run = 0
+    conn = get_db()
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    # 投入順のバッチ [(future, バッチ内の最大id, 件数)]。先頭から順に書き戻す
+    pending: List = []
+    cursor_id = state['last_id']
+    exhausted = False
+    reached_end = False
+
+    def _update_rate() -> None:
+        elapsed = time.perf_counter() - started
+        state['elapsed_sec'] = round(elapsed, 1)
+        state['rate'] = round(processed_this_run / elapsed, 1) if elapsed > 0 else None
+
+    try:
+        while pending or not exhausted:
+            # プロセス数の2倍までバッチを先読みして投入する
+            while not exhausted and len(pending) < workers * 2:
+                fetch_size = batch_size if limit is None else min(batch_size, limit - submitted_this_run)
+                if fetch_size <= 0:
+                    exhausted = True
+                    break
+                rows = _fetch_batch(conn, cursor_id, fetch_size, tenant_id, status)
+                if not rows:
+                    exhausted = reached_end = True
+                    break
+                if mode == 'reocr':
+                    for row in rows:
+                        row['vision_api_key'] = _vision_key(row['tenant_id'])
+                cursor_id = rows[-1]['id']
+                submitted_this_run += len(rows)
+                pending.append((executor.submit(process_batch, mode, rows), cursor_id, len(rows)))
+
+            if not pending:
+                break
+            wait([pending[0][0]], return_when=FIRST_COMPLETED)
+
+            # 先頭から完了しているバッチを書き戻し、チェックポイントを進める
+            while pending and pending[0][0].done():
+                future, last_id, count = pending.pop(0)
+                results = future.result()
+                errors = [r for r in results if r['error']]
+                for result in errors[:5]:
+                    print(f"再処理エラー (voucher={result['id']}): {result['error']}")
+                updated = len([r for r in results if not r['error']]) if dry_run else _write_results(conn, results)
+
+                state['last_id'] = last_id
+                state['processed'] += count
+                state['updated'] += updated
+                state['errors'] += len(errors)
+                processed_this_run += count
+                _update_rate()
+                if not dry_run:
+                    save_checkpoint(checkpoint_path, state)
+                if report:
+                    report(dict(state))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        conn.close()
+
+    _update_rate()
+    state['completed'] = reached_end
+    if state['completed'] and checkpoint_path and not dry_run and os.path.exists(checkpoint_path):
+        # 最後まで終わったら次回は最初から処理する
+        os.remove(checkpoint_path)
+    return state
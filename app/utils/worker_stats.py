@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+ワーカープロセスの集計値の共有
+
+OCR・AI・国税庁検索の集計値（_stats）と処理時間のヒストグラムはプロセスごとに持っているが、
+パイプラインは `python -m app.worker` の各プロセスで動くため、Web プロセスの /healthz からは見えない。
+各ワーカーは WORKER_STATS_INTERVAL 秒ごとに自分の集計値のスナップショットを T_ワーカー統計 に書き、
+/healthz・/healthz/timings は Web プロセスの値と、更新が新しいスナップショットを合算して返す。
+
+合算のルール:
+- 件数（int）と、省いた時間・費用（saved_ms / saved_yen）は合計
+- 比率・平均・設定値・状態などそれ以外の値は、全プロセスで同じならその値、違えばプロセスごとの値の一覧
+"""
+
+import importlib
+import json
+import os
+import socket
+import time
+from typing import Dict, List, Optional
+
+from .db import get_db, _sql
+from .timing import get_raw_histograms, merge_histograms
+
+
+# スナップショットを書く間隔（秒）
+WORKER_STATS_INTERVAL = float(os.environ.get('WORKER_STATS_INTERVAL', '30'))
+# この秒数より古いスナップショット（停止したワーカー）は合算しない
+WORKER_STATS_MAX_AGE = float(os.environ.get('WORKER_STATS_MAX_AGE', str(WORKER_STATS_INTERVAL * 3)))
+
+# /healthz の項目名 → (モジュール, 集計関数)。ワーカーでも値が増える項目
+STATS_SECTIONS = {
+    'ocr_cache': ('ocr_cache', 'get_ocr_cache_stats'),
+    'ocr_engines': ('ocr_engines', 'get_ocr_engine_stats'),
+    'ai_gate': ('ocr_confidence', 'get_ai_gate_stats'),
+    'image_decode': ('image_preprocess', 'get_decode_stats'),
+    'duplicates': ('duplicate_detection', 'get_duplicate_stats'),
+    'http_clients': ('http_clients', 'get_http_client_stats'),
+    'nta_cache': ('nta_cache', 'get_nta_cache_stats'),
+    'nta_mirror': ('nta_mirror', 'get_mirror_stats'),
+    'nta_lookups': ('nta_api_enhanced', 'get_nta_lookup_stats'),
+    'nta_resilience': ('nta_api', 'get_nta_resilience_stats'),
+    'company_index': ('company_index', 'get_company_index_stats'),
+    'ai_cache': ('ai_cache', 'get_ai_cache_stats'),
+    'ai_extraction': ('ai_helper', 'get_ai_extraction_stats'),
+}
+
+# int でも合計しない値（設定値・プロセスごとの状態）
+_NON_ADDITIVE_KEYS = {
+    'lru_capacity', 'ttl', 'negative_ttl', 'threshold_default', 'max_retries', 'burst',
+    'tenants', 'companies', 'consecutive_failures',
+}
+# float でも合計する値
+_ADDITIVE_FLOAT_KEYS = {'saved_ms', 'saved_yen'}
+
+
+def collect_process_stats() -> Dict:
+    """このプロセスの STATS_SECTIONS の集計値"""
+    stats = {}
+    for section, (module, func) in STATS_SECTIONS.items():
+        try:
+            stats[section] = getattr(importlib.import_module(f'{__package__}.{module}'), func)()
+        except Exception as e:
+            stats[section] = {'error': str(e)}
+    return stats
+
+
+def _merge_values(key: Optional[str], values: List):
+    if all(isinstance(v, dict) for v in values):
+        keys = []
+        for value in values:
+            keys += [k for k in value if k not in keys]
+        return {k: _merge_values(k, [v[k] for v in values if k in v]) for k in keys}
+    if key not in _NON_ADDITIVE_KEYS and all(
+            isinstance(v, int) and not isinstance(v, bool) for v in values):
+        return sum(values)
+    if key in _ADDITIVE_FLOAT_KEYS and all(isinstance(v, (int, float)) for v in values):
+        return round(sum(values), 2)
+    if all(v == values[0] for v in values):
+        return values[0]
+    return values
+
+
+def merge_stats(snapshots: List[Dict]) -> Dict:
+    """collect_process_stats の結果（複数プロセス分）を合算"""
+    if not snapshots:
+        return {}
+    return _merge_values(None, snapshots)
+
+
+def worker_key(worker_index: int) -> str:
+    """スナップショットの行のキー（再起動したワーカーは同じ行を上書きする）"""
+    return f"{os.environ.get('DYNO') or socket.gethostname()}:{worker_index}"
+
+
+def publish_worker_stats(key: str) -> None:
+    """このプロセスの集計値とヒストグラムを T_ワーカー統計 に書く"""
+    snapshot = json.dumps({'stats': collect_process_stats(), 'timings': get_raw_histograms()},
+                          ensure_ascii=False, default=str)
+    conn = get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute(_sql(conn, '''
+            INSERT INTO "T_ワーカー統計" (worker_key, pid, stats, updated_at)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (worker_key) DO UPDATE SET
+                pid = excluded.pid, stats = excluded.stats, updated_at = excluded.updated_at
+        '''), (key, os.getpid(), snapshot, time.time()))
+        if hasattr(conn, 'commit'):
+            conn.commit()
+    finally:
+        conn.close()
+
+
+def load_worker_snapshots(max_age: Optional[float] = None) -> List[Dict]:
+    """
+    更新が新しいワーカーのスナップショット
+
+    Returns:
+        [{'worker_key', 'pid', 'age_sec', 'stats': {...}, 'timings': {...}}, ...]
+    """
+    max_age = WORKER_STATS_MAX_AGE if max_age is None else max_age
+    now = time.time()
+    conn = get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute(_sql(conn, '''
+            SELECT worker_key, pid, stats, updated_at FROM "T_ワーカー統計"
+            WHERE updated_at >= %s ORDER BY worker_key
+        '''), (now - max_age,))
+        rows = cur.fetchall()
+    finally:
+        conn.close()
+
+    snapshots = []
+    for row in rows:
+        try:
+            data = json.loads(row[2])
+        except (TypeError, ValueError):
+            continue
+        snapshots.append({
+            'worker_key': row[0],
+            'pid': row[1],
+            'age_sec': round(now - row[3], 1),
+            'stats': data.get('stats') or {},
+            'timings': data.get('timings') or {},
+        })
+    return snapshots
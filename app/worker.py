@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+証憑処理ワーカー
+
+T_証憑ジョブ から待機中のジョブを取得し、OCR・AI・国税庁検索を実行します。
+Web プロセスとは別に起動します（Procfile の worker）。
+
+    python -m app.worker                 # CPUコア数ぶんのワーカープロセス
+    python -m app.worker --concurrency 4
+"""
+
+from __future__ import annotations
+
+import argparse
+import multiprocessing
+import os
+import signal
+import time
+import traceback
+
+from .utils.google_vision_helper import setup_google_credentials
+
+
+# キューが空のときのポーリング間隔（秒）
+POLL_INTERVAL = float(os.environ.get('VOUCHER_WORKER_POLL_INTERVAL', '1.0'))
+# running のまま止まったジョブ（ワーカーの強制終了など）を queued に戻す間隔（秒）
+REQUEUE_INTERVAL = float(os.environ.get('VOUCHER_JOB_REQUEUE_INTERVAL', '60'))
+# キャッシュの保守（AIキャッシュのヒット件数の書き込み、AI・国税庁キャッシュの期限切れの削除）の間隔（秒）
+CACHE_MAINTENANCE_INTERVAL = float(os.environ.get('CACHE_MAINTENANCE_INTERVAL', '300'))
+# 同一テナントのジョブをまとめて取得する最大件数（Vision のバッチOCR 1リクエストの上限が16枚）
+# まとめて取得するのはバッチOCRのためだけで、OCR後は先頭の1件以外をキューに戻す
+BATCH_SIZE = min(16, int(os.environ.get('VOUCHER_WORKER_BATCH_SIZE', '16')))
+
+
+def _default_concurrency() -> int:
+    value = os.environ.get('VOUCHER_WORKER_CONCURRENCY')
+    if value:
+        return max(1, int(value))
+    return max(1, os.cpu_count() or 1)
+
+
+def process_job(job) -> None:
+    """ジョブ1件を実行して結果を T_証憑ジョブ に記録"""
+    from .utils.db import get_db
+    from .utils.voucher_jobs import update_job_progress, complete_job, fail_job
+    from .utils.voucher_pipeline import run_voucher_pipeline
+    from .utils.timing import start_trace, end_trace
+    from .utils.memory import reset_peak_rss, peak_rss_mb
+
+    # ジョブ中のピークRSSを測るためにリセットしておく
+    reset_peak_rss()
+    trace = start_trace()
+    started = time.perf_counter()
+    status = 'failed'
+    status_conn = get_db()
+    try:
+        def progress(stage: str, percent: int):
+            try:
+                update_job_progress(status_conn, job['id'], stage, percent)
+            except Exception as e:
+                print(f"ジョブ進捗更新エラー (job={job['id']}): {e}")
+
+        try:
+            result = run_voucher_pipeline(
+                job['tenant_id'],
+                job['uploaded_by'],
+                job['画像パス'],
+                progress=progress,
+            )
+            complete_job(status_conn, job['id'], result.get('voucher_id'), result.get('warning'))
+            status = 'done'
+            print(f"✅ 証憑ジョブ完了: job={job['id']} voucher={result.get('voucher_id')}")
+        except Exception as e:
+            traceback.print_exc()
+            fail_job(status_conn, job['id'], str(e), job['attempts'] or 1)
+            print(f"⚠️ 証憑ジョブ失敗: job={job['id']} {e}")
+    finally:
+        try:
+            status_conn.close()
+        except Exception:
+            pass
+        end_trace(trace, 'voucher_job', (time.perf_counter() - started) * 1000,
+                  job_id=job['id'], tenant_id=job['tenant_id'], status=status,
+                  peak_rss_mb=peak_rss_mb())
+
+
+def prefetch_batch_ocr(jobs) -> None:
+    """
+    まとめて取得したジョブの画像を Vision API でバッチOCRし、OCRキャッシュに入れておく
+    各ジョブのパイプラインはキャッシュから OCR 結果を得る
+    """
+    from .utils.ocr import prefetch_ocr_batch
+    from .utils.voucher_pipeline import load_tenant_ai_settings
+
+    if len(jobs) < 2:
+        return
+    try:
+        settings = load_tenant_ai_settings(jobs[0]['tenant_id'])
+        if settings['google_vision_api_key']:
+            prefetch_ocr_batch([job['画像パス'] for job in jobs], settings['google_vision_api_key'])
+    except Exception as e:
+        # 失敗してもジョブごとの通常OCRで処理できる
+        print(f"⚠️ バッチOCRエラー: {e}")
+
+
+def maintain_caches() -> None:
+    """AIキャッシュのヒット件数をまとめて書き、AI・国税庁キャッシュの期限切れのエントリを削除する"""
+    from .utils.ai_cache import flush_ai_cache_hits, purge_expired_ai_cache
+    from .utils.nta_cache import purge_expired_nta_cache
+
+    try:
+        flush_ai_cache_hits()
+        purged = purge_expired_ai_cache()
+        if purged:
+            print(f"期限切れのAIキャッシュを削除しました: {purged}件")
+    except Exception as e:
+        print(f"⚠️ AIキャッシュの保守エラー: {e}")
+    try:
+        purged = purge_expired_nta_cache()
+        if purged:
+            print(f"期限切れの国税庁キャッシュを削除しました: {purged}件")
+    except Exception as e:
+        print(f"⚠️ 国税庁キャッシュの保守エラー: {e}")
+
+
+def worker_loop(worker_index: int = 0) -> None:
+    """キューをポーリングしてジョブを処理し続ける"""
+    from .utils.db import get_db
+    from .utils.voucher_jobs import claim_job_batch, release_jobs, requeue_stale_jobs
+    from .utils.worker_stats import WORKER_STATS_INTERVAL, publish_worker_stats, worker_key
+
+    setup_google_credentials()
+    stopping = {'flag': False}
+
+    def _stop(signum, frame):
+        stopping['flag'] = True
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    print(f"証憑ワーカー起動: worker={worker_index} pid={os.getpid()}")
+    next_requeue = time.monotonic() + REQUEUE_INTERVAL
+    stats_key = worker_key(worker_index)
+    next_stats = time.monotonic() + WORKER_STATS_INTERVAL
+    next_cache_maintenance = time.monotonic() + CACHE_MAINTENANCE_INTERVAL
+
+    def _publish_stats():
+        # 集計値はこのプロセス内にしか無いため、/healthz で合算できるよう DB に書いておく
+        try:
+            publish_worker_stats(stats_key)
+        except Exception as e:
+            print(f"⚠️ ワーカー統計の書き込みエラー: {e}")
+
+    while not stopping['flag']:
+        # 他のワーカー・dyno が落ちて残したジョブも拾えるよう、起動時だけでなく定期的に戻す
+        if time.monotonic() >= next_requeue:
+            next_requeue = time.monotonic() + REQUEUE_INTERVAL
+            try:
+                conn = get_db()
+                try:
+                    requeued = requeue_stale_jobs(conn)
+                finally:
+                    conn.close()
+                if requeued:
+                    print(f"放置されていたジョブを再キューしました: {requeued}件")
+            except Exception as e:
+                print(f"⚠️ 再キュー処理エラー: {e}")
+
+        if time.monotonic() >= next_stats:
+            next_stats = time.monotonic() + WORKER_STATS_INTERVAL
+            _publish_stats()
+
+        if time.monotonic() >= next_cache_maintenance:
+            next_cache_maintenance = time.monotonic() + CACHE_MAINTENANCE_INTERVAL
+            maintain_caches()
+
+        jobs = []
+        try:
+            conn = get_db()
+            try:
+                jobs = claim_job_batch(conn, max(1, BATCH_SIZE))
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"⚠️ ジョブ取得エラー: {e}")
+
+        if not jobs:
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        # 残りのジョブはOCR結果がキャッシュに入った状態でキューに戻し、空いているワーカーに任せる
+        prefetch_batch_ocr(jobs)
+        if len(jobs) > 1:
+            try:
+                conn = get_db()
+                try:
+                    release_jobs(conn, [job['id'] for job in jobs[1:]])
+                finally:
+                    conn.close()
+                jobs = jobs[:1]
+            except Exception as e:
+                # 戻せなかったジョブは自分で処理する
+                print(f"⚠️ ジョブ返却エラー: {e}")
+        for job in jobs:
+            process_job(job)
+
+    maintain_caches()
+    _publish_stats()
+    print(f"証憑ワーカー停止: worker={worker_index} pid={os.getpid()}")
+
+
+def run_workers(concurrency: int) -> None:
+    """
+    ワーカープロセスを起動して監視する
+    異常終了したプロセスは再起動する
+    """
+    from .utils.db import get_db
+    from .utils.voucher_jobs import requeue_stale_jobs
+
+    try:
+        conn = get_db()
+        requeued = requeue_stale_jobs(conn)
+        conn.close()
+        if requeued:
+            print(f"放置されていたジョブを再キューしました: {requeued}件")
+    except Exception as e:
+        print(f"⚠️ 再キュー処理エラー: {e}")
+
+    processes = {}
+
+    def spawn(index: int):
+        p = multiprocessing.Process(target=worker_loop, args=(index,), daemon=False)
+        p.start()
+        processes[index] = p
+
+    for i in range(concurrency):
+        spawn(i)
+
+    stopping = {'flag': False}
+
+    def _stop(signum, frame):
+        stopping['flag'] = True
+        for p in processes.values():
+            if p.is_alive():
+                p.terminate()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    while not stopping['flag']:
+        for index, p in list(processes.items()):
+            if not p.is_alive() and not stopping['flag']:
+                print(f"⚠️ ワーカー異常終了 → 再起動: worker={index} exitcode={p.exitcode}")
+                spawn(index)
+        time.sleep(1.0)
+
+    for p in processes.values():
+        p.join(timeout=30)
+
+
+def main() -> None:
+    from . import config  # noqa: F401  .env を読み込む
+    from .logging import setup_logging
+    setup_logging(debug=os.environ.get('DEBUG', '0') in ('1', 'true', 'True'))
+
+    parser = argparse.ArgumentParser(description='証憑処理ワーカー')
+    parser.add_argument('--concurrency', type=int, default=_default_concurrency(),
+                        help='ワーカープロセス数（既定: VOUCHER_WORKER_CONCURRENCY またはCPUコア数）')
+    args = parser.parse_args()
+    run_workers(args.concurrency)
+
+
+if __name__ == '__main__':
+    main()
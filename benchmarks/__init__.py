@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+"""
+性能計測スクリプト
+
+リポジトリのルートで `python -m benchmarks.<名前>` として実行します。
+"""
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+登録済み企業のあいまい会社名検索のベンチマーク
+1テナントに架空の企業を登録したインデックスで、OCRの誤読を混ぜた会社名の検索時間と正解率を計る
+
+    python -m benchmarks.company_index
+    python -m benchmarks.company_index --companies 20000 --queries 5000
+
+あわせて、登録済み企業と1〜数文字だけ違う未登録の会社名
+（山田商事 に対する 山田商会、ローソン に対する ローソン100 のような近い名前）を検索し、
+登録済み企業に誤って一致した割合を計る。短い名前ほど誤一致しやすいため、短い社名も混ぜて登録する。
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+from app.utils.company_index import COMPANY_INDEX_TRUST_SCORE, _TenantIndex, normalize_for_match
+
+
+_PARTS = ['サンプル', 'テスト', 'フィクスチャ', 'ミホン', 'レイ', 'ダミー', 'モデル', 'アルファ', 'ベータ',
+          '東西', '南北', '中央', '第一', '日本', '東京', '大阪', '北', '新', '光', '緑']
+_KINDS = ['商事', '交通', '物産', '電機', '運輸', '食品', '建設', '不動産', 'ストア', 'マート', '薬局', 'タクシー']
+_FORMS = ['株式会社{}', '{}株式会社', '有限会社{}', '合同会社{}', '(株){}']
+# 短い社名（姓 + 業種）
+_SURNAMES = ['山田', '田中', '佐藤', '鈴木', '高橋', '伊藤', '渡辺', '中村', '小林', '加藤']
+# 1文字違いの業種（未登録の近い名前を作るのに使う）
+_NEAR_KINDS = {'商事': '商会', '物産': '物流', '電機': '電気', '食品': '食堂', '建設': '建材', '交通': '交易',
+               '運輸': '運送', 'ストア': 'スト', 'マート': 'マーク', '薬局': '薬品', '不動産': '不動産販売',
+               'タクシー': 'タクシー無線'}
+# 店舗番号・ブランド名などの付け足し
+_SUFFIXES = ['100', '2号店', 'ホールディングス', 'プラス', 'HD']
+# OCRで起きやすい誤読
+_OCR_NOISE = [('株式会社', '林式会社'), ('株式会社', '抹式会社'), ('ロ', '口'), ('エ', '工'), ('カ', '力'),
+              ('ー', '一'), ('ニ', '二')]
+
+
+def make_companies(count: int, rng: random.Random):
+    names = set()
+    # 1割は「山田商事」のような短い社名
+    for surname in _SURNAMES:
+        for kind in _KINDS:
+            if len(names) < count // 10:
+                names.add(rng.choice(_FORMS).format(surname + kind))
+    while len(names) < count:
+        # 実在の社名に近いばらつきを出すため、カタカナ2〜3文字の固有部分を混ぜる
+        unique = ''.join(chr(rng.randrange(ord('ア'), ord('ン') + 1)) for _ in range(rng.randint(2, 3)))
+        core = rng.choice(_PARTS) + unique + rng.choice(_KINDS)
+        names.add(rng.choice(_FORMS).format(core))
+    return sorted(names)
+
+
+def make_neighbour(name: str, registered: set, rng: random.Random):
+    """登録済みの社名に近い未登録の社名（作れなければNone）"""
+    for _ in range(10):
+        if rng.random() < 0.6:
+            kinds = [kind for kind in _NEAR_KINDS if kind in name]
+            if not kinds:
+                continue
+            kind = rng.choice(kinds)
+            neighbour = name.replace(kind, _NEAR_KINDS[kind], 1)
+        else:
+            neighbour = normalize_for_match(name) + rng.choice(_SUFFIXES)
+        if normalize_for_match(neighbour) not in registered:
+            return neighbour
+    return None
+
+
+def add_noise(name: str, rng: random.Random) -> str:
+    noisy = name
+    for src, dst in rng.sample(_OCR_NOISE, 3):
+        noisy = noisy.replace(src, dst, 1)
+    if rng.random() < 0.3:
+        noisy = noisy.replace('株式会社', '(株)')
+    if rng.random() < 0.2:
+        noisy = noisy + ' '
+    return noisy
+
+
+def add_typo(name: str, rng: random.Random) -> str:
+    """取り違えやすい文字以外の1文字の読み違い（長い名前でだけ起こす）"""
+    core = normalize_for_match(name)
+    if len(core) < 8:
+        return name
+    position = rng.randrange(len(core))
+    return core[:position] + 'ヰ' + core[position + 1:]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='あいまい会社名検索のベンチマーク')
+    parser.add_argument('--companies', type=int, default=5000, help='1テナントの企業数')
+    parser.add_argument('--queries', type=int, default=2000, help='検索回数')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    names = make_companies(args.companies, rng)
+    index = _TenantIndex()
+    started = time.perf_counter()
+    for company_id, name in enumerate(names, 1):
+        index.upsert({'id': company_id, '会社名': name, '法人番号': None,
+                      'インボイス登録番号': None, '都道府県': None})
+    print(f"索引作成: {len(names):,}社 {(time.perf_counter() - started) * 1000:.1f}ms "
+          f"（2-gram {len(index.postings):,}種）")
+
+    timings = []
+    correct = 0
+    unmatched = 0
+    for i in range(args.queries):
+        company_id = rng.randrange(len(names)) + 1
+        query = add_noise(names[company_id - 1], rng)
+        if i % 5 == 0:
+            query = add_typo(query, rng)
+        t0 = time.perf_counter()
+        matches = index.search(normalize_for_match(query), None, 1)
+        timings.append((time.perf_counter() - t0) * 1000)
+        if not matches:
+            unmatched += 1
+        elif matches[0]['company_id'] == company_id or \
+                normalize_for_match(matches[0]['会社名']) == normalize_for_match(names[company_id - 1]):
+            correct += 1
+
+    timings.sort()
+    print(f"検索: {args.queries}回  平均 {statistics.mean(timings):.3f}ms  "
+          f"p50 {timings[len(timings) // 2]:.3f}ms  p99 {timings[int(len(timings) * 0.99)]:.3f}ms")
+    print(f"正解 {correct}/{args.queries}  一致なし {unmatched}")
+
+    # 未登録の近い名前が登録済み企業に一致してしまう割合
+    registered = {normalize_for_match(name) for name in names}
+    false_matches = 0
+    trusted = 0
+    short_false = 0
+    short_total = 0
+    tried = 0
+    examples = []
+    while tried < args.queries:
+        name = names[rng.randrange(len(names))]
+        neighbour = make_neighbour(name, registered, rng)
+        if neighbour is None:
+            continue
+        tried += 1
+        short = len(normalize_for_match(name)) <= 6
+        short_total += short
+        matches = index.search(normalize_for_match(add_noise(neighbour, rng)), None, 1)
+        if matches:
+            false_matches += 1
+            short_false += short
+            trusted += matches[0]['score'] >= COMPANY_INDEX_TRUST_SCORE
+            if len(examples) < 3:
+                examples.append(f"{neighbour} → {matches[0]['会社名']} ({matches[0]['score']})")
+    print(f"近い未登録名の誤一致 {false_matches}/{tried}（6文字以下の社名 {short_false}/{short_total}）"
+          f"  うち国税庁APIを呼ばずに使われるもの（類似度{COMPANY_INDEX_TRUST_SCORE}以上） {trusted}")
+    for example in examples:
+        print(f"  例: {example}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+重複検出（同じレシートの再登録）のベンチマーク
+レシートを模したOCRテキストを1テナントに大量登録した SQLite で、
+find_same_receipt の所要時間・候補件数と、検出漏れ・誤検出の割合を計る
+
+    python -m benchmarks.duplicate_lookup
+    python -m benchmarks.duplicate_lookup --rows 1000000 --queries 3000 --noise 0.03
+
+問い合わせは次の3種類を同数ずつ:
+- 撮り直し: 登録済みレシートの本文に OCR の読み違い・欠落（--noise の割合）を入れたもの（見つかるべき）
+- 別のレシート: 新しく作ったレシート（見つかってはいけない）
+- 同じ買い物: 登録済みと同じ店・同じ日・同じ品目・同じ合計で、時刻とレシート番号だけ違うもの
+  （最も紛らわしい別レシート。見つかってはいけない）
+
+合計金額は品目の価格の組み合わせで、日付は1年の範囲なので、
+同じ「合計金額 + 日付」の登録済み証憑が現実と同じように複数見つかる。
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from app.utils.db import init_schema
+from app.utils.duplicate_detection import find_same_receipt, receipt_fingerprint
+
+
+STORES = [
+    'セブンイレブン 千代田神田店', 'ファミリーマート 神田駅前店', 'ローソン 内神田一丁目店',
+    'サンプル交通株式会社', 'カフェ・ミホン 本店', 'テスト書店 神保町店', 'ダミー薬局 中央店',
+    '見本文具株式会社', 'サンプル食堂', 'コインパーキング見本',
+]
+ITEMS = [
+    ('コーヒー', 150), ('カフェラテ', 220), ('サンドイッチ', 398), ('おにぎり', 140), ('お茶', 130),
+    ('弁当', 550), ('ボールペン', 110), ('ノート', 198), ('コピー用紙', 480), ('切手', 84),
+    ('電池', 330), ('タクシー料金', 1200), ('駐車料金', 600), ('会議用菓子', 1080), ('付箋', 275),
+]
+# OCRで取り違えやすい文字
+CONFUSIONS = {'0': 'O', '1': 'l', '8': 'B', '5': 'S', 'ロ': '口', 'エ': '工', 'カ': '力', 'ー': '一', '株': '林'}
+
+
+def make_receipt(rng: random.Random, store=None, date=None, items=None):
+    """レシートのOCRテキストと、合計金額・日付を作る"""
+    store = store or rng.choice(STORES)
+    date = date or (rng.randint(1, 12), rng.randint(1, 28))
+    items = items or [rng.choice(ITEMS) for _ in range(rng.randint(1, 5))]
+    total = sum(price for _, price in items)
+    lines = [
+        store,
+        '東京都千代田区神田1-2-3',
+        'TEL 03-1234-5678',
+        f"2024年{date[0]}月{date[1]}日 {rng.randint(7, 22)}:{rng.randint(0, 59):02d}",
+        f"レジ{rng.randint(1, 4)} No.{rng.randint(1000, 9999)}",
+    ]
+    lines += [f"{name} ¥{price:,}" for name, price in items]
+    lines += [f"合計 ¥{total:,}", f"お預り ¥{(total // 1000 + 1) * 1000:,}", '登録番号 T1234567890123']
+    ocr_result = {
+        'full_text': '\n'.join(lines),
+        'amount': float(total),
+        'date': f"2024-{date[0]:02d}-{date[1]:02d}",
+    }
+    return ocr_result, (store, date, items)
+
+
+def add_ocr_noise(text: str, rng: random.Random, rate: float) -> str:
+    """読み違い（rate）・文字の欠落（rate の3割）・行の欠落（5%）を入れる"""
+    lines = []
+    for line in text.split('\n'):
+        if rng.random() < 0.05:
+            continue
+        chars = []
+        for char in line:
+            r = rng.random()
+            if r < rate:
+                chars.append(CONFUSIONS.get(char, rng.choice('abcxyzアイウ')))
+            elif r < rate * 1.3:
+                continue
+            else:
+                chars.append(char)
+        lines.append(''.join(chars))
+    return '\n'.join(lines)
+
+
+def populate(conn, tenant_id: int, rows: int, rng: random.Random, noise: float, batch: int = 20000):
+    """レシートを rows 件登録し、その一部（元のテキストと内容）を返す"""
+    cur = conn.cursor()
+    samples = []
+    for start in range(0, rows, batch):
+        vouchers = []
+        fingerprints = []
+        for voucher_id in range(start + 1, min(rows, start + batch) + 1):
+            ocr_result, content = make_receipt(rng)
+            if len(samples) < 10000:
+                samples.append((ocr_result, content))
+            vouchers.append((voucher_id, tenant_id, add_ocr_noise(ocr_result['full_text'], rng, noise)))
+            fingerprints.append((tenant_id, voucher_id, receipt_fingerprint(ocr_result)))
+        cur.executemany('INSERT INTO "T_証憑" (id, tenant_id, OCR結果_生データ) VALUES (?, ?, ?)', vouchers)
+        cur.executemany('''
+            INSERT INTO "T_証憑重複指紋" (tenant_id, voucher_id, fingerprint) VALUES (?, ?, ?)
+        ''', fingerprints)
+    conn.commit()
+    return samples
+
+
+def candidate_count(conn, tenant_id: int, ocr_result) -> int:
+    cur = conn.cursor()
+    cur.execute('SELECT COUNT(*) FROM "T_証憑重複指紋" WHERE tenant_id = ? AND fingerprint = ?',
+                (tenant_id, receipt_fingerprint(ocr_result)))
+    return cur.fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='重複検出のベンチマーク')
+    parser.add_argument('--rows', type=int, default=200000, help='登録する証憑の件数')
+    parser.add_argument('--queries', type=int, default=3000, help='検索回数（3種類を同数ずつ）')
+    parser.add_argument('--noise', type=float, default=0.03, help='OCRの1文字あたりの読み違いの割合')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    conn = sqlite3.connect(path)
+    init_schema(conn)
+    # T_証憑 はアプリ本体のスキーマで作られるため、ベンチマークでは必要な列だけ作る
+    conn.execute('CREATE TABLE IF NOT EXISTS "T_証憑" (id INTEGER PRIMARY KEY, tenant_id INTEGER, OCR結果_生データ TEXT)')
+
+    started = time.perf_counter()
+    samples = populate(conn, 1, args.rows, rng, args.noise)
+    print(f"登録: {args.rows:,}件 {time.perf_counter() - started:.1f}秒")
+
+    kinds = ('撮り直し', '別のレシート', '同じ買い物')
+    timings = []
+    candidates = []
+    flagged = {kind: 0 for kind in kinds}
+    asked = {kind: 0 for kind in kinds}
+    for i in range(args.queries):
+        kind = kinds[i % 3]
+        if kind == '撮り直し':
+            original, _ = rng.choice(samples)
+            query = dict(original, full_text=add_ocr_noise(original['full_text'], rng, args.noise))
+        elif kind == '別のレシート':
+            query, _ = make_receipt(rng)
+            query['full_text'] = add_ocr_noise(query['full_text'], rng, args.noise)
+        else:
+            _, (store, date, items) = rng.choice(samples)
+            query, _ = make_receipt(rng, store, date, items)
+            query['full_text'] = add_ocr_noise(query['full_text'], rng, args.noise)
+
+        t0 = time.perf_counter()
+        matches = find_same_receipt(1, query, conn=conn)
+        timings.append((time.perf_counter() - t0) * 1000)
+        candidates.append(candidate_count(conn, 1, query))
+        asked[kind] += 1
+        if matches:
+            flagged[kind] += 1
+
+    timings.sort()
+    candidates.sort()
+    print(f"検索: {args.queries}回  平均 {statistics.mean(timings):.3f}ms  "
+          f"p50 {timings[len(timings) // 2]:.3f}ms  p99 {timings[int(len(timings) * 0.99)]:.3f}ms")
+    print(f"候補件数（合計金額+日付が一致）: p50 {candidates[len(candidates) // 2]}  "
+          f"p99 {candidates[int(len(candidates) * 0.99)]}  最大 {candidates[-1]}")
+    print(f"撮り直しの検出率: {flagged['撮り直し']}/{asked['撮り直し']}")
+    print(f"別のレシートの誤検出: {flagged['別のレシート']}/{asked['別のレシート']}")
+    print(f"同じ買い物の誤検出: {flagged['同じ買い物']}/{asked['同じ買い物']}")
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+項目抽出ベンチマーク
+ocr.py の extract_* 関数を個別に呼ぶ従来方式と、
+field_extraction.extract_receipt_fields を合成レシートで比較する
+
+    python -m benchmarks.field_extraction
+    python -m benchmarks.field_extraction --receipts 2000 --repeat 5
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+from app.utils.field_extraction import PREFECTURES, extract_receipt_fields
+from app.utils.ocr import (
+    extract_company_name, extract_phone_numbers, extract_addresses, extract_postal_code,
+    extract_amount, extract_date, extract_invoice_number, extract_corporate_number,
+)
+
+
+FIELDS = (
+    'company_name', 'phone_numbers', 'addresses', 'postal_code',
+    'amount', 'date', 'invoice_number', 'corporate_number',
+)
+
+_COMPANY_FORMATS = ('株式会社{}', '{}株式会社', '有限会社{}', '合同会社{}', '㈱{}')
+_NAMES = ('山田商店', 'サンプル', 'テスト物産', 'ABCフーズ', '青空書房', 'みどり薬局')
+_ITEMS = ('コーヒー', 'サンドイッチ', 'ノート', 'ボールペン', '弁当', 'お茶', '電池')
+
+
+def make_receipt(rng: random.Random) -> str:
+    """それらしいレシートのOCRテキストを1件作る"""
+    company = rng.choice(_COMPANY_FORMATS).format(rng.choice(_NAMES))
+    prefecture = rng.choice(PREFECTURES)
+    lines = [
+        company,
+        f"〒{rng.randint(100, 999)}-{rng.randint(0, 9999):04d}",
+        f"{prefecture}中央区{rng.randint(1, 9)}-{rng.randint(1, 30)}-{rng.randint(1, 20)}",
+        f"TEL {rng.randint(1, 99):02d}-{rng.randint(1000, 9999)}-{rng.randint(0, 9999):04d}",
+        f"{rng.randint(2020, 2025)}年{rng.randint(1, 12)}月{rng.randint(1, 28)}日 "
+        f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}",
+        '-' * 20,
+    ]
+    total = 0
+    for _ in range(rng.randint(3, 15)):
+        price = rng.randint(1, 300) * 10
+        total += price
+        lines.append(f"{rng.choice(_ITEMS)}  ¥{price:,}")
+    lines.extend([
+        '-' * 20,
+        f"小計 ¥{total:,}",
+        f"合計 {total:,}円",
+        f"登録番号 T{rng.randint(10 ** 12, 10 ** 13 - 1)}",
+        'ご来店ありがとうございました',
+    ])
+    return '\n'.join(lines)
+
+
+def extract_legacy(text: str) -> dict:
+    """従来の process_receipt_image と同じ呼び出し方"""
+    return {
+        'company_name': extract_company_name(text),
+        'phone_numbers': extract_phone_numbers(text),
+        'addresses': extract_addresses(text),
+        'postal_code': extract_postal_code(text),
+        'amount': extract_amount(text),
+        'date': extract_date(text),
+        'invoice_number': extract_invoice_number(text),
+        'corporate_number': extract_corporate_number(text),
+    }
+
+
+def _same(field: str, a, b) -> bool:
+    if field == 'phone_numbers':
+        return set(a or []) == set(b or [])
+    return a == b
+
+
+def _time_per_receipt(func, corpus, repeat: int) -> float:
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for text in corpus:
+            func(text)
+        runs.append(time.perf_counter() - started)
+    return statistics.median(runs) / len(corpus) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='項目抽出ベンチマーク')
+    parser.add_argument('--receipts', type=int, default=1000, help='合成レシート件数')
+    parser.add_argument('--repeat', type=int, default=3, help='計測回数')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    corpus = [make_receipt(rng) for _ in range(args.receipts)]
+
+    legacy_us = _time_per_receipt(extract_legacy, corpus, args.repeat)
+    single_us = _time_per_receipt(extract_receipt_fields, corpus, args.repeat)
+
+    agree = {field: 0 for field in FIELDS}
+    for text in corpus:
+        old = extract_legacy(text)
+        new = extract_receipt_fields(text)
+        for field in FIELDS:
+            if _same(field, old[field], new[field]):
+                agree[field] += 1
+
+    print(f"レシート {len(corpus)} 件")
+    print(f"従来（extract_* 個別）: {legacy_us:8.1f} µs/件")
+    print(f"抽出エンジン          : {single_us:8.1f} µs/件  ({legacy_us / single_us:.1f}倍)")
+    print('項目ごとの一致率:')
+    for field in FIELDS:
+        print(f"  {field:<17} {agree[field] / len(corpus):.1%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+OCR前処理ベンチマーク
+前処理の有無で、OCRエンジンに送るバイト数と OCR 時間を比較する
+
+    python -m benchmarks.ocr_preprocess receipt1.jpg receipt2.jpg
+    python -m benchmarks.ocr_preprocess --vision-key XXXX receipt.jpg
+    python -m benchmarks.ocr_preprocess            # 合成したレシート写真で計測
+
+OCR時間は --vision-key 指定時は Vision API（APIキー）、
+それ以外は Tesseract（インストールされている場合）で計測する。
+"""
+
+import argparse
+import base64
+import os
+import statistics
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+from app.utils.image_preprocess import preprocess_image_file, preprocess_signature
+
+
+def make_synthetic_receipt(path: str, size=(4032, 3024)) -> str:
+    """スマホ写真相当のサイズで、背景の上にレシートを置いた画像を作る"""
+    image = Image.new('RGB', size, (90, 80, 70))
+    draw = ImageDraw.Draw(image)
+    left, top = size[0] // 3, size[1] // 10
+    right, bottom = size[0] * 2 // 3, size[1] * 9 // 10
+    draw.rectangle([left, top, right, bottom], fill=(245, 245, 240))
+    lines = ['RECEIPT', '2024/01/05 12:34', 'TEL 03-1234-5678', 'T1234567890123',
+             'COFFEE   480', 'SANDWICH 620', 'TOTAL   1,100']
+    for i, line in enumerate(lines):
+        draw.text((left + 60, top + 80 + i * 120), line, fill=(20, 20, 20))
+    image.save(path, format='JPEG', quality=95)
+    return path
+
+
+def ocr_tesseract(content: bytes) -> float:
+    import io
+    import pytesseract
+    started = time.perf_counter()
+    pytesseract.image_to_string(Image.open(io.BytesIO(content)), lang='jpn')
+    return time.perf_counter() - started
+
+
+def ocr_vision(content: bytes, api_key: str) -> float:
+    import requests
+    from app.utils.ocr import VISION_ANNOTATE_URL, _build_vision_request
+    started = time.perf_counter()
+    response = requests.post(
+        f'{VISION_ANNOTATE_URL}?key={api_key}',
+        json={'requests': [_build_vision_request(base64.b64encode(content).decode('utf-8'))]},
+        timeout=60
+    )
+    response.raise_for_status()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OCR前処理ベンチマーク')
+    parser.add_argument('images', nargs='*', help='計測する画像ファイル')
+    parser.add_argument('--vision-key', help='Google Cloud Vision APIキー（指定時は Vision で計測）')
+    parser.add_argument('--repeat', type=int, default=1, help='OCRの計測回数')
+    args = parser.parse_args()
+
+    images = args.images
+    tmpdir = None
+    if not images:
+        tmpdir = tempfile.mkdtemp()
+        images = [make_synthetic_receipt(os.path.join(tmpdir, 'synthetic.jpg'))]
+
+    if args.vision_key:
+        engine = 'vision'
+        run_ocr = lambda content: ocr_vision(content, args.vision_key)
+    else:
+        try:
+            import pytesseract
+            pytesseract.get_tesseract_version()
+            engine = 'tesseract'
+            run_ocr = ocr_tesseract
+        except Exception:
+            engine = None
+            run_ocr = None
+
+    print(f"前処理設定: {preprocess_signature()}  OCRエンジン: {engine or '（なし: バイト数のみ計測）'}")
+    print(f"{'画像':<30} {'元(KB)':>9} {'後(KB)':>9} {'base64後(KB)':>13} {'前処理(ms)':>11} "
+          f"{'OCR前(ms)':>10} {'OCR後(ms)':>10}")
+
+    totals = {'before': 0, 'after': 0}
+    for path in images:
+        with open(path, 'rb') as f:
+            original = f.read()
+
+        started = time.perf_counter()
+        processed = preprocess_image_file(path)
+        preprocess_ms = (time.perf_counter() - started) * 1000
+
+        ocr_before = ocr_after = None
+        if run_ocr:
+            ocr_before = statistics.median(run_ocr(original) for _ in range(args.repeat)) * 1000
+            ocr_after = statistics.median(run_ocr(processed) for _ in range(args.repeat)) * 1000
+
+        totals['before'] += len(original)
+        totals['after'] += len(processed)
+        encoded_after = (len(processed) + 2) // 3 * 4
+        print(f"{os.path.basename(path)[:30]:<30} {len(original) / 1024:>9.1f} {len(processed) / 1024:>9.1f} "
+              f"{encoded_after / 1024:>13.1f} {preprocess_ms:>11.1f} "
+              f"{ocr_before if ocr_before is not None else float('nan'):>10.1f} "
+              f"{ocr_after if ocr_after is not None else float('nan'):>10.1f}")
+
+    if totals['before']:
+        ratio = totals['after'] / totals['before']
+        print(f"合計: {totals['before'] / 1024:.1f}KB → {totals['after'] / 1024:.1f}KB ({ratio:.1%})")
+
+
+if __name__ == '__main__':
+    main()